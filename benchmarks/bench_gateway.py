@@ -0,0 +1,212 @@
+# End-to-end timings of UPnPinterface against benchmarks.fake_igd on the loopback interface:
+# discovery latency, enumeration time against table size, add/remove throughput and renewal lag.
+# Also compares the memory a large table takes as decoded dicts and as PortMapping records, and
+# lease renewals over SOAP, PCP and NAT-PMP (the fake's --latency only delays SOAP calls).
+# Needs no network, so results from two revisions on the same machine can be compared directly.
+# Run from the repository root: python -m benchmarks.bench_gateway [--latency 0.002]
+import argparse
+import contextlib
+import os
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from benchmarks.fake_igd import FakeIGD
+from classes.upnp_interface import UPnPinterface
+from classes.port_mapping import PortMapping
+from classes.renewal_scheduler import RenewalScheduler
+
+# UPnPinterface reports progress with print(), which is discarded while measuring
+output = sys.stdout
+
+def report(name, value, unit, detail=''):
+    print(f"{name:<40}{value:>12.2f} {unit:<8}{detail}", file=output)
+
+def bench_discovery(args):
+    igd = FakeIGD(latency=args.latency, ssdp_latency=args.latency).start()
+    try:
+        samples = []
+        for _ in range(args.repeat):
+            upnp = UPnPinterface(igd.interface_data())
+            started = time.perf_counter()
+            upnp.resolve_gateway(force=True)
+            samples.append(time.perf_counter() - started)
+            upnp.close()
+        report("discovery (M-SEARCH + descriptions)", statistics.median(samples) * 1000, "ms", f"median of {args.repeat}")
+    finally:
+        igd.stop()
+
+def bench_enumeration(args):
+    for version in (1, 2):
+        for size in args.sizes:
+            igd = FakeIGD(table_size=size, latency=args.latency, version=version).start()
+            try:
+                upnp = UPnPinterface(igd.interface_data())
+                upnp.resolve_gateway()
+                samples = []
+                for _ in range(args.repeat):
+                    igd.calls.clear()
+                    started = time.perf_counter()
+                    mappings = upnp.get_port_mappings()
+                    samples.append(time.perf_counter() - started)
+                assert len(mappings) == size, f"enumerated {len(mappings)} of {size}"
+                report(f"enumerate IGDv{version}, {size} entries", statistics.median(samples) * 1000, "ms",
+                       f"{sum(igd.calls.values())} SOAP calls")
+
+                # How soon iter_port_mappings() has a first row to show
+                samples = []
+                for _ in range(args.repeat):
+                    started = time.perf_counter()
+                    mappings = upnp.iter_port_mappings()
+                    next(mappings, None)
+                    samples.append(time.perf_counter() - started)
+                    mappings.close()
+                report(f"first row IGDv{version}, {size} entries", statistics.median(samples) * 1000, "ms")
+                upnp.close()
+            finally:
+                igd.stop()
+
+def fresh_entry(entry):
+    # A copy with new string objects, as a SOAP decode would produce
+    return {key: value.encode().decode() for key, value in entry.items()}
+
+def retained(build):
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = build()
+        return tracemalloc.get_traced_memory()[0] - before, result
+    finally:
+        tracemalloc.stop()
+
+def bench_memory(args):
+    size = max(args.sizes)
+    igd = FakeIGD(table_size=size).start()
+    try:
+        upnp = UPnPinterface(igd.interface_data())
+        entries = upnp.get_port_mappings()
+        upnp.close()
+    finally:
+        igd.stop()
+    dict_bytes, _ = retained(lambda: [fresh_entry(entry) for entry in entries])
+    record_bytes, _ = retained(lambda: [PortMapping.from_entry(fresh_entry(entry)) for entry in entries])
+    report(f"table memory as dicts, {size} entries", dict_bytes / 1024, "KiB")
+    report(f"table memory as records, {size} entries", record_bytes / 1024, "KiB", f"{dict_bytes / record_bytes:.1f}x smaller")
+
+def bench_add_remove(args):
+    igd = FakeIGD(latency=args.latency).start()
+    try:
+        upnp = UPnPinterface(igd.interface_data())
+        upnp.resolve_gateway()
+        specs = [{
+            'ip':'192.168.1.20',
+            'external_port':20000 + offset,
+            'internal_port':20000 + offset,
+            'protocol':'UDP',
+            'description':'bench',
+            'lease':3600
+        } for offset in range(args.count)]
+
+        started = time.perf_counter()
+        results = upnp.add_port_mappings(specs)
+        elapsed = time.perf_counter() - started
+        assert all(result['code'] == 0 for result in results)
+        report(f"add {args.count} mappings", args.count / elapsed, "ops/s",
+               f"p50 latency {statistics.median(result['latency'] for result in results) * 1000:.2f} ms")
+
+        started = time.perf_counter()
+        results = upnp.remove_port_mappings([(spec['external_port'], spec['protocol']) for spec in specs])
+        elapsed = time.perf_counter() - started
+        assert all(result['code'] == 0 for result in results)
+        report(f"remove {args.count} mappings", args.count / elapsed, "ops/s",
+               f"p50 latency {statistics.median(result['latency'] for result in results) * 1000:.2f} ms")
+        upnp.close()
+    finally:
+        igd.stop()
+
+def bench_port_control(args):
+    # The same leases for this host added, renewed and removed over each protocol. CPU time is
+    # the whole process, client and fake gateway together.
+    for protocol in ('soap', 'pcp', 'natpmp'):
+        igd = FakeIGD(latency=args.latency, port_control=('pcp', 'natpmp')).start()
+        try:
+            upnp = UPnPinterface(igd.interface_data(location=igd.location, port_control=protocol))
+            ip = upnp.get_local_ip()
+            specs = [{
+                'ip':ip,
+                'external_port':20000 + offset,
+                'internal_port':20000 + offset,
+                'protocol':'UDP',
+                'description':'bench',
+                'lease':3600
+            } for offset in range(args.count)]
+            results = upnp.add_port_mappings(specs)
+            assert all(result['code'] == 0 for result in results)
+
+            started, cpu = time.perf_counter(), time.process_time()
+            results = upnp.add_port_mappings(specs)
+            elapsed, cpu = time.perf_counter() - started, time.process_time() - cpu
+            assert all(result['code'] == 0 for result in results)
+            report(f"renew {args.count} leases over {protocol}", args.count / elapsed, "ops/s",
+                   f"p50 latency {statistics.median(result['latency'] for result in results) * 1000:.2f} ms, "
+                   f"{cpu / args.count * 1e6:.0f} us CPU/op")
+
+            results = upnp.remove_port_mappings([(spec['external_port'], spec['protocol']) for spec in specs])
+            assert all(result['code'] == 0 for result in results) and not igd.table
+            upnp.close()
+        finally:
+            igd.stop()
+
+def bench_renewal_lag(args):
+    # Every lease is due in the same instant, lag is how long after its due time each one was renewed
+    igd = FakeIGD(latency=args.latency).start()
+    try:
+        upnp = UPnPinterface(igd.interface_data())
+        upnp.resolve_gateway()
+        lags = []
+        finished = threading.Event()
+
+        def on_result(key, lease, result):
+            lags.append(time.monotonic() - due[key])
+            if len(lags) == args.count:
+                finished.set()
+
+        scheduler = RenewalScheduler(upnp.add_port_mappings, on_result=on_result, batch_window=0)
+        due = {}
+        start = time.monotonic() + 0.2
+        for offset in range(args.count):
+            lease = {
+                'ip':'192.168.1.20',
+                'external_port':30000 + offset,
+                'internal_port':30000 + offset,
+                'protocol':'UDP',
+                'description':'bench',
+                'lease':3600
+            }
+            due[scheduler.lease_key(lease)] = scheduler.schedule(lease, due=start)
+        scheduler.start()
+        finished.wait(60)
+        scheduler.stop()
+        lags.sort()
+        report(f"renewal lag, {args.count} leases due together", statistics.median(lags) * 1000, "ms",
+               f"max {lags[-1] * 1000:.2f} ms")
+        upnp.close()
+    finally:
+        igd.stop()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark UPnPinterface against a local fake gateway.")
+    parser.add_argument('--latency', type=float, default=0, help="Seconds the fake gateway adds to every call")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000], help="Table sizes to enumerate")
+    parser.add_argument('--count', type=int, default=200, help="Mappings for the add/remove and renewal runs")
+    parser.add_argument('--repeat', type=int, default=5, help="Runs per timing, the median is reported")
+    args = parser.parse_args()
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        bench_discovery(args)
+        bench_enumeration(args)
+        bench_memory(args)
+        bench_add_remove(args)
+        bench_port_control(args)
+        bench_renewal_lag(args)
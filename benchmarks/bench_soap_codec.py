@@ -0,0 +1,96 @@
+# Per-call CPU and allocation cost of building and parsing SOAP messages, before (f-string
+# envelope plus ElementTree, as UPnPinterface did originally) and after (classes.soap_codec).
+# Run from the repository root: python -m benchmarks.bench_soap_codec
+import timeit
+import tracemalloc
+from xml.etree import ElementTree
+from classes.soap_codec import encode_request, decode_response
+
+SERVICE_TYPE = 'urn:schemas-upnp-org:service:WANIPConnection:1'
+
+# What both encodes format: gateway location and control URL, then the add_port_mapping arguments
+ADD_ARGUMENTS = ('http://192.168.1.1:5000/rootDesc.xml', '/ctl/IPConn', 27015, 'UDP', 27015, '192.168.1.20',
+                 'Game server', 3600)
+
+ENTRY_RESPONSE = (
+    '<?xml version="1.0"?>\r\n'
+    '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" '
+    's:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body>'
+    '<u:GetGenericPortMappingEntryResponse xmlns:u="urn:schemas-upnp-org:service:WANIPConnection:1">'
+    '<NewRemoteHost></NewRemoteHost><NewExternalPort>27015</NewExternalPort><NewProtocol>UDP</NewProtocol>'
+    '<NewInternalPort>27015</NewInternalPort><NewInternalClient>192.168.1.20</NewInternalClient>'
+    '<NewEnabled>1</NewEnabled><NewPortMappingDescription>Game server</NewPortMappingDescription>'
+    '<NewLeaseDuration>3600</NewLeaseDuration>'
+    '</u:GetGenericPortMappingEntryResponse></s:Body></s:Envelope>\r\n'
+).encode('utf-8')
+
+def legacy_encode(location, control_url, external_port, protocol, internal_port, internal_client, description,
+                  leaseDuration):
+    # The original add_port_mapping body, formatting its arguments
+    url = f"{location.split('/')[0]}//{location.split('/')[2]}{control_url}"
+    body = f"""<?xml version="1.0"?>
+        <s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"
+        s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">
+            <s:Body>
+                <u:AddPortMapping xmlns:u="urn:schemas-upnp-org:service:WANIPConnection:1">
+                    <NewRemoteHost></NewRemoteHost>
+                    <NewExternalPort>{external_port}</NewExternalPort>
+                    <NewProtocol>{protocol}</NewProtocol>
+                    <NewInternalPort>{internal_port}</NewInternalPort>
+                    <NewInternalClient>{internal_client}</NewInternalClient>
+                    <NewEnabled>1</NewEnabled>
+                    <NewPortMappingDescription>{description}</NewPortMappingDescription>
+                    <NewLeaseDuration>{leaseDuration}</NewLeaseDuration>
+                </u:AddPortMapping>
+            </s:Body>
+        </s:Envelope>"""
+    return url, body.encode('utf-8')
+
+def legacy_decode():
+    root = ElementTree.fromstring(ENTRY_RESPONSE.decode('utf-8'))
+    namespace = {'s': 'http://schemas.xmlsoap.org/soap/envelope/'}
+    body = root.find('s:Body', namespace)
+    response = body.find('*')
+    result = {}
+    for child in response:
+        result[child.tag.replace('{http://schemas.xmlsoap.org/soap/envelope/}', '')] = child.text
+    return result
+
+def codec_encode(location, control_url, external_port, protocol, internal_port, internal_client, description,
+                 leaseDuration):
+    # request_add_port_mapping's request, the control endpoint is resolved once per gateway
+    return encode_request(SERVICE_TYPE, 'AddPortMapping', (
+        external_port, protocol, internal_port, internal_client, description, leaseDuration
+    ))
+
+def legacy_encode_call():
+    return legacy_encode(*ADD_ARGUMENTS)
+
+def codec_encode_call():
+    return codec_encode(*ADD_ARGUMENTS)
+
+def codec_decode():
+    return decode_response(ENTRY_RESPONSE)
+
+def measure(func, number):
+    func()
+    seconds = min(timeit.repeat(func, number=number, repeat=5)) / number
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for _ in range(100):
+        func()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename') if stat.count_diff > 0)
+    tracemalloc.start()
+    func()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak, blocks / 100
+
+if __name__ == '__main__':
+    print(f"{'case':<16}{'us/call':>10}{'peak bytes':>12}{'blocks':>8}")
+    for name, func in (('legacy encode', legacy_encode_call), ('codec encode', codec_encode_call),
+                       ('legacy decode', legacy_decode), ('codec decode', codec_decode)):
+        seconds, peak, blocks = measure(func, 20000)
+        print(f"{name:<16}{seconds * 1e6:>10.2f}{peak:>12}{blocks:>8.1f}")
@@ -0,0 +1,637 @@
+import collections
+import http.client
+import queue
+import socket
+import struct
+import threading
+import time
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit
+from xml.sax.saxutils import escape
+from classes.soap_codec import ENVELOPE_HEAD, ENVELOPE_TAIL, SOAPError, SOAPFault, decode_response, fault_from_code
+from classes.port_control import PROTOCOL_NUMBERS, NATPMP_OPCODES, PCP_PREFER_FAILURE, mapped_address
+
+# An Internet Gateway Device on the loopback interface for tests and benchmarks. It answers
+# M-SEARCH on a unicast UDP socket, serves the device and service descriptions and implements
+# the WANIPConnection port mapping actions on an in-memory table, with GENA events whenever the
+# number of mappings changes. Point a client at it with UPnPinterface(fake_igd.interface_data()).
+# With port_control set it also answers PCP and/or NAT-PMP on a UDP port of the same host, mapping
+# into the same table like miniupnpd does. Every socket takes a free port, so several fakes can
+# run at once.
+
+DESCRIPTION_PATH = '/rootDesc.xml'
+SCPD_PATH = '/WANIPCn.xml'
+CONTROL_PATH = '/ctl/IPConn'
+EVENT_PATH = '/evt/IPConn'
+
+QUERY_STATE_ACTION = 'QueryStateVariable'
+
+IGD_V1_ACTIONS = (
+    'AddPortMapping',
+    'DeletePortMapping',
+    'GetGenericPortMappingEntry',
+    'GetSpecificPortMappingEntry',
+    'GetExternalIPAddress'
+)
+IGD_V2_ACTIONS = IGD_V1_ACTIONS + ('GetListOfPortMappings',)
+
+PROTOCOL_NAMES = {number: name for name, number in PROTOCOL_NUMBERS.items()}
+NATPMP_PROTOCOLS = {opcode: name for name, opcode in NATPMP_OPCODES.items()}
+
+def device_type(version):
+    return f'urn:schemas-upnp-org:device:InternetGatewayDevice:{version}'
+
+def service_type(version):
+    return f'urn:schemas-upnp-org:service:WANIPConnection:{version}'
+
+def soap_response(namespace, action, arguments):
+    body = ''.join(f'<{name}>{escape(str(value))}</{name}>' for name, value in arguments)
+    return f'{ENVELOPE_HEAD}<u:{action}Response xmlns:u="{namespace}">{body}</u:{action}Response>{ENVELOPE_TAIL}'.encode('utf-8')
+
+def property_set(variables):
+    properties = ''.join(f'<e:property><{name}>{escape(str(value))}</{name}></e:property>' for name, value in variables.items())
+    return f'<?xml version="1.0"?><e:propertyset xmlns:e="urn:schemas-upnp-org:event-1-0">{properties}</e:propertyset>'.encode('utf-8')
+
+def soap_fault(code, description):
+    return (
+        f'{ENVELOPE_HEAD}<s:Fault><faultcode>s:Client</faultcode><faultstring>UPnPError</faultstring>'
+        '<detail><UPnPError xmlns="urn:schemas-upnp-org:control-1-0">'
+        f'<errorCode>{code}</errorCode><errorDescription>{escape(str(description))}</errorDescription>'
+        f'</UPnPError></detail></s:Fault>{ENVELOPE_TAIL}'
+    ).encode('utf-8')
+
+class FakeIGDRequestHandler(BaseHTTPRequestHandler):
+
+    # Keep-alive like a real router so the client's connection pool gets used
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, with Nagle on every answer would wait for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml; charset="utf-8"')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        document = self.server.fake_igd.documents.get(self.path)
+        if document is None:
+            self.send_body(404, b'Not Found')
+            return
+        self.send_body(200, document)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path != CONTROL_PATH:
+            self.send_body(404, b'Not Found')
+            return
+        status, response = self.server.fake_igd.handle_soap(self.headers.get('SOAPAction', ''), body)
+        self.send_body(status, response)
+
+    def send_event_response(self, status, headers):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_SUBSCRIBE(self):
+        if self.path != EVENT_PATH:
+            self.send_event_response(404, {})
+            return
+        self.send_event_response(*self.server.fake_igd.handle_subscribe(self.headers))
+
+    def do_UNSUBSCRIBE(self):
+        if self.path != EVENT_PATH:
+            self.send_event_response(404, {})
+            return
+        self.send_event_response(self.server.fake_igd.handle_unsubscribe(self.headers), {})
+
+class FakeIGDServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+class FakeIGD:
+
+    def __init__(self, table_size=0, latency=0, ssdp_latency=0, version=1, query_state=True, host='127.0.0.1',
+                 port_control=(), max_lifetime=None, port_control_port=0):
+        # latency is added to every SOAP call and ssdp_latency to every M-SEARCH answer, in seconds.
+        # version 2 also advertises GetListOfPortMappings, query_state=False makes QueryStateVariable
+        # fail like on routers that never implemented it. port_control holds 'pcp' and/or 'natpmp'
+        # to answer, their lifetimes are capped at max_lifetime seconds. port_control_port 0 takes a
+        # free port, give 5351 for clients that can't be told another one, like the CLI.
+        self.host = host
+        self.latency = latency
+        self.ssdp_latency = ssdp_latency
+        self.version = version
+        self.query_state = query_state
+        self.port_control = tuple(port_control)
+        self.max_lifetime = max_lifetime
+        self.requested_port_control_port = port_control_port
+        self.external_ip = '203.0.113.1'
+        self.epoch = time.monotonic()
+
+        # (protocol, external port) -> mapping dict with an 'expires' monotonic time or None
+        self.table = {}
+        # (protocol, external port) -> nonce of the PCP request that made the mapping
+        self.nonces = {}
+        self.entries = None
+        self.next_expiry = None
+        self.lock = threading.Lock()
+        # action -> [errorCode, remaining count or None for every call, match(arguments) or None]
+        self.faults = {}
+        self.calls = collections.Counter()
+        self.searches = 0
+        # sid -> {'callback':url, 'expires':monotonic time, 'sequence':next SEQ}
+        self.subscribers = {}
+        # NOTIFYs go out one at a time from a single thread, so SEQ order is kept
+        self.events = queue.Queue()
+
+        self.http_server = None
+        self.ssdp_socket = None
+        self.port_control_socket = None
+        self.threads = []
+        self.stopping = threading.Event()
+        self.populate(table_size)
+
+    @property
+    def location(self):
+        return f'http://{self.host}:{self.http_server.server_address[1]}{DESCRIPTION_PATH}'
+
+    @property
+    def ssdp_address(self):
+        return self.ssdp_socket.getsockname()
+
+    @property
+    def port_control_port(self):
+        return self.port_control_socket.getsockname()[1] if self.port_control_socket is not None else None
+
+    def interface_data(self, **data):
+        # Constructor data for UPnPinterface and AsyncUPnPinterface that discovers this gateway,
+        # probe answers aren't saved to the user's cache
+        defaults = {'renewals':'', 'ssdp_address':self.ssdp_address, 'port_control_cache':None}
+        if self.port_control_socket is not None:
+            defaults['port_control_port'] = self.port_control_port
+        return dict(defaults, **data)
+
+    def start(self):
+        self.stopping.clear()
+        self.http_server = FakeIGDServer((self.host, 0), FakeIGDRequestHandler)
+        self.http_server.fake_igd = self
+        self.ssdp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.ssdp_socket.bind((self.host, 0))
+        self.ssdp_socket.settimeout(0.2)
+        self.documents = {
+            DESCRIPTION_PATH:self.device_description(),
+            SCPD_PATH:self.service_description()
+        }
+        self.threads = [
+            threading.Thread(target=self.http_server.serve_forever, name="fake-igd-http", daemon=True),
+            threading.Thread(target=self.ssdp_loop, name="fake-igd-ssdp", daemon=True),
+            threading.Thread(target=self.event_loop, name="fake-igd-events", daemon=True)
+        ]
+        if self.port_control:
+            self.port_control_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+            self.port_control_socket.bind((self.host, self.requested_port_control_port))
+            self.port_control_socket.settimeout(0.2)
+            self.threads.append(threading.Thread(target=self.port_control_loop, name="fake-igd-port-control", daemon=True))
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self.stopping.set()
+        self.events.put(None)
+        if self.http_server is not None:
+            self.http_server.shutdown()
+            self.http_server.server_close()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        if self.ssdp_socket is not None:
+            self.ssdp_socket.close()
+        if self.port_control_socket is not None:
+            self.port_control_socket.close()
+            self.port_control_socket = None
+
+    def advertised_targets(self):
+        targets = ['upnp:rootdevice', 'ssdp:all']
+        for version in range(1, self.version + 1):
+            targets += [device_type(version), service_type(version)]
+        return targets
+
+    def ssdp_loop(self):
+        targets = self.advertised_targets()
+        while not self.stopping.is_set():
+            try:
+                data, addr = self.ssdp_socket.recvfrom(8192)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            lines = data.decode('utf-8', errors='replace').splitlines()
+            if not lines or not lines[0].startswith('M-SEARCH'):
+                continue
+            headers = {}
+            for line in lines[1:]:
+                key, _, value = line.partition(':')
+                headers[key.strip().upper()] = value.strip()
+            search_target = headers.get('ST', '')
+            if search_target not in targets:
+                continue
+            self.searches += 1
+            if search_target in ('upnp:rootdevice', 'ssdp:all'):
+                search_target = device_type(self.version)
+            answer = (
+                'HTTP/1.1 200 OK\r\n'
+                'CACHE-CONTROL: max-age=120\r\n'
+                f'ST: {search_target}\r\n'
+                f'USN: uuid:fake-igd::{search_target}\r\n'
+                'EXT:\r\n'
+                'SERVER: FakeIGD UPnP/1.1\r\n'
+                f'LOCATION: {self.location}\r\n'
+                '\r\n'
+            ).encode('utf-8')
+            if self.ssdp_latency:
+                threading.Timer(self.ssdp_latency, self.send_answer, (answer, addr)).start()
+            else:
+                self.send_answer(answer, addr)
+
+    def send_answer(self, answer, addr):
+        try:
+            self.ssdp_socket.sendto(answer, addr)
+        except OSError:
+            pass
+
+    def port_control_loop(self):
+        while not self.stopping.is_set():
+            try:
+                data, addr = self.port_control_socket.recvfrom(1100)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            with self.lock:
+                self.expire()
+                count = len(self.table)
+                answer = self.handle_port_control(data, addr[0])
+                if len(self.table) != count:
+                    self.queue_event({'PortMappingNumberOfEntries':len(self.table)})
+            if answer is not None:
+                try:
+                    self.port_control_socket.sendto(answer, addr)
+                except OSError:
+                    pass
+
+    def handle_port_control(self, data, client):
+        # Called with the lock held, returns the answer datagram or None to stay silent
+        epoch = int(time.monotonic() - self.epoch)
+        if len(data) >= 2 and data[0] == 0 and 'natpmp' in self.port_control:
+            opcode = data[1]
+            self.calls[f'NAT-PMP {opcode}'] += 1
+            if opcode == 0:
+                return struct.pack('!BBHI4s', 0, 128, 0, epoch, socket.inet_aton(self.external_ip))
+            if opcode not in NATPMP_PROTOCOLS or len(data) < 12:
+                return struct.pack('!BBHI', 0, 128 + opcode, 5, epoch)
+            internal_port, external_port, lifetime = struct.unpack('!HHI', data[4:12])
+            result, external_port, lifetime = self.map_port(NATPMP_PROTOCOLS[opcode], client, internal_port,
+                                                            external_port, lifetime, None, False)
+            return struct.pack('!BBHIHHI', 0, 128 + opcode, result, epoch, internal_port, external_port, lifetime)
+
+        if len(data) >= 24 and data[0] == 2 and 'pcp' in self.port_control:
+            opcode = data[1] & 0x7f
+            self.calls[f'PCP {opcode}'] += 1
+            lifetime = struct.unpack('!I', data[4:8])[0]
+            header = lambda result, lifetime: struct.pack('!BBBBII12x', 2, 0x80 | opcode, 0, result, lifetime, epoch)
+            if opcode == 0:
+                return header(0, 0)
+            if opcode != 1 or len(data) < 60:
+                return header(4, 0)
+            nonce, number, internal_port, external_port = struct.unpack('!12sB3xHH', data[24:44])
+            prefer_failure = any(data[offset] == PCP_PREFER_FAILURE for offset in range(60, len(data) - 3, 4))
+            if data[8:24] != mapped_address(client):
+                result = 12
+            elif number not in PROTOCOL_NAMES:
+                result = 9
+            else:
+                result, external_port, lifetime = self.map_port(PROTOCOL_NAMES[number], client, internal_port,
+                                                                external_port, lifetime, nonce, prefer_failure)
+            body = struct.pack('!12sB3xHH16s', nonce, number, internal_port, external_port, mapped_address(self.external_ip))
+            return header(result, lifetime) + body
+
+        if len(data) >= 2 and 'natpmp' in self.port_control:
+            # What NAT-PMP gateways answer to other versions, PCP clients take it as no PCP here
+            return struct.pack('!BBHI', 0, 128 + (data[1] & 0x7f), 1, epoch)
+        return None
+
+    def map_port(self, protocol, client, internal_port, external_port, lifetime, nonce, prefer_failure):
+        # Called with the lock held, returns (result code, external port, lifetime). The result
+        # codes used here mean the same to NAT-PMP and PCP.
+        if lifetime == 0:
+            for key, mapping in list(self.table.items()):
+                if key[0] == protocol and mapping['NewInternalClient'] == client and mapping['NewInternalPort'] == internal_port:
+                    if nonce is not None and self.nonces.get(key, nonce) != nonce:
+                        return 2, external_port, 0
+                    del self.table[key]
+                    self.nonces.pop(key, None)
+                    self.entries = None
+            return 0, external_port, 0
+
+        existing = self.table.get((protocol, external_port))
+        if existing is not None and existing['NewInternalClient'] == client:
+            if nonce is not None and self.nonces.get((protocol, external_port), nonce) != nonce:
+                return 2, external_port, 0
+        elif existing is not None or external_port == 0:
+            if prefer_failure:
+                return 11, external_port, 0
+            # Hand out the next free port like a NAT-PMP gateway does
+            external_port = max(external_port, 1024)
+            while (protocol, external_port) in self.table:
+                external_port += 1
+        if self.max_lifetime is not None:
+            lifetime = min(lifetime, self.max_lifetime)
+        self.put_mapping(protocol, external_port, internal_port, client, 'PCP' if nonce is not None else 'NAT-PMP', lifetime)
+        if nonce is not None:
+            self.nonces[(protocol, external_port)] = nonce
+        return 0, external_port, lifetime
+
+    def device_description(self):
+        return (
+            '<?xml version="1.0"?>'
+            '<root xmlns="urn:schemas-upnp-org:device-1-0"><specVersion><major>1</major><minor>0</minor></specVersion>'
+            f'<device><deviceType>{device_type(self.version)}</deviceType><friendlyName>Fake IGD</friendlyName>'
+            '<deviceList><device><deviceType>urn:schemas-upnp-org:device:WANDevice:1</deviceType>'
+            '<deviceList><device><deviceType>urn:schemas-upnp-org:device:WANConnectionDevice:1</deviceType>'
+            f'<serviceList><service><serviceType>{service_type(self.version)}</serviceType>'
+            f'<serviceId>urn:upnp-org:serviceId:WANIPConn1</serviceId><controlURL>{CONTROL_PATH}</controlURL>'
+            f'<eventSubURL>{EVENT_PATH}</eventSubURL><SCPDURL>{SCPD_PATH}</SCPDURL></service></serviceList>'
+            '</device></deviceList></device></deviceList></device></root>'
+        ).encode('utf-8')
+
+    def service_description(self):
+        actions = IGD_V2_ACTIONS if self.version >= 2 else IGD_V1_ACTIONS
+        return (
+            '<?xml version="1.0"?>'
+            '<scpd xmlns="urn:schemas-upnp-org:service-1-0"><specVersion><major>1</major><minor>0</minor></specVersion>'
+            '<actionList>' + ''.join(f'<action><name>{action}</name></action>' for action in actions) + '</actionList>'
+            '</scpd>'
+        ).encode('utf-8')
+
+    def populate(self, count, internal_client='192.168.1.20', protocol='TCP', first_port=10000, lease=0, description='fake'):
+        # Mappings made by some other host, subscribers hear about them like any other change
+        with self.lock:
+            before = len(self.table)
+            for port in range(first_port, first_port + count):
+                self.put_mapping(protocol, port, port, internal_client, description, lease)
+            if len(self.table) != before:
+                self.queue_event({'PortMappingNumberOfEntries':len(self.table)})
+
+    def mappings(self):
+        with self.lock:
+            self.expire()
+            return [self.public_mapping(mapping) for mapping in self.table.values()]
+
+    def inject_fault(self, action, code, times=None, match=None):
+        # The next `times` calls of action (every call when None) for which match(arguments) is
+        # true answer with UPnP errorCode code instead of running
+        with self.lock:
+            self.faults[action] = [str(code), times, match]
+
+    def clear_faults(self):
+        with self.lock:
+            self.faults = {}
+
+    def take_fault(self, action, arguments):
+        # Called with the lock held
+        fault = self.faults.get(action)
+        if fault is None or (fault[2] is not None and not fault[2](arguments)):
+            return None
+        if fault[1] is not None:
+            fault[1] -= 1
+            if fault[1] <= 0:
+                del self.faults[action]
+        return fault[0]
+
+    def handle_soap(self, soap_action, body):
+        # Returns (HTTP status, response body) for one control request
+        namespace, _, action = soap_action.strip().strip('"').rpartition('#')
+        try:
+            arguments = decode_response(body)
+        except SOAPError as e:
+            return 500, soap_fault('402', f"Invalid Args: {e}")
+        if self.latency:
+            time.sleep(self.latency)
+
+        handler = self.action_handlers().get(action)
+        with self.lock:
+            self.calls[action] += 1
+            code = self.take_fault(action, arguments)
+            if code is not None:
+                return 500, soap_fault(code, fault_from_code(code, '').__class__.__name__)
+            if handler is None:
+                return 500, soap_fault('401', 'Invalid Action')
+            self.expire()
+            count = len(self.table)
+            try:
+                answer = 200, soap_response(namespace, action, handler(arguments))
+            except SOAPFault as fault:
+                answer = 500, soap_fault(fault.code, fault.description)
+            except (KeyError, ValueError) as e:
+                answer = 500, soap_fault('402', f"Invalid Args: {e}")
+            if len(self.table) != count:
+                self.queue_event({'PortMappingNumberOfEntries':len(self.table)})
+        return answer
+
+    def handle_subscribe(self, headers):
+        # Returns (HTTP status, response headers) for SUBSCRIBE, new or renewal
+        timeout = headers.get('TIMEOUT', 'Second-1800')
+        try:
+            seconds = int(timeout.lower().split('second-', 1)[1])
+        except (IndexError, ValueError):
+            seconds = 1800
+        sid = headers.get('SID')
+        with self.lock:
+            if sid is not None:
+                subscriber = self.subscribers.get(sid)
+                if subscriber is None or subscriber['expires'] < time.monotonic():
+                    self.subscribers.pop(sid, None)
+                    return 412, {}
+                subscriber['expires'] = time.monotonic() + seconds
+                return 200, {'SID':sid, 'TIMEOUT':f'Second-{seconds}'}
+
+            callback = headers.get('CALLBACK', '').strip()
+            if headers.get('NT') != 'upnp:event' or not callback.startswith('<'):
+                return 412, {}
+            sid = f'uuid:{uuid.uuid4()}'
+            self.subscribers[sid] = {
+                'callback':callback[1:].split('>', 1)[0],
+                'expires':time.monotonic() + seconds,
+                'sequence':0
+            }
+            # Initial event with every evented variable
+            self.queue_event({
+                'PortMappingNumberOfEntries':len(self.table),
+                'ExternalIPAddress':self.external_ip,
+                'ConnectionStatus':'Connected'
+            }, sid)
+        return 200, {'SID':sid, 'TIMEOUT':f'Second-{seconds}', 'SERVER':'FakeIGD UPnP/1.1'}
+
+    def handle_unsubscribe(self, headers):
+        with self.lock:
+            return 200 if self.subscribers.pop(headers.get('SID'), None) is not None else 412
+
+    def drop_subscribers(self):
+        # What a router reboot does to event subscriptions
+        with self.lock:
+            self.subscribers = {}
+
+    def queue_event(self, variables, sid=None):
+        # Called with the lock held, SEQ is assigned here so it matches the queue order
+        now = time.monotonic()
+        for subscriber_sid, subscriber in list(self.subscribers.items()):
+            if sid is not None and subscriber_sid != sid:
+                continue
+            if subscriber['expires'] < now:
+                del self.subscribers[subscriber_sid]
+                continue
+            self.events.put((subscriber['callback'], subscriber_sid, subscriber['sequence'], property_set(variables)))
+            subscriber['sequence'] = subscriber['sequence'] % 4294967295 + 1
+
+    def event_loop(self):
+        while True:
+            event = self.events.get()
+            if event is None:
+                break
+            callback, sid, sequence, body = event
+            parts = urlsplit(callback)
+            connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=2)
+            try:
+                connection.request('NOTIFY', parts.path or '/', body, {
+                    'Content-Type':'text/xml; charset="utf-8"',
+                    'NT':'upnp:event',
+                    'NTS':'upnp:propchange',
+                    'SID':sid,
+                    'SEQ':str(sequence)
+                })
+                connection.getresponse().read()
+            except OSError:
+                pass
+            finally:
+                connection.close()
+
+    def action_handlers(self):
+        handlers = {
+            'AddPortMapping':self.add_port_mapping,
+            'DeletePortMapping':self.delete_port_mapping,
+            'GetGenericPortMappingEntry':self.get_generic_port_mapping_entry,
+            'GetSpecificPortMappingEntry':self.get_specific_port_mapping_entry,
+            'GetExternalIPAddress':self.get_external_ip_address
+        }
+        if self.version >= 2:
+            handlers['GetListOfPortMappings'] = self.get_list_of_port_mappings
+        if self.query_state:
+            handlers[QUERY_STATE_ACTION] = self.query_state_variable
+        return handlers
+
+    # The action handlers run with the lock held, take the request arguments and return the
+    # output arguments as (name, value) pairs or raise the SOAPFault to answer with
+
+    def put_mapping(self, protocol, external_port, internal_port, internal_client, description, lease):
+        self.table[(protocol, external_port)] = {
+            'NewRemoteHost':'',
+            'NewExternalPort':external_port,
+            'NewProtocol':protocol,
+            'NewInternalPort':internal_port,
+            'NewInternalClient':internal_client,
+            'NewEnabled':1,
+            'NewPortMappingDescription':description,
+            'expires':time.monotonic() + lease if lease > 0 else None
+        }
+        if lease > 0 and (self.next_expiry is None or time.monotonic() + lease < self.next_expiry):
+            self.next_expiry = time.monotonic() + lease
+        self.entries = None
+
+    def expire(self):
+        if self.next_expiry is None or self.next_expiry > time.monotonic():
+            return
+        now = time.monotonic()
+        expired = [key for key, mapping in self.table.items() if mapping['expires'] is not None and mapping['expires'] <= now]
+        for key in expired:
+            del self.table[key]
+        leases = [mapping['expires'] for mapping in self.table.values() if mapping['expires'] is not None]
+        self.next_expiry = min(leases) if leases else None
+        self.entries = None
+
+    def public_mapping(self, mapping):
+        mapping = dict(mapping)
+        expires = mapping.pop('expires')
+        mapping['NewLeaseDuration'] = 0 if expires is None else max(1, int(expires - time.monotonic()))
+        return mapping
+
+    def mapping_key(self, arguments):
+        protocol = arguments['NewProtocol'].upper()
+        if protocol not in ('TCP', 'UDP'):
+            raise fault_from_code('402', 'Invalid Args')
+        return (protocol, int(arguments['NewExternalPort']))
+
+    def add_port_mapping(self, arguments):
+        key = self.mapping_key(arguments)
+        existing = self.table.get(key)
+        if existing is not None and existing['NewInternalClient'] != arguments['NewInternalClient']:
+            raise fault_from_code('718', 'ConflictInMappingEntry')
+        self.put_mapping(key[0], key[1], int(arguments['NewInternalPort']), arguments['NewInternalClient'],
+                         arguments.get('NewPortMappingDescription', ''), int(arguments.get('NewLeaseDuration') or 0))
+        return []
+
+    def delete_port_mapping(self, arguments):
+        key = self.mapping_key(arguments)
+        if self.table.pop(key, None) is None:
+            raise fault_from_code('714', 'NoSuchEntryInArray')
+        self.nonces.pop(key, None)
+        self.entries = None
+        return []
+
+    def get_generic_port_mapping_entry(self, arguments):
+        if self.entries is None:
+            self.entries = list(self.table.values())
+        index = int(arguments['NewPortMappingIndex'])
+        if not 0 <= index < len(self.entries):
+            raise fault_from_code('713', 'SpecifiedArrayIndexInvalid')
+        return list(self.public_mapping(self.entries[index]).items())
+
+    def get_specific_port_mapping_entry(self, arguments):
+        mapping = self.table.get(self.mapping_key(arguments))
+        if mapping is None:
+            raise fault_from_code('714', 'NoSuchEntryInArray')
+        mapping = self.public_mapping(mapping)
+        return [(name, mapping[name]) for name in ('NewInternalPort', 'NewInternalClient', 'NewEnabled',
+                                                   'NewPortMappingDescription', 'NewLeaseDuration')]
+
+    def get_external_ip_address(self, arguments):
+        return [('NewExternalIPAddress', self.external_ip)]
+
+    def query_state_variable(self, arguments):
+        if arguments.get('varName') != 'PortMappingNumberOfEntries':
+            raise fault_from_code('404', 'Invalid Var')
+        return [('return', len(self.table))]
+
+    def get_list_of_port_mappings(self, arguments):
+        protocol = arguments['NewProtocol'].upper()
+        start_port, end_port = int(arguments['NewStartPort']), int(arguments['NewEndPort'])
+        limit = int(arguments['NewNumberOfPorts']) or len(self.table)
+        ports = sorted(port for mapping_protocol, port in self.table if mapping_protocol == protocol and start_port <= port <= end_port)
+        if not ports:
+            raise fault_from_code('730', 'PortMappingNotFound')
+        entries = []
+        for port in ports[:limit]:
+            mapping = self.public_mapping(self.table[(protocol, port)])
+            mapping['NewDescription'] = mapping.pop('NewPortMappingDescription')
+            mapping['NewLeaseTime'] = mapping.pop('NewLeaseDuration')
+            fields = ''.join(f'<p:{name}>{escape(str(value))}</p:{name}>' for name, value in mapping.items())
+            entries.append(f'<p:PortMappingEntry>{fields}</p:PortMappingEntry>')
+        listing = '<p:PortMappingList xmlns:p="urn:schemas-upnp-org:gw:WANIPConnection">' + ''.join(entries) + '</p:PortMappingList>'
+        return [('NewPortListing', listing)]
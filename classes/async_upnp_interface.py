@@ -0,0 +1,484 @@
+import asyncio
+import ipaddress
+import socket
+import time
+from urllib.parse import urljoin, urlsplit
+from classes.upnp_interface import (
+    SSDP_ADDRESS, GATEWAY_SEARCH_TARGETS, build_msearch, parse_ssdp_response, is_gateway_response,
+    local_ipv4_addresses, route_source_address,
+    parse_soap_fault, parse_soap_response, parse_port_mapping_entry, parse_gateway_service,
+    parse_port_listing, parse_service_actions, QUERY_STATE_SERVICE, END_OF_TABLE_FAULT, NO_MAPPINGS_FAULT,
+    PORT_LISTING_PAGE
+)
+from xml.etree import ElementTree
+from classes.soap_codec import SOAPError, encode_request
+from classes.metrics import Metrics
+
+class SSDPProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, local_address=None):
+        self.local_address = local_address
+        self.gateways = []
+        self.seen = set()
+        self.found = asyncio.get_running_loop().create_future()
+
+    def datagram_received(self, data, addr):
+        gateway_info = parse_ssdp_response(data)
+        if gateway_info is None or not is_gateway_response(gateway_info):
+            return
+        # An IGD answers once per matching search target
+        if gateway_info['LOCATION'] in self.seen:
+            return
+        self.seen.add(gateway_info['LOCATION'])
+        gateway_info['LOCAL_ADDRESS'] = self.local_address or route_source_address(addr[0])
+        self.gateways.append(gateway_info)
+        if not self.found.done():
+            self.found.set_result(gateway_info)
+
+    def error_received(self, exc):
+        print(f"SSDP socket error: {exc}")
+
+class AsyncUPnPinterface:
+
+    def __init__(self, data):
+
+        self.ssdp_address = tuple(data.get('ssdp_address', SSDP_ADDRESS))
+        self.pinned_location = data.get('location') or None
+        self.bind_address = data.get('bind_address') or None
+
+        # Same gateway cache as UPnPinterface, guarded by an asyncio lock
+        self.cache_ttl = data.get('cache_ttl', 300)
+        self.location = None
+        self.control_url = None
+        self.control_endpoint = None
+        self.event_endpoint = None
+        self.service_type = None
+        self.actions = set()
+        self.query_state_supported = True
+        self.gateway_time = 0
+        self.gateway_lock = asyncio.Lock()
+
+        self.connect_timeout = data.get('connect_timeout', 3)
+        self.read_timeout = data.get('read_timeout', 10)
+        self.max_in_flight = data.get('pool_size', 8)
+        self.metrics = data.get('metrics') or Metrics()
+
+    async def with_deadline(self, coro, timeout, what):
+        # Per-call deadline, None waits forever. Cancellation of the caller is not caught.
+        if timeout is None:
+            return await coro
+        try:
+            return await asyncio.wait_for(coro, timeout)
+        except asyncio.TimeoutError:
+            print(f"{what} did not finish within {timeout} s.")
+            return {
+                'code':2,
+                'error':f"{what} did not finish within {timeout} s",
+                'fault_code':None,
+                'latency':timeout
+            }
+
+    async def discover_upnp_devices(self, timeout=2):
+        # Returns the headers of the first IGD that answers, or {} if none did
+        gateways = await self.ssdp_search(timeout)
+        if not gateways:
+            return {}
+        return gateways[0]
+
+    async def discover_gateways(self, collect_ms=500, timeout=2):
+        return await self.ssdp_search(timeout, collect_ms)
+
+    async def ssdp_search(self, timeout, collect_ms=None):
+        with self.metrics.timer('upnp_discovery_seconds', mode='first' if collect_ms is None else 'collect') as labels:
+            gateways = await self.ssdp_exchange(timeout, collect_ms)
+            labels['result'] = 'found' if gateways else 'none'
+        return gateways
+
+    def search_addresses(self):
+        # Same choice of local addresses as UPnPinterface.search_addresses
+        if self.bind_address:
+            return [self.bind_address]
+        if not ipaddress.ip_address(self.ssdp_address[0]).is_multicast:
+            return [None]
+        return [address for interface, address in local_ipv4_addresses()] or [None]
+
+    async def ssdp_exchange(self, timeout, collect_ms):
+        # One endpoint per local address, all searching at once
+        loop = asyncio.get_running_loop()
+        endpoints = []
+        try:
+            for address in self.search_addresses():
+                try:
+                    transport, protocol = await loop.create_datagram_endpoint(
+                        lambda: SSDPProtocol(address),
+                        family=socket.AF_INET, local_addr=(address or '0.0.0.0', 0))
+                except OSError as e:
+                    print(f"Can't search for gateways from {address}.\n {e}")
+                    continue
+                endpoints.append((transport, protocol))
+                if address is not None:
+                    transport.get_extra_info('socket').setsockopt(
+                        socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(address))
+                for search_target in GATEWAY_SEARCH_TARGETS:
+                    transport.sendto(build_msearch(search_target, address=self.ssdp_address), self.ssdp_address)
+            if not endpoints:
+                return []
+            if collect_ms is None:
+                await asyncio.wait([asyncio.shield(protocol.found) for transport, protocol in endpoints],
+                                   timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            else:
+                await asyncio.sleep(min(timeout, collect_ms / 1000))
+        finally:
+            for transport, protocol in endpoints:
+                transport.close()
+
+        gateways = []
+        seen = set()
+        for transport, protocol in endpoints:
+            for gateway_info in protocol.gateways:
+                if gateway_info['LOCATION'] not in seen:
+                    seen.add(gateway_info['LOCATION'])
+                    gateways.append(gateway_info)
+        return gateways[:1] if collect_ms is None else gateways
+
+    async def http_request(self, method, url, headers, body=b''):
+        # Minimal HTTP/1.1 client, one connection per request so calls can run concurrently
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(parts.hostname, parts.port or 80), self.connect_timeout)
+        try:
+            request = f"{method} {path} HTTP/1.1\r\nHost: {parts.netloc}\r\nConnection: close\r\n"
+            request += f"Content-Length: {len(body)}\r\n"
+            request += "".join(f"{key}: {value}\r\n" for key, value in headers.items())
+            writer.write(request.encode('latin-1') + b"\r\n" + body)
+            await writer.drain()
+            return await asyncio.wait_for(self.read_response(reader), self.read_timeout)
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    async def read_response(self, reader):
+        status_line = await reader.readline()
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            key, _, value = line.decode('latin-1').partition(':')
+            headers[key.strip().lower()] = value.strip()
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            data = b''
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    break
+                data += await reader.readexactly(size)
+                await reader.readline()
+        elif 'content-length' in headers:
+            data = await reader.readexactly(int(headers['content-length']))
+        else:
+            data = await reader.read()
+        return status, data.decode('utf-8', errors='replace')
+
+    async def get_gateway_service(self, location):
+        with self.metrics.timer('upnp_description_fetch_seconds', document='device', outcome='error') as labels:
+            status, xml_data = await self.http_request('GET', location, {"Content-Type": "application/xml"})
+            labels['outcome'] = 'ok'
+        return parse_gateway_service(xml_data)
+
+    async def get_service_actions(self, scpd_url):
+        try:
+            with self.metrics.timer('upnp_description_fetch_seconds', document='scpd', outcome='error') as labels:
+                status, xml_data = await self.http_request('GET', scpd_url, {})
+                labels['outcome'] = 'ok'
+            return parse_service_actions(xml_data)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError, ElementTree.ParseError) as e:
+            print(f"Failed to read service description.\n {e}")
+            return set()
+
+    def invalidate_gateway(self, control_endpoint=None):
+        if control_endpoint is not None and control_endpoint != self.control_endpoint:
+            return
+        self.location = None
+        self.control_url = None
+        self.control_endpoint = None
+        self.event_endpoint = None
+        self.service_type = None
+        self.actions = set()
+        self.query_state_supported = True
+        self.gateway_time = 0
+
+    def gateway_cached(self):
+        if self.control_endpoint is None:
+            return False
+        return self.cache_ttl is None or time.monotonic() - self.gateway_time < self.cache_ttl
+
+    async def resolve_gateway(self, force=False):
+        async with self.gateway_lock:
+            if not force and self.gateway_cached():
+                return None
+            self.metrics.increment('upnp_gateway_resolves_total', reason='forced' if force else 'cache_miss')
+            self.invalidate_gateway()
+            upnp_gateway = {'LOCATION':self.pinned_location} if self.pinned_location else await self.discover_upnp_devices()
+            try:
+                location = upnp_gateway['LOCATION']
+                service = await self.get_gateway_service(location)
+                if service is None:
+                    raise LookupError("no WANIPConnection or WANPPPConnection service")
+            except Exception as e:
+                print(f"Failed to find IGD device.\n {e}")
+                return {
+                    'code':1,
+                    'error':f"Failed to find IGD device: {e}"
+                }
+
+            self.location = location
+            self.control_url = service['control_url']
+            self.control_endpoint = urljoin(location, self.control_url)
+            self.event_endpoint = urljoin(location, service['event_sub_url']) if service['event_sub_url'] else None
+            self.service_type = service['service_type']
+            if service['scpd_url']:
+                self.actions = await self.get_service_actions(urljoin(location, service['scpd_url']))
+            self.gateway_time = time.monotonic()
+            return None
+
+    async def soap_request(self, action, values, namespace=None):
+        # Returns ((status, text), error), rediscovering once like UPnPinterface.soap_request
+        with self.metrics.timer('upnp_soap_request_seconds', action=action, outcome='error') as labels:
+            response, error = await self.send_soap_request(action, values, namespace)
+            if error is None:
+                labels['outcome'] = 'ok' if response[0] == 200 else 'fault'
+            elif error['error'].startswith("IGD did not answer in time"):
+                labels['outcome'] = 'timeout'
+        if error is None and response[0] != 200:
+            fault_code, fault_description = parse_soap_fault(response[1])
+            self.metrics.increment('upnp_soap_faults_total', action=action, code=fault_code or str(response[0]))
+        return response, error
+
+    async def send_soap_request(self, action, values, namespace):
+        for attempt in range(2):
+            error = await self.resolve_gateway()
+            if error is not None:
+                return None, error
+            control_endpoint, service_type = self.control_endpoint, namespace or self.service_type
+
+            soap_action, body = encode_request(service_type, action, values)
+            headers = {
+                "Content-Type": 'text/xml; charset="utf-8"',
+                "SOAPAction": soap_action
+            }
+            try:
+                status, text = await self.http_request('POST', control_endpoint, headers, body)
+            except (OSError, asyncio.IncompleteReadError, ValueError, IndexError) as e:
+                print(f"Connection to IGD failed, rediscovering.\n {e}")
+                self.metrics.increment('upnp_gateway_invalidations_total', reason='connection')
+                self.invalidate_gateway(control_endpoint)
+                error = {
+                    'code':2,
+                    'error':f"Connection to IGD failed: {e}"
+                }
+                continue
+            except asyncio.TimeoutError:
+                print("IGD did not answer in time.")
+                return None, {
+                    'code':2,
+                    'error':"IGD did not answer in time"
+                }
+            if status == 404:
+                print("IGD control URL not found, rediscovering.")
+                self.metrics.increment('upnp_gateway_invalidations_total', reason='not_found')
+                self.invalidate_gateway(control_endpoint)
+                error = {
+                    'code':2,
+                    'error':text
+                }
+                continue
+            return (status, text), None
+
+        return None, error
+
+    def soap_result(self, response, error):
+        if error is not None:
+            return dict(error, fault_code=None)
+        status, text = response
+        if status == 200:
+            return {
+                'code':0,
+                'error':text,
+                'fault_code':None
+            }
+        fault_code, fault_description = parse_soap_fault(text)
+        return {
+            'code':2,
+            'error':f"{fault_code} {fault_description}" if fault_code else text,
+            'fault_code':fault_code
+        }
+
+    async def enumerate_port_mappings(self):
+        # Same strategy as UPnPinterface.get_port_mappings
+        error = await self.resolve_gateway()
+        if error is not None:
+            return error
+        if 'GetListOfPortMappings' in self.actions:
+            mappings = await self.get_port_mapping_list()
+            if mappings is not None:
+                return mappings
+            print("GetListOfPortMappings failed, falling back to GetGenericPortMappingEntry.")
+        return await self.get_generic_port_mappings()
+
+    async def get_port_mapping_list(self):
+        async def fetch(protocol):
+            mappings = []
+            start_port = 0
+            while start_port <= 65535:
+                response, error = await self.soap_request('GetListOfPortMappings', (
+                    start_port, 65535, protocol, PORT_LISTING_PAGE
+                ))
+                if error is not None:
+                    return None
+                status, text = response
+                if status != 200:
+                    fault_code, fault_description = parse_soap_fault(text)
+                    if fault_code == NO_MAPPINGS_FAULT:
+                        break
+                    return None
+                try:
+                    page = parse_port_listing(parse_soap_response(text).get('NewPortListing'))
+                except SOAPError as e:
+                    print(f"Unreadable port listing.\n {e}")
+                    return None
+                mappings.extend(page)
+                if len(page) < PORT_LISTING_PAGE:
+                    break
+                start_port = max(int(mapping['NewExternalPort']) for mapping in page) + 1
+            return mappings
+
+        results = await asyncio.gather(fetch('TCP'), fetch('UDP'))
+        if None in results:
+            return None
+        return results[0] + results[1]
+
+    async def get_port_mapping_count(self):
+        if not self.query_state_supported:
+            return None
+        response, error = await self.soap_request('QueryStateVariable', ('PortMappingNumberOfEntries',),
+                                                  namespace=QUERY_STATE_SERVICE)
+        if error is None and response[0] == 200:
+            try:
+                return int(parse_soap_response(response[1]).get('return'))
+            except (TypeError, ValueError, SOAPError):
+                pass
+        self.query_state_supported = False
+        return None
+
+    async def request_port_mapping_entry(self, index):
+        response, error = await self.soap_request('GetGenericPortMappingEntry', (index,))
+        result = self.soap_result(response, error)
+        if result['code'] == 0:
+            try:
+                result['mapping'] = parse_port_mapping_entry(response[1])
+            except SOAPError as e:
+                result = dict(result, code=2, error=str(e))
+        return result
+
+    async def get_generic_port_mappings(self):
+        count = await self.get_port_mapping_count()
+        window = self.max_in_flight
+        if count is not None:
+            window = max(window, count + 1)
+
+        mappings = []
+        index = 0
+        while True:
+            results = await self.run_batch(self.request_port_mapping_entry, range(index, index + window))
+            fetched = 0
+            end = False
+            for offset, result in enumerate(results):
+                if result['code'] != 0 and result['fault_code'] != END_OF_TABLE_FAULT:
+                    result = await self.request_port_mapping_entry(index + offset)
+                if result['code'] == 0:
+                    mappings.append(result['mapping'])
+                    fetched += 1
+                elif result['fault_code'] == END_OF_TABLE_FAULT:
+                    end = True
+                    break
+                else:
+                    print(f"Skipping port mapping entry {index + offset}.\n {result['error']}")
+            if end or fetched == 0:
+                break
+            index += window
+            window = self.max_in_flight
+
+        return mappings
+
+    async def get_port_mappings(self, timeout=None):
+        return await self.with_deadline(self.enumerate_port_mappings(), timeout, "Port mapping enumeration")
+
+    async def request_remove_port_mapping(self, external_port, protocol):
+        started = time.perf_counter()
+        response, error = await self.soap_request('DeletePortMapping', (external_port, protocol))
+        result = self.soap_result(response, error)
+        result['latency'] = time.perf_counter() - started
+        return result
+
+    async def request_add_port_mapping(self, internal_client, external_port, internal_port, protocol, description, leaseDuration):
+        started = time.perf_counter()
+        response, error = await self.soap_request('AddPortMapping', (external_port, protocol, internal_port,
+                                                  internal_client, description, leaseDuration))
+        result = self.soap_result(response, error)
+        result['latency'] = time.perf_counter() - started
+        return result
+
+    async def remove_port_mapping(self, external_port, protocol, timeout=None):
+        return await self.with_deadline(self.request_remove_port_mapping(external_port, protocol),
+                                        timeout, "DeletePortMapping")
+
+    async def add_port_mapping(self, internal_client, external_port, internal_port, protocol, description, leaseDuration, timeout=None):
+        return await self.with_deadline(self.request_add_port_mapping(internal_client, external_port, internal_port,
+                                                                      protocol, description, leaseDuration),
+                                        timeout, "AddPortMapping")
+
+    async def run_batch(self, func, items):
+        # At most max_in_flight requests to the router at a time
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+
+        async def run(item):
+            async with semaphore:
+                return await func(item)
+
+        return await asyncio.gather(*(run(item) for item in items))
+
+    async def remove_port_mappings(self, keys, timeout=None):
+        keys = list(keys)
+        error = await self.resolve_gateway()
+        if error is not None:
+            return [dict(error, external_port=port, protocol=protocol, fault_code=None, latency=0) for port, protocol in keys]
+
+        async def remove(key):
+            result = await self.with_deadline(self.request_remove_port_mapping(*key), timeout, "DeletePortMapping")
+            result['external_port'], result['protocol'] = key
+            return result
+
+        return await self.run_batch(remove, keys)
+
+    async def add_port_mappings(self, specs, timeout=None):
+        specs = list(specs)
+        error = await self.resolve_gateway()
+        if error is not None:
+            return [dict(spec, **error, fault_code=None, latency=0) for spec in specs]
+
+        async def add(spec):
+            result = await self.with_deadline(self.request_add_port_mapping(spec['ip'], spec['external_port'], spec['internal_port'],
+                                                                            spec['protocol'], spec['description'], spec['lease']),
+                                              timeout, "AddPortMapping")
+            return dict(spec, **result)
+
+        return await self.run_batch(add, specs)
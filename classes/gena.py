@@ -0,0 +1,219 @@
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from xml.etree import ElementTree
+import requests
+
+# GENA eventing for the WANIPConnection service: SUBSCRIBE to the gateway's eventSubURL, take
+# its NOTIFY requests on a small local HTTP server and renew the subscription before it lapses.
+# Routers event PortMappingNumberOfEntries, ExternalIPAddress and ConnectionStatus, so a change
+# to the mapping count is enough to know an enumeration is worth doing.
+
+def parse_timeout(value, default):
+    # "Second-1800" -> 1800, "infinite" or anything unreadable -> default
+    try:
+        return int(value.strip().lower().split('second-', 1)[1])
+    except (AttributeError, IndexError, ValueError):
+        return default
+
+def parse_property_set(data):
+    # {state variable: value} from a NOTIFY body
+    root = ElementTree.fromstring(data)
+    variables = {}
+    for prop in root:
+        if prop.tag.rpartition('}')[2] != 'property':
+            continue
+        for variable in prop:
+            variables[variable.tag.rpartition('}')[2]] = variable.text or ''
+    return variables
+
+class NotifyRequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_NOTIFY(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('NT') != 'upnp:event' or self.headers.get('NTS') != 'upnp:propchange':
+            status = 400
+        else:
+            try:
+                sequence = int(self.headers.get('SEQ', 0))
+            except ValueError:
+                sequence = 0
+            status = self.server.event_listener.handle_notify(self.headers.get('SID'), sequence, body)
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+class NotifyServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+class EventListener:
+
+    def __init__(self, upnp, on_event, timeout=1800, host=None):
+        # on_event(variables, missed) is called from a listener thread with the state variables
+        # of each NOTIFY. missed is true when SEQ skipped, so earlier changes may have been lost.
+        self.upnp = upnp
+        self.on_event = on_event
+        # Subscription length we ask for, the router may grant a different one
+        self.timeout = timeout
+        # Address the router calls back, defaults to ours on the gateway's network
+        self.host = host
+
+        self.lock = threading.Lock()
+        self.endpoint = None
+        self.sid = None
+        self.expires = None
+        self.sequence = None
+        self.server = None
+        self.threads = []
+        self.stopping = threading.Event()
+
+    @property
+    def subscribed(self):
+        return self.sid is not None
+
+    @property
+    def callback_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self):
+        # Returns None once subscribed, or an error dict like UPnPinterface.resolve_gateway
+        error = self.upnp.resolve_gateway()
+        if error is not None:
+            return error
+        self.endpoint = self.upnp.event_endpoint
+        if not self.endpoint:
+            return {
+                'code':2,
+                'error':"Gateway does not offer eventing"
+            }
+        host = self.host or self.upnp.get_local_ip()
+        if not host:
+            return {
+                'code':4,
+                'error':"No local address for the router to call back"
+            }
+
+        self.stopping.clear()
+        self.server = NotifyServer((host, 0), NotifyRequestHandler)
+        self.server.event_listener = self
+        self.threads = [threading.Thread(target=self.server.serve_forever, name="gena-notify", daemon=True)]
+        self.threads[0].start()
+        error = self.subscribe()
+        if error is not None:
+            self.stop()
+            return error
+        self.threads.append(threading.Thread(target=self.renewal_loop, name="gena-renewal", daemon=True))
+        self.threads[1].start()
+        return None
+
+    def stop(self):
+        self.stopping.set()
+        if self.sid is not None:
+            self.unsubscribe()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        for thread in self.threads:
+            if thread is not threading.current_thread():
+                thread.join()
+        self.threads = []
+
+    def send(self, method, headers):
+        try:
+            return self.upnp.http_request(method, self.endpoint, headers=headers), None
+        except requests.exceptions.RequestException as e:
+            return None, {
+                'code':2,
+                'error':f"{method} failed: {e}"
+            }
+
+    def subscribe(self):
+        # The lock is held across the request so the initial NOTIFY, which can arrive before
+        # the response is read, waits until the SID is known
+        with self.lock:
+            response, error = self.send('SUBSCRIBE', {
+                'CALLBACK':f"<{self.callback_url}>",
+                'NT':'upnp:event',
+                'TIMEOUT':f"Second-{self.timeout}"
+            })
+            if error is None and (response.status_code != 200 or not response.headers.get('SID')):
+                error = {
+                    'code':2,
+                    'error':f"SUBSCRIBE refused: {response.status_code} {response.reason}"
+                }
+            if error is not None:
+                print(f"Failed to subscribe to gateway events.\n {error['error']}")
+                self.sid = None
+                return error
+            self.sid = response.headers['SID']
+            self.sequence = None
+            self.expires = time.monotonic() + parse_timeout(response.headers.get('TIMEOUT'), self.timeout)
+            self.upnp.metrics.increment('upnp_gena_subscriptions_total', kind='subscribe')
+        print(f"Subscribed to gateway events as {self.sid}.")
+        return None
+
+    def renew(self):
+        with self.lock:
+            sid = self.sid
+        if sid is None:
+            return self.subscribe()
+        response, error = self.send('SUBSCRIBE', {
+            'SID':sid,
+            'TIMEOUT':f"Second-{self.timeout}"
+        })
+        if error is None and response.status_code == 200:
+            with self.lock:
+                self.expires = time.monotonic() + parse_timeout(response.headers.get('TIMEOUT'), self.timeout)
+            self.upnp.metrics.increment('upnp_gena_subscriptions_total', kind='renew')
+            return None
+        # 412 means the router forgot us (it rebooted or the SID lapsed), start over
+        print("Event subscription renewal refused, subscribing again.")
+        with self.lock:
+            self.sid = None
+        error = self.subscribe()
+        if error is None:
+            # Changes made while unsubscribed were never sent
+            self.on_event({}, True)
+        return error
+
+    def unsubscribe(self):
+        with self.lock:
+            sid, self.sid = self.sid, None
+        if sid is not None:
+            self.send('UNSUBSCRIBE', {'SID':sid})
+
+    def renewal_loop(self):
+        # Renews at half of what is left, retrying every 30 s while the router is unreachable
+        while not self.stopping.is_set():
+            with self.lock:
+                delay = (self.expires - time.monotonic()) / 2 if self.sid is not None else 30
+            if self.stopping.wait(max(delay, 1)):
+                break
+            error = self.renew()
+            if error is not None:
+                print(f"Failed to renew gateway event subscription.\n {error['error']}")
+
+    def handle_notify(self, sid, sequence, body):
+        # Returns the HTTP status to answer the NOTIFY with
+        with self.lock:
+            if sid is None or sid != self.sid:
+                return 412
+            # SEQ starts at 0 with the initial event and wraps from 4294967295 to 1
+            expected = None if self.sequence is None else (1 if self.sequence == 4294967295 else self.sequence + 1)
+            missed = expected is not None and sequence != expected
+            self.sequence = sequence
+        try:
+            variables = parse_property_set(body)
+        except ElementTree.ParseError as e:
+            print(f"Unreadable gateway event.\n {e}")
+            return 400
+        self.upnp.metrics.increment('upnp_gena_events_total', missed=str(missed).lower())
+        self.on_event(variables, missed)
+        return 200
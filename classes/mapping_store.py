@@ -0,0 +1,210 @@
+import fcntl
+import json
+import os
+import threading
+import time
+
+def default_store_path():
+    data_dir = os.environ.get('XDG_DATA_HOME') or os.path.join(os.path.expanduser('~'), '.local', 'share')
+    return os.path.join(data_dir, 'simple_upnp', 'mappings.jsonl')
+
+class StoreLockedError(Exception):
+    pass
+
+class MappingStore:
+
+    # Desired mappings and their last known lease state, kept in an append-only JSON lines
+    # journal. Every line is a full record ("put") or a "delete", so loading is a single pass
+    # and a torn last line from a crash is cut off before appending resumes. The journal is rewritten through a
+    # temporary file and os.replace() once it holds too many superseded lines.
+    # Only one process may have a journal open at a time, a second MappingStore on the same path
+    # raises StoreLockedError.
+
+    def __init__(self, path=None, compact_ratio=2, compact_minimum=100):
+        self.path = path or default_store_path()
+        self.compact_ratio = compact_ratio
+        self.compact_minimum = compact_minimum
+        self.lock = threading.Lock()
+        # (protocol, external port) -> {'lease':{...}, 'renewed_at':..., 'expires_at':...}
+        self.records = {}
+        self.lines = 0
+        self.journal = None
+        self.lock_file = None
+        self.acquire()
+        self.load()
+
+    def key(self, lease):
+        return (str(lease['protocol']).upper(), int(lease['external_port']))
+
+    def __contains__(self, key):
+        return key in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    def acquire(self):
+        # Compaction replaces the journal, a second writer would go on appending to the unlinked
+        # old file and both would renew the same leases. The lock is on a file next to the
+        # journal since the journal itself changes inode.
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.lock_file = open(self.path + '.lock', 'a')
+        try:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.lock_file.close()
+            self.lock_file = None
+            raise StoreLockedError(f"{self.path} is in use by another process")
+
+    def load(self):
+        with self.lock:
+            self.records = {}
+            self.lines = 0
+            if os.path.exists(self.path):
+                with open(self.path, 'r', encoding='utf-8') as journal:
+                    for line in journal:
+                        # Only the last line can lack its newline, and it is cut off below even when
+                        # it parses, so it must not count either
+                        if not line.endswith("\n"):
+                            break
+                        self.lines += 1
+                        try:
+                            entry = json.loads(line)
+                            key = (str(entry['key'][0]), int(entry['key'][1]))
+                            record = None if entry.get('op') == 'delete' else entry['record']
+                        except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+                            print(f"Skipping damaged line {self.lines} of {self.path}")
+                            continue
+                        if record is None:
+                            self.records.pop(key, None)
+                        else:
+                            self.records[key] = record
+                self.truncate_torn_line()
+            self.journal = open(self.path, 'a', encoding='utf-8')
+            self.compact_if_needed()
+
+    def truncate_torn_line(self):
+        # Called with the lock held. A write cut short by a crash leaves no newline at the end,
+        # the next append would land on that line and be lost with it on the next load.
+        with open(self.path, 'rb+') as journal:
+            size = journal.seek(0, os.SEEK_END)
+            if size == 0:
+                return
+            journal.seek(size - 1)
+            if journal.read(1) == b"\n":
+                return
+            # Only the last line can be torn, read back just far enough to find its start
+            end = size
+            while end > 0:
+                start = max(0, end - 4096)
+                journal.seek(start)
+                newline = journal.read(end - start).rfind(b"\n")
+                if newline >= 0:
+                    end = start + newline + 1
+                    break
+                end = start
+            journal.truncate(end)
+            journal.flush()
+            os.fsync(journal.fileno())
+        print(f"Cut a torn last line off {self.path}")
+
+    def leases(self):
+        with self.lock:
+            return [dict(record['lease']) for record in self.records.values()]
+
+    def items(self):
+        with self.lock:
+            return [(key, dict(record)) for key, record in self.records.items()]
+
+    def append(self, entries, sync):
+        # Called with the lock held
+        self.journal.write("".join(json.dumps(entry, separators=(',', ':')) + "\n" for entry in entries))
+        self.journal.flush()
+        if sync:
+            os.fsync(self.journal.fileno())
+        self.lines += len(entries)
+        self.compact_if_needed()
+
+    def put(self, lease):
+        # Adds or replaces a desired mapping, durable once this returns
+        self.put_many([lease])
+
+    def put_many(self, leases):
+        with self.lock:
+            entries = []
+            for lease in leases:
+                key = self.key(lease)
+                record = {
+                    'lease':dict(lease),
+                    'renewed_at':None,
+                    'expires_at':None
+                }
+                self.records[key] = record
+                entries.append({'op':'put', 'key':list(key), 'record':record})
+            self.append(entries, sync=True)
+
+    def delete(self, key):
+        with self.lock:
+            if self.records.pop(key, None) is None:
+                return False
+            self.append([{'op':'delete', 'key':list(key)}], sync=True)
+            return True
+
+    def record_renewal(self, key, renewed_at=None):
+        # Lease state is only a hint for restoring the schedule, losing the last few after a crash
+        # just means an early renewal, so these writes skip the fsync
+        with self.lock:
+            record = self.records.get(key)
+            if record is None:
+                return
+            renewed_at = renewed_at or time.time()
+            record['renewed_at'] = renewed_at
+            record['expires_at'] = renewed_at + int(record['lease']['lease'])
+            self.append([{'op':'put', 'key':list(key), 'record':record}], sync=False)
+
+    def renewal_delay(self, key, now=None):
+        # Seconds until a restored lease should be renewed: half of what is left of the last known
+        # lease, capped at half the lease, or right away when nothing is known or it has expired
+        with self.lock:
+            record = self.records.get(key)
+            if record is None or record['expires_at'] is None:
+                return 0
+            now = now or time.time()
+            remaining = record['expires_at'] - now
+            return max(0, min(remaining / 2, int(record['lease']['lease']) / 2))
+
+    def compact_if_needed(self):
+        # Called with the lock held
+        if self.lines <= max(self.compact_minimum, self.compact_ratio * len(self.records)):
+            return
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w', encoding='utf-8') as journal:
+            for key, record in self.records.items():
+                journal.write(json.dumps({'op':'put', 'key':list(key), 'record':record}, separators=(',', ':')) + "\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+        if self.journal is not None:
+            self.journal.close()
+        os.replace(temporary, self.path)
+        directory = os.path.dirname(self.path) or '.'
+        try:
+            descriptor = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(descriptor)
+            finally:
+                os.close(descriptor)
+        except OSError:
+            pass
+        self.journal = open(self.path, 'a', encoding='utf-8')
+        self.lines = len(self.records)
+
+    def close(self):
+        with self.lock:
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+            if self.lock_file is not None:
+                # Closing drops the flock
+                self.lock_file.close()
+                self.lock_file = None
@@ -0,0 +1,158 @@
+import bisect
+import contextlib
+import json
+import threading
+import time
+import traceback
+
+# Counters and latency histograms recorded by UPnPinterface, RenewalScheduler and TaskRunner.
+# Every sample is also passed to the listeners added with subscribe(), and the totals can be
+# dumped as JSON or in the Prometheus text exposition format.
+
+# Upper bounds in seconds, the implicit last bucket is +Inf
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Histogram:
+
+    __slots__ = ('buckets', 'counts', 'count', 'sum', 'max')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # Not cumulative, counts[i] is the samples in (buckets[i-1], buckets[i]]
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def cumulative(self):
+        # [(upper bound, samples at or below it)] ending with +Inf
+        total = 0
+        bounds = []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            bounds.append((bound, total))
+        return bounds
+
+def format_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(float(bound))
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for name, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+class Metrics:
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # (name, sorted label pairs) -> number or Histogram
+        self.counters = {}
+        self.histograms = {}
+        self.listeners = []
+        self.started = time.time()
+
+    def subscribe(self, callback):
+        # callback(kind, name, labels, value) for every sample, kind is 'counter' or 'histogram'.
+        # Runs on the thread that recorded the sample, so it should be quick.
+        with self.lock:
+            self.listeners = self.listeners + [callback]
+
+    def unsubscribe(self, callback):
+        with self.lock:
+            self.listeners = [listener for listener in self.listeners if listener != callback]
+
+    def notify(self, kind, name, labels, value):
+        for listener in self.listeners:
+            try:
+                listener(kind, name, labels, value)
+            except Exception:
+                traceback.print_exc()
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+        self.notify('counter', name, labels, amount)
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+        self.notify('histogram', name, labels, value)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        # Observes the duration of the block, which can add or change labels through the
+        # yielded dict, e.g. labels['outcome'] = 'fault'
+        started = time.perf_counter()
+        try:
+            yield labels
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def counter_value(self, name, **labels):
+        with self.lock:
+            return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def snapshot(self):
+        with self.lock:
+            counters = [{
+                'name':name,
+                'labels':dict(labels),
+                'value':value
+            } for (name, labels), value in sorted(self.counters.items())]
+            histograms = [{
+                'name':name,
+                'labels':dict(labels),
+                'count':histogram.count,
+                'sum':histogram.sum,
+                'max':histogram.max,
+                'mean':histogram.sum / histogram.count if histogram.count else 0,
+                'buckets':{format_bound(bound):count for bound, count in histogram.cumulative()}
+            } for (name, labels), histogram in sorted(self.histograms.items())]
+        return {
+            'started':self.started,
+            'counters':counters,
+            'histograms':histograms
+        }
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self):
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, histogram.cumulative(), histogram.sum, histogram.count)
+                                for key, histogram in self.histograms.items())
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name}{format_labels(labels)} {value}')
+        for (name, labels), bounds, total, count in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} histogram')
+            for bound, cumulative in bounds:
+                lines.append(f'{name}_bucket{format_labels(labels + (("le", format_bound(bound)),))} {cumulative}')
+            lines.append(f'{name}_sum{format_labels(labels)} {total}')
+            lines.append(f'{name}_count{format_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path, format='json'):
+        with open(path, 'w', encoding='utf-8') as dump:
+            dump.write(self.to_prometheus() if format == 'prometheus' else self.to_json() + '\n')
@@ -0,0 +1,140 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+from classes.upnp_interface import UPnPinterface
+from classes.metrics import Metrics
+
+class MultiGatewayInterface:
+
+    # One UPnPinterface pinned to each gateway, found by searching every local IPv4 interface or
+    # given as description URLs. Operations run on all gateways at once, so they take as long as
+    # the slowest gateway, and every mapping and result carries the 'gateway' it belongs to.
+
+    def __init__(self, data, locations=None):
+        self.data = dict(data)
+        self.data.setdefault('metrics', Metrics())
+        self.metrics = self.data['metrics']
+        self.discovery = UPnPinterface(self.data)
+        # description URL -> pinned UPnPinterface
+        self.gateways = {}
+        self.lock = threading.Lock()
+        for location in locations or ():
+            self.add_gateway(location)
+
+    def add_gateway(self, location, local_address=None):
+        with self.lock:
+            upnp = self.gateways.get(location)
+            if upnp is None:
+                upnp = self.gateways[location] = UPnPinterface(dict(self.data, location=location, bind_address=local_address))
+            return upnp
+
+    def discover(self, collect_ms=500, timeout=2):
+        # Adds every gateway that answers on any interface, returns their SSDP headers
+        found = self.discovery.discover_gateways(collect_ms, timeout)
+        for gateway_info in found:
+            self.add_gateway(gateway_info['LOCATION'], gateway_info.get('LOCAL_ADDRESS'))
+        print(f"Found {len(found)} gateway(s).")
+        return found
+
+    def ensure_gateways(self):
+        if not self.gateways:
+            self.discover()
+        with self.lock:
+            return dict(self.gateways)
+
+    def close(self):
+        self.discovery.close()
+        for upnp in self.gateways.values():
+            upnp.close()
+
+    def run_on_gateways(self, func, gateways):
+        # {location: func(location, upnp)}, one thread per gateway
+        if not gateways:
+            return {}
+        with ThreadPoolExecutor(max_workers=len(gateways)) as executor:
+            futures = {location: executor.submit(func, location, upnp) for location, upnp in gateways.items()}
+            return {location: future.result() for location, future in futures.items()}
+
+    def get_local_ip(self, gateway=None):
+        gateways = self.ensure_gateways()
+        if gateway is not None:
+            return gateways[gateway].get_local_ip() if gateway in gateways else None
+        return self.discovery.get_local_ip()
+
+    def get_port_mappings(self):
+        # Every gateway's table in one list, each mapping tagged with its 'gateway'. Gateways that
+        # fail are reported and left out, the error dict only comes back when all of them failed.
+        gateways = self.ensure_gateways()
+        if not gateways:
+            return {
+                'code':1,
+                'error':"Failed to find IGD device: no gateway answered on any interface"
+            }
+
+        def enumerate_gateway(location, upnp):
+            mappings = upnp.get_port_mappings()
+            if type(mappings) == dict:
+                return mappings
+            return [dict(mapping, gateway=location) for mapping in mappings]
+
+        results = self.run_on_gateways(enumerate_gateway, gateways)
+        mappings = []
+        errors = []
+        for location, result in results.items():
+            if type(result) == dict:
+                print(f"Failed to read the port mappings of {location}.\n {result['error']}")
+                errors.append(result)
+            else:
+                mappings.extend(result)
+        if errors and len(errors) == len(results):
+            return errors[0]
+        return mappings
+
+    def add_port_mappings(self, specs, max_workers=4):
+        # specs as for UPnPinterface.add_port_mappings plus an optional 'gateway', a spec without
+        # one is added on every gateway. A missing ip is this host's address on that gateway's network.
+        specs = list(specs)
+        gateways = self.ensure_gateways()
+        batches = {location: [] for location in gateways}
+        results = []
+        for spec in specs:
+            location = spec.get('gateway')
+            if location is None:
+                for batch in batches.values():
+                    batch.append(spec)
+            elif location in batches:
+                batches[location].append(spec)
+            else:
+                results.append(dict(spec, code=1, error=f"Unknown gateway {location}", fault_code=None, latency=0))
+
+        def add(location, upnp):
+            batch = [dict(spec, gateway=location, ip=spec.get('ip') or upnp.get_local_ip()) for spec in batches[location]]
+            return upnp.add_port_mappings(batch, max_workers) if batch else []
+
+        for location, batch_results in self.run_on_gateways(add, gateways).items():
+            results.extend(batch_results)
+        return results
+
+    def remove_port_mappings(self, keys, max_workers=4):
+        # keys are (external_port, protocol) for every gateway or (external_port, protocol, gateway)
+        gateways = self.ensure_gateways()
+        batches = {location: [] for location in gateways}
+        results = []
+        for key in keys:
+            if len(key) > 2:
+                if key[2] in batches:
+                    batches[key[2]].append(key[:2])
+                else:
+                    results.append({'external_port':key[0], 'protocol':key[1], 'gateway':key[2], 'code':1,
+                                    'error':f"Unknown gateway {key[2]}", 'fault_code':None, 'latency':0})
+            else:
+                for batch in batches.values():
+                    batch.append(tuple(key))
+
+        def remove(location, upnp):
+            if not batches[location]:
+                return []
+            return [dict(result, gateway=location) for result in upnp.remove_port_mappings(batches[location], max_workers)]
+
+        for location, batch_results in self.run_on_gateways(remove, gateways).items():
+            results.extend(batch_results)
+        return results
@@ -0,0 +1,294 @@
+import json
+import os
+import socket
+import struct
+import threading
+import time
+
+# NAT-PMP (RFC 6886) and PCP (RFC 6887) clients, the UDP alternative to UPnP SOAP that many
+# routers also run on the default gateway. A mapping is one datagram to port 5351 and one
+# answer, with no SSDP, HTTP or XML. Both protocols only map ports to the host that asks, so
+# UPnPinterface uses them for its own address and keeps SOAP for everything else.
+
+PORT_CONTROL_PORT = 5351
+
+# Seconds to wait for each try, doubling from 250 ms as both RFCs do but giving up far
+# sooner, SOAP is always there to fall back to
+REQUEST_TIMEOUTS = (0.25, 0.5, 1)
+PROBE_TIMEOUTS = (0.25, 0.5)
+
+PROTOCOL_NUMBERS = {'TCP':6, 'UDP':17}
+NATPMP_OPCODES = {'UDP':1, 'TCP':2}
+
+NATPMP_RESULTS = {1:'UNSUPP_VERSION', 2:'NOT_AUTHORIZED', 3:'NETWORK_FAILURE', 4:'NO_RESOURCES', 5:'UNSUPP_OPCODE'}
+PCP_RESULTS = {1:'UNSUPP_VERSION', 2:'NOT_AUTHORIZED', 3:'MALFORMED_REQUEST', 4:'UNSUPP_OPCODE', 5:'UNSUPP_OPTION',
+               6:'MALFORMED_OPTION', 7:'NETWORK_FAILURE', 8:'NO_RESOURCES', 9:'UNSUPP_PROTOCOL', 10:'USER_EX_QUOTA',
+               11:'CANNOT_PROVIDE_EXTERNAL', 12:'ADDRESS_MISMATCH', 13:'EXCESSIVE_REMOTE_PEERS'}
+
+PCP_CANNOT_PROVIDE_EXTERNAL = 11
+PCP_PREFER_FAILURE = 2
+
+# What AddPortMapping faults with when the port is taken, so callers like PortAllocator treat
+# a refused port the same on both paths
+CONFLICT_FAULT = '718'
+
+def default_gateway():
+    try:
+        import netifaces
+        return netifaces.gateways()['default'][netifaces.AF_INET][0]
+    except (ImportError, KeyError, IndexError):
+        return None
+
+def default_probe_cache_path():
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_dir, 'simple_upnp', 'port_control.json')
+
+def probe_cache_key(gateway, port, local_address):
+    return f"{gateway}:{port} {local_address}"
+
+def read_probe_cache(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as cache:
+            entries = json.load(cache)
+    except (OSError, ValueError):
+        return {}
+    return entries if type(entries) == dict else {}
+
+def load_probe(path, gateway, port, local_address, protocols, ttl):
+    # (protocol name or None, seconds since the probe) when a probe of the same gateway from
+    # the same address within ttl answers for protocols, else None
+    entry = read_probe_cache(path).get(probe_cache_key(gateway, port, local_address))
+    try:
+        protocol, tried, age = entry['protocol'], entry['tried'], time.time() - entry['checked_at']
+    except (KeyError, TypeError):
+        return None
+    if not 0 <= age < ttl:
+        return None
+    if protocol in protocols or (protocol is None and set(protocols) <= set(tried)):
+        return protocol, age
+    return None
+
+def save_probe(path, gateway, port, local_address, protocols, protocol, ttl):
+    # Written through a temporary file, processes probing at the same time just race to the
+    # last answer. Entries past ttl are dropped on the way.
+    now = time.time()
+    entries = {}
+    for key, entry in read_probe_cache(path).items():
+        try:
+            if now - entry['checked_at'] < ttl:
+                entries[key] = entry
+        except (KeyError, TypeError):
+            continue
+    entries[probe_cache_key(gateway, port, local_address)] = {'protocol':protocol, 'tried':list(protocols), 'checked_at':now}
+    temporary = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(temporary, 'w', encoding='utf-8') as cache:
+            json.dump(entries, cache)
+        os.replace(temporary, path)
+    except OSError as e:
+        print(f"Couldn't save the port control probe to {path}.\n {e}")
+
+def mapped_address(address):
+    # PCP carries IPv4 addresses as IPv4-mapped IPv6 ones
+    return b'\0' * 10 + b'\xff\xff' + socket.inet_aton(address or '0.0.0.0')
+
+class PortControlClient:
+
+    # Shared by the NAT-PMP and PCP clients: add() and remove() return the same result dicts as
+    # UPnPinterface's SOAP requests, or None when the gateway didn't answer at all
+
+    name = None
+    # The --port-control value that picks this client
+    mode = None
+
+    def __init__(self, gateway, local_address, port=PORT_CONTROL_PORT):
+        self.gateway = gateway
+        self.local_address = local_address
+        self.port = port
+        self.lock = threading.Lock()
+        # (protocol, external port) -> internal port of the mappings made through this client,
+        # the only ones it is able to delete
+        self.mappings = {}
+
+    def exchange(self, request, accept, timeouts=REQUEST_TIMEOUTS):
+        # Sends request until accept(response) returns something other than None and returns
+        # that, or None once every try timed out. A new socket per call keeps the answers of
+        # parallel requests apart.
+        SOC = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            SOC.bind((self.local_address or '', 0))
+            SOC.connect((self.gateway, self.port))
+            for timeout in timeouts:
+                SOC.send(request)
+                deadline = time.monotonic() + timeout
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    SOC.settimeout(remaining)
+                    try:
+                        reply = accept(SOC.recv(1100))
+                    except socket.timeout:
+                        break
+                    if reply is not None:
+                        return reply
+        except OSError:
+            # Port unreachable, nothing listens on the gateway
+            return None
+        finally:
+            SOC.close()
+        return None
+
+    def failure(self, result, names, fault_code=None):
+        return {
+            'code':2,
+            'error':f"{self.name} {names.get(result, result)}",
+            'fault_code':fault_code
+        }
+
+    def mapped(self, protocol, external_port, internal_port, assigned_port, granted):
+        # Result of an add once the gateway answered with success
+        if assigned_port != external_port:
+            # Both protocols may hand out another port than the one asked for, UPnP callers
+            # expect exactly theirs
+            self.delete(protocol, internal_port, assigned_port)
+            return {
+                'code':2,
+                'error':f"{self.name} assigned port {assigned_port} instead of {external_port}",
+                'fault_code':CONFLICT_FAULT
+            }
+        with self.lock:
+            self.mappings[(protocol, external_port)] = internal_port
+        return {
+            'code':0,
+            'error':'',
+            'fault_code':None,
+            'granted_lease':granted
+        }
+
+    def owns(self, protocol, external_port):
+        with self.lock:
+            return (protocol, int(external_port)) in self.mappings
+
+    def remove(self, external_port, protocol):
+        with self.lock:
+            internal_port = self.mappings.get((protocol, int(external_port)))
+        if internal_port is None:
+            return None
+        result = self.delete(protocol, internal_port, int(external_port))
+        if result is not None and result['code'] == 0:
+            with self.lock:
+                self.mappings.pop((protocol, int(external_port)), None)
+        return result
+
+class NATPMPClient(PortControlClient):
+
+    name = 'NAT-PMP'
+    mode = 'natpmp'
+
+    def probe(self):
+        # External address request, any answer means the gateway speaks NAT-PMP
+        def accept(data):
+            if len(data) >= 12 and data[0] == 0 and data[1] == 128:
+                return struct.unpack('!H', data[2:4])[0]
+            return None
+        return self.exchange(b'\0\0', accept, PROBE_TIMEOUTS) == 0
+
+    def request(self, protocol, internal_port, external_port, lifetime):
+        opcode = NATPMP_OPCODES[protocol]
+        def accept(data):
+            if len(data) >= 16 and data[0] == 0 and data[1] == 128 + opcode:
+                result, epoch, internal, external, granted = struct.unpack('!HIHHI', data[2:16])
+                if internal == internal_port:
+                    return result, external, granted
+            return None
+        return self.exchange(struct.pack('!BBHHHI', 0, opcode, 0, internal_port, external_port, lifetime), accept)
+
+    def add(self, external_port, internal_port, protocol, lifetime):
+        reply = self.request(protocol, internal_port, external_port, lifetime)
+        if reply is None:
+            return None
+        result, assigned_port, granted = reply
+        if result != 0:
+            return self.failure(result, NATPMP_RESULTS)
+        return self.mapped(protocol, external_port, internal_port, assigned_port, granted)
+
+    def delete(self, protocol, internal_port, external_port):
+        # Lifetime 0 deletes, the external port must be 0 as well
+        reply = self.request(protocol, internal_port, 0, 0)
+        if reply is None:
+            return None
+        if reply[0] != 0:
+            return self.failure(reply[0], NATPMP_RESULTS)
+        return {'code':0, 'error':'', 'fault_code':None}
+
+class PCPClient(PortControlClient):
+
+    name = 'PCP'
+    mode = 'pcp'
+
+    def __init__(self, gateway, local_address, port=PORT_CONTROL_PORT):
+        super().__init__(gateway, local_address, port)
+        # The server ties every mapping to the nonce that made it, renewals and deletes must
+        # repeat it
+        self.nonce = os.urandom(12)
+
+    def header(self, opcode, lifetime):
+        return struct.pack('!BBHI16s', 2, opcode, 0, lifetime, mapped_address(self.local_address))
+
+    def probe(self):
+        # ANNOUNCE, which every PCP server must answer with success
+        def accept(data):
+            if len(data) >= 24 and data[0] == 2 and data[1] == 0x80:
+                return data[3]
+            # A NAT-PMP only gateway answers version 0 with UNSUPP_VERSION
+            if len(data) >= 4 and data[0] == 0:
+                return -1
+            return None
+        return self.exchange(self.header(0, 0), accept, PROBE_TIMEOUTS) == 0
+
+    def request(self, protocol, internal_port, external_port, lifetime):
+        # MAP with PREFER_FAILURE, so a taken port is refused rather than swapped for another
+        body = struct.pack('!12sB3xHH16s', self.nonce, PROTOCOL_NUMBERS[protocol], internal_port, external_port,
+                           mapped_address(None))
+        option = struct.pack('!BBH', PCP_PREFER_FAILURE, 0, 0) if lifetime else b''
+        def accept(data):
+            if len(data) >= 60 and data[0] == 2 and data[1] == 0x81 and data[24:36] == self.nonce:
+                result = data[3]
+                granted = struct.unpack('!I', data[4:8])[0]
+                internal, external = struct.unpack('!HH', data[40:44])
+                if internal == internal_port:
+                    return result, external, granted
+            return None
+        return self.exchange(self.header(1, lifetime) + body + option, accept)
+
+    def add(self, external_port, internal_port, protocol, lifetime):
+        reply = self.request(protocol, internal_port, external_port, lifetime)
+        if reply is None:
+            return None
+        result, assigned_port, granted = reply
+        if result == PCP_CANNOT_PROVIDE_EXTERNAL:
+            return self.failure(result, PCP_RESULTS, CONFLICT_FAULT)
+        if result != 0:
+            return self.failure(result, PCP_RESULTS)
+        return self.mapped(protocol, external_port, internal_port, assigned_port, granted)
+
+    def delete(self, protocol, internal_port, external_port):
+        reply = self.request(protocol, internal_port, external_port, 0)
+        if reply is None:
+            return None
+        if reply[0] != 0:
+            return self.failure(reply[0], PCP_RESULTS)
+        return {'code':0, 'error':'', 'fault_code':None}
+
+# Tried in this order, PCP first as it can refuse a taken port instead of picking another
+PORT_CONTROL_CLIENTS = {'pcp':PCPClient, 'natpmp':NATPMPClient}
+
+def probe_port_control(gateway, local_address, protocols=('pcp', 'natpmp'), port=PORT_CONTROL_PORT):
+    # A client for the first protocol the gateway answers, or None
+    for protocol in protocols:
+        client = PORT_CONTROL_CLIENTS[protocol](gateway, local_address, port)
+        if client.probe():
+            return client
+    return None
@@ -0,0 +1,201 @@
+import threading
+import time
+from classes.port_mapping import PortMapping
+
+PROTOCOLS = ('TCP', 'UDP')
+
+# States of a port in PortIndex.ports
+FREE = 0
+MAPPED = 1
+RESERVED = 2
+
+def index_key(protocol, external_port):
+    return (str(protocol).upper(), int(external_port))
+
+class PortIndex:
+
+    # The router's mapping table as PortMapping records keyed by (protocol, external port), filled from enumeration
+    # and kept current by UPnPinterface's own add and remove calls. Next to the dict every
+    # protocol has one byte per port, so a conflict check is a dict lookup and the first run of
+    # N free ports is a single bytes.find over the requested span.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.mappings = {}
+        self.ports = {protocol: bytearray(65536) for protocol in PROTOCOLS}
+        # Ranges handed out by claim_free_range() and not yet added or released
+        self.reserved = set()
+        self.loaded_at = None
+
+    def __len__(self):
+        return len(self.mappings)
+
+    def __contains__(self, key):
+        return index_key(*key) in self.mappings
+
+    def is_stale(self, max_age):
+        return self.loaded_at is None or (max_age is not None and time.monotonic() - self.loaded_at > max_age)
+
+    def load(self, mappings):
+        # Replaces the index with a full enumeration result
+        with self.lock:
+            self.mappings = {}
+            self.ports = {protocol: bytearray(65536) for protocol in PROTOCOLS}
+            for key in self.reserved:
+                self.ports[key[0]][key[1]] = RESERVED
+            for mapping in mappings:
+                self.store(mapping)
+            self.loaded_at = time.monotonic()
+
+    def store(self, mapping):
+        # Called with the lock held
+        key = mapping.key
+        if key[0] not in self.ports:
+            return
+        self.mappings[key] = mapping
+        self.ports[key[0]][key[1]] = MAPPED
+
+    def put(self, mapping):
+        with self.lock:
+            self.store(mapping)
+
+    def mark_taken(self, protocol, external_port):
+        # A port the router refused without telling us who holds it
+        self.put(PortMapping(str(protocol).upper(), int(external_port), '', 0, True, '', 0))
+
+    def remove(self, protocol, external_port):
+        key = index_key(protocol, external_port)
+        with self.lock:
+            if self.mappings.pop(key, None) is not None:
+                self.ports[key[0]][key[1]] = RESERVED if key in self.reserved else FREE
+
+    def get(self, protocol, external_port):
+        with self.lock:
+            return self.mappings.get(index_key(protocol, external_port))
+
+    def conflict(self, protocol, external_port, internal_client):
+        # The mapping that keeps internal_client from taking the port, None when it is free
+        # or already points there (re-adding your own mapping just renews it)
+        mapping = self.get(protocol, external_port)
+        if mapping is None or mapping.internal_client == internal_client:
+            return None
+        return mapping
+
+    def find_free_range(self, protocol, count, first=1, last=65535):
+        # First port of the lowest run of count free ports within first..last, or None
+        with self.lock:
+            return self.find(str(protocol).upper(), count, first, last)
+
+    def find(self, protocol, count, first, last):
+        # Called with the lock held
+        if count < 1 or first < 1 or last > 65535:
+            raise ValueError(f"Bad port range {first}-{last} for {count} port(s)")
+        start = self.ports[protocol].find(bytes(count), first, last + 1)
+        return None if start < 0 else start
+
+    def claim_free_range(self, protocol, count, first=1, last=65535):
+        # find_free_range() that also reserves the run, so concurrent allocations can't pick it
+        protocol = str(protocol).upper()
+        with self.lock:
+            start = self.find(protocol, count, first, last)
+            if start is None:
+                return None
+            for port in range(start, start + count):
+                self.reserved.add((protocol, port))
+                self.ports[protocol][port] = RESERVED
+            return start
+
+    def release(self, protocol, first, count):
+        protocol = str(protocol).upper()
+        with self.lock:
+            for port in range(first, first + count):
+                self.reserved.discard((protocol, port))
+                if self.ports[protocol][port] == RESERVED:
+                    self.ports[protocol][port] = FREE
+
+class PortAllocator:
+
+    # Picks contiguous free external ports from the index and claims them with one batch of
+    # AddPortMapping calls, so a block costs one enumeration (skipped while the index is
+    # fresh) plus the adds.
+
+    def __init__(self, upnp, max_age=60):
+        self.upnp = upnp
+        self.index = upnp.port_index
+        # Seconds an enumeration stays good enough to pick ranges from
+        self.max_age = max_age
+
+    def refresh(self):
+        mappings = self.upnp.get_port_mappings()
+        if type(mappings) == dict:
+            return mappings
+        return None
+
+    def allocate(self, count, protocol='UDP', first=1024, last=65535, ip=None, description='simple_upnp',
+                 lease=0, internal_first=None, attempts=3):
+        # Maps count contiguous external ports within first..last to ip. Internal ports keep the
+        # same offsets from internal_first, or equal the external ports when it is None.
+        protocol = str(protocol).upper()
+        if self.index.is_stale(self.max_age):
+            error = self.refresh()
+            if error is not None:
+                return error
+        ip = ip or self.upnp.get_local_ip()
+        if not ip:
+            return {
+                'code':4,
+                'error':"No local address found, pass ip"
+            }
+
+        results = []
+        for attempt in range(attempts):
+            start = self.index.claim_free_range(protocol, count, first, last)
+            if start is None:
+                return {
+                    'code':2,
+                    'error':f"No {count} contiguous free {protocol} ports in {first}-{last}",
+                    'results':results
+                }
+            offset = start if internal_first is None else internal_first
+            specs = [{
+                'ip':ip,
+                'external_port':port,
+                'internal_port':port - start + offset,
+                'protocol':protocol,
+                'description':description,
+                'lease':lease
+            } for port in range(start, start + count)]
+            try:
+                results = self.upnp.add_port_mappings(specs)
+            finally:
+                self.index.release(protocol, start, count)
+
+            failed = [result for result in results if result['code'] != 0]
+            if not failed:
+                print(f"Allocated {protocol} {start}-{start + count - 1}.")
+                return {
+                    'code':0,
+                    'error':'',
+                    'protocol':protocol,
+                    'first_port':start,
+                    'last_port':start + count - 1,
+                    'results':results
+                }
+
+            # Give back the part of the block we did get, a block with holes is no use
+            added = [(result['external_port'], protocol) for result in results if result['code'] == 0]
+            if added:
+                self.upnp.remove_port_mappings(added)
+            conflicts = [result for result in failed if result['fault_code'] == '718']
+            if len(conflicts) < len(failed):
+                break
+            # Another host took ports since the enumeration, skip them and try the next run
+            for result in conflicts:
+                self.index.mark_taken(protocol, result['external_port'])
+            print(f"{len(conflicts)} port(s) of {protocol} {start}-{start + count - 1} were taken, trying another range.")
+
+        return {
+            'code':2,
+            'error':f"Failed to allocate {count} {protocol} port(s): {failed[0]['error']}",
+            'results':results
+        }
@@ -0,0 +1,54 @@
+import collections
+import sys
+
+# Typed, immutable port mapping records. A namedtuple with empty __slots__ is a fraction of
+# the size of the string dict a SOAP response decodes to, and the strings that repeat across a
+# table (protocol, internal client, description) are shared through sys.intern.
+
+PROTOCOL_NAMES = {'TCP':'TCP', 'UDP':'UDP'}
+
+def parse_flag(value):
+    return str(value).strip().lower() in ('1', 'true', 'yes')
+
+class PortMapping(collections.namedtuple('PortMapping', (
+        'protocol', 'external_port', 'internal_client', 'internal_port', 'enabled', 'description', 'lease',
+        'remote_host', 'gateway'), defaults=('', None))):
+
+    __slots__ = ()
+
+    @classmethod
+    def from_entry(cls, entry, gateway=None):
+        # From a GetGenericPortMappingEntry style dict of strings, raises ValueError or KeyError
+        # for entries that can't be read
+        protocol = str(entry['NewProtocol']).upper()
+        return cls(
+            PROTOCOL_NAMES.get(protocol) or sys.intern(protocol),
+            int(entry['NewExternalPort']),
+            sys.intern(entry['NewInternalClient'] or ''),
+            int(entry['NewInternalPort']),
+            parse_flag(entry.get('NewEnabled', '1')),
+            sys.intern(entry.get('NewPortMappingDescription') or ''),
+            int(entry.get('NewLeaseDuration') or 0),
+            entry.get('NewRemoteHost') or '',
+            gateway
+        )
+
+    @property
+    def key(self):
+        return (self.protocol, self.external_port)
+
+    def to_entry(self):
+        # Back to the dict of strings get_port_mappings() has always returned
+        entry = {
+            'NewRemoteHost':self.remote_host,
+            'NewExternalPort':str(self.external_port),
+            'NewProtocol':self.protocol,
+            'NewInternalPort':str(self.internal_port),
+            'NewInternalClient':self.internal_client,
+            'NewEnabled':'1' if self.enabled else '0',
+            'NewPortMappingDescription':self.description,
+            'NewLeaseDuration':str(self.lease)
+        }
+        if self.gateway is not None:
+            entry['gateway'] = self.gateway
+        return entry
@@ -0,0 +1,115 @@
+def lease_key(lease):
+    return (str(lease['protocol']).upper(), int(lease['external_port']))
+
+def mapping_key(mapping):
+    return (str(mapping['NewProtocol']).upper(), int(mapping['NewExternalPort']))
+
+class Reconciler:
+
+    # Compares declared leases (dicts with ip, external_port, internal_port, protocol,
+    # description and lease keys) against the router table from get_port_mappings() by
+    # (protocol, external port) and only sends the SOAP calls needed to close the gap.
+
+    def __init__(self, upnp, renew_fraction=0.5):
+        self.upnp = upnp
+        # Renew when less than this fraction of the declared lease is left on the router
+        self.renew_fraction = renew_fraction
+
+    def plan(self, desired, current, owned=None, force=False, undescribed=()):
+        # owned(mapping) says whether a router entry is ours to delete when it isn't declared,
+        # without it nothing is ever deleted. force re-adds mappings another host has taken over.
+        # undescribed holds the keys of leases that go over NAT-PMP or PCP. Planning never talks
+        # to the gateway.
+        current = {mapping_key(mapping): mapping for mapping in current}
+        plan = {
+            'add':[],
+            'update':[],
+            'renew':[],
+            'delete':[],
+            'drift':[],
+            'unchanged':[]
+        }
+
+        declared = set()
+        for lease in desired:
+            key = lease_key(lease)
+            declared.add(key)
+            mapping = current.get(key)
+            if mapping is None:
+                plan['add'].append(lease)
+                continue
+
+            if mapping['NewInternalClient'] != lease['ip']:
+                # Someone else holds the port, AddPortMapping would fail with 718 anyway
+                plan['drift'].append({
+                    'lease':lease,
+                    'mapping':mapping
+                })
+                if force:
+                    plan['delete'].append(key)
+                    plan['add'].append(lease)
+                continue
+
+            # Leases that go over NAT-PMP or PCP can't carry a description, the router lists them
+            # under its own label, so comparing it would rewrite them on every pass
+            if (int(mapping['NewInternalPort']) != int(lease['internal_port'])
+                    or (key not in undescribed and (mapping['NewPortMappingDescription'] or '') != lease['description'])
+                    or str(mapping.get('NewEnabled', '1')) != '1'):
+                plan['update'].append(lease)
+                continue
+
+            remaining = int(mapping['NewLeaseDuration'] or 0)
+            # 0 means the router holds it permanently, which satisfies any declared lease
+            if int(lease['lease']) > 0 and 0 < remaining < int(lease['lease']) * self.renew_fraction:
+                plan['renew'].append(lease)
+                continue
+            plan['unchanged'].append(lease)
+
+        if owned is not None:
+            for key, mapping in current.items():
+                if key not in declared and owned(mapping):
+                    plan['delete'].append(key)
+        return plan
+
+    def execute(self, plan):
+        # Deletes go first so forced takeovers free the port before the add
+        deletes = [(port, protocol) for protocol, port in plan['delete']]
+        writes = plan['add'] + plan['update'] + plan['renew']
+        results = []
+        if deletes:
+            results += self.upnp.remove_port_mappings(deletes)
+        if writes:
+            results += self.upnp.add_port_mappings(writes)
+        failed = [result for result in results if result['code'] != 0]
+        return {
+            'code':0 if not failed else 2,
+            'error':'' if not failed else f"{len(failed)} of {len(results)} changes failed",
+            'added':len(plan['add']),
+            'updated':len(plan['update']),
+            'renewed':len(plan['renew']),
+            'deleted':len(plan['delete']),
+            'unchanged':len(plan['unchanged']),
+            'drift':plan['drift'],
+            'failed':failed,
+            'writes':len(results)
+        }
+
+    def reconcile(self, desired, owned=None, force=False, dry_run=False):
+        # One enumeration, then only the writes the plan calls for
+        current = self.upnp.get_port_mappings()
+        if type(current) == dict:
+            return current
+        # The port control probe happens here, once, rather than while planning
+        undescribed = {lease_key(lease) for lease in desired
+                       if self.upnp.port_control_client(lease['ip'], lease['protocol'], lease['lease']) is not None}
+        plan = self.plan(desired, current, owned, force, undescribed)
+        for drift in plan['drift']:
+            mapping = drift['mapping']
+            print(f"{mapping['NewProtocol']} {mapping['NewExternalPort']} is mapped to {mapping['NewInternalClient']}, "
+                  f"not {drift['lease']['ip']}.")
+        if dry_run:
+            return dict(plan, code=0, error='')
+        report = self.execute(plan)
+        print(f"Reconciled: {report['added']} added, {report['updated']} updated, {report['renewed']} renewed, "
+              f"{report['deleted']} deleted, {report['unchanged']} unchanged.")
+        return report
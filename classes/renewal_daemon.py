@@ -0,0 +1,283 @@
+import json
+import os
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+from classes.upnp_interface import UPnPinterface
+from classes.renewal_scheduler import RenewalScheduler
+from classes.mapping_store import MappingStore
+from classes.reconciler import Reconciler
+from classes.gena import EventListener
+
+def default_socket_path():
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    return os.path.join(runtime_dir, f"simple_upnp-{os.getuid()}.sock")
+
+def mapping_key(protocol, external_port):
+    return (str(protocol).upper(), int(external_port))
+
+class DaemonRequestHandler(socketserver.StreamRequestHandler):
+
+    # One JSON object per line in each direction, several requests per connection are fine
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                response = self.server.renewal_daemon.handle_request(request)
+            except (ValueError, KeyError, TypeError) as e:
+                response = {
+                    'code':4,
+                    'error':f"Bad request: {e}"
+                }
+            self.wfile.write(json.dumps(response).encode('utf-8') + b"\n")
+            self.wfile.flush()
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class RenewalDaemon:
+
+    def __init__(self, socket_path=None, refresh_interval=300, data=None, store_path=None):
+        self.socket_path = socket_path or default_socket_path()
+        self.refresh_interval = refresh_interval
+        self.upnp = UPnPinterface(data or {'renewals':''})
+        self.scheduler = RenewalScheduler(self.upnp.add_port_mappings, on_result=self.on_renewed, metrics=self.upnp.metrics)
+        self.store = MappingStore(store_path)
+        self.started = time.time()
+        self.server = None
+
+        # In-memory view of the router table, (protocol, external port) -> GetGenericPortMappingEntry
+        # style dict. Filled by enumeration and kept current by our own add/remove calls, so list
+        # never has to go back to the router.
+        self.view = {}
+        self.view_lock = threading.Lock()
+        self.refreshed = None
+        self.refresh_error = None
+        self.stopping = threading.Event()
+        # Set by gateway events, so the table is only re-read when the router says it changed
+        self.refresh_wanted = threading.Event()
+        self.events = EventListener(self.upnp, self.on_event)
+
+    def refresh(self):
+        mappings = self.upnp.get_port_mappings()
+        if type(mappings) == dict:
+            self.refresh_error = mappings['error']
+            return mappings
+        view = {mapping_key(mapping['NewProtocol'], mapping['NewExternalPort']): mapping for mapping in mappings}
+        with self.view_lock:
+            self.view = view
+        self.refreshed = time.time()
+        self.refresh_error = None
+        return {
+            'code':0,
+            'error':'',
+            'count':len(view)
+        }
+
+    def refresh_loop(self):
+        # Polls every refresh_interval only while the gateway isn't sending events, once
+        # subscribed the subscription length is just a safety net
+        while not self.stopping.is_set():
+            self.refresh_wanted.clear()
+            self.refresh()
+            if self.events.server is None:
+                error = self.events.start()
+                if error is not None:
+                    print(f"No gateway events, polling every {self.refresh_interval} s.\n {error['error']}")
+            self.refresh_wanted.wait(self.events.timeout if self.events.subscribed else self.refresh_interval)
+
+    def on_event(self, variables, missed):
+        # The initial event repeats what the last refresh already found
+        count = variables.get('PortMappingNumberOfEntries')
+        with self.view_lock:
+            changed = count is not None and count != str(len(self.view))
+        if missed or changed:
+            self.refresh_wanted.set()
+
+    def restore(self):
+        # Leases from the store are scheduled and listed right away, the first refresh corrects the view
+        for key, record in self.store.items():
+            self.remember(record['lease'])
+            self.scheduler.schedule(record['lease'], due=time.monotonic() + self.store.renewal_delay(key))
+        print(f"Restored {len(self.store)} lease(s) from {self.store.path}")
+
+    def on_renewed(self, key, lease, result):
+        if result['code'] == 0:
+            self.remember(lease)
+            self.store.record_renewal(key)
+        elif key in self.scheduler:
+            print(f"Renewal of {key[0]} {key[1]} failed, retrying.\n {result['error']}")
+        else:
+            self.store.delete(key)
+            print(f"Renewal of {key[0]} {key[1]} failed, dropping it.\n {result['error']}")
+
+    def remember(self, lease):
+        with self.view_lock:
+            self.view[mapping_key(lease['protocol'], lease['external_port'])] = {
+                'NewRemoteHost':'',
+                'NewExternalPort':str(lease['external_port']),
+                'NewProtocol':lease['protocol'],
+                'NewInternalPort':str(lease['internal_port']),
+                'NewInternalClient':lease['ip'],
+                'NewEnabled':'1',
+                'NewPortMappingDescription':lease['description'],
+                'NewLeaseDuration':str(lease['lease'])
+            }
+
+    def lease_from_request(self, request):
+        ip = request.get('ip') or self.upnp.get_local_ip()
+        if not ip:
+            raise ValueError("no local address found, pass ip")
+        return {
+            'ip':ip,
+            'external_port':int(request['external_port']),
+            'internal_port':int(request.get('internal_port', request['external_port'])),
+            'protocol':str(request.get('protocol', 'TCP')).upper(),
+            'description':request.get('description', 'simple_upnp'),
+            'lease':int(request.get('lease', 0))
+        }
+
+    def command_add(self, request):
+        lease = self.lease_from_request(request)
+        result = self.upnp.request_add_port_mapping(lease['ip'], lease['external_port'], lease['internal_port'],
+                                                    lease['protocol'], lease['description'], lease['lease'])
+        if result['code'] == 0:
+            self.remember(lease)
+            if request.get('renew', True) and lease['lease'] > 0:
+                self.store.put(lease)
+                self.scheduler.schedule(lease, due=self.scheduler.next_due(lease, result.get('granted_lease')))
+                self.store.record_renewal(mapping_key(lease['protocol'], lease['external_port']))
+        return dict(lease, **result)
+
+    def command_remove(self, request):
+        key = mapping_key(request.get('protocol', 'TCP'), request['external_port'])
+        self.scheduler.cancel(key)
+        self.store.delete(key)
+        result = self.upnp.request_remove_port_mapping(key[1], key[0])
+        if result['code'] == 0:
+            with self.view_lock:
+                self.view.pop(key, None)
+        return dict(result, protocol=key[0], external_port=key[1])
+
+    def command_cancel(self, request):
+        # Stops renewing a lease, the mapping stays on the router until it expires
+        key = mapping_key(request.get('protocol', 'TCP'), request['external_port'])
+        cancelled = self.scheduler.cancel(key)
+        self.store.delete(key)
+        return {
+            'code':0,
+            'error':'',
+            'protocol':key[0],
+            'external_port':key[1],
+            'cancelled':cancelled
+        }
+
+    def command_list(self, request):
+        if request.get('refresh'):
+            result = self.refresh()
+            if result['code'] != 0:
+                return result
+        with self.view_lock:
+            mappings = [dict(mapping, renew=key in self.scheduler) for key, mapping in sorted(self.view.items())]
+        return {
+            'code':0,
+            'error':'',
+            'mappings':mappings
+        }
+
+    def command_reconcile(self, request):
+        # Brings the router back in line with the stored leases, one enumeration and only the writes needed
+        report = Reconciler(self.upnp).reconcile(self.store.leases(), force=request.get('force', False),
+                                                  dry_run=request.get('dry_run', False))
+        if report['code'] == 0 and not request.get('dry_run'):
+            self.refresh()
+        return report
+
+    def command_status(self, request):
+        return {
+            'code':0,
+            'error':'',
+            'gateway':self.upnp.location,
+            'uptime':time.time() - self.started,
+            'mappings':len(self.view),
+            'refreshed':self.refreshed,
+            'refresh_error':self.refresh_error,
+            'events':self.events.subscribed,
+            'port_control':self.upnp.port_control.name if self.upnp.port_control is not None else None,
+            'renewals':[dict(lease, due_in=due_in) for due_in, lease in self.scheduler.pending()]
+        }
+
+    def command_metrics(self, request):
+        # format 'prometheus' returns the text exposition format in 'text', anything else the snapshot
+        if request.get('format') == 'prometheus':
+            return {
+                'code':0,
+                'error':'',
+                'text':self.upnp.metrics.to_prometheus()
+            }
+        return dict(self.upnp.metrics.snapshot(), code=0, error='')
+
+    def handle_request(self, request):
+        command = getattr(self, f"command_{request['command']}", None)
+        if command is None:
+            return {
+                'code':4,
+                'error':f"Unknown command {request['command']}"
+            }
+        return command(request)
+
+    def serve_forever(self):
+        if os.path.exists(self.socket_path):
+            # A stale socket from a crashed daemon, refuse if another one is still listening
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+                raise RuntimeError(f"Another daemon is listening on {self.socket_path}")
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.unlink(self.socket_path)
+            finally:
+                probe.close()
+
+        self.server = DaemonServer(self.socket_path, DaemonRequestHandler)
+        self.server.renewal_daemon = self
+        os.chmod(self.socket_path, 0o600)
+
+        self.restore()
+        self.scheduler.start()
+        threading.Thread(target=self.refresh_loop, name="refresh", daemon=True).start()
+        print(f"Listening on {self.socket_path}")
+        try:
+            self.server.serve_forever()
+        finally:
+            self.stopping.set()
+            self.refresh_wanted.set()
+            self.events.stop()
+            self.scheduler.stop()
+            self.server.server_close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+            self.upnp.close()
+            self.store.close()
+
+    def shutdown(self):
+        # Safe to call from a signal handler or another thread
+        if self.server is not None:
+            threading.Thread(target=self.server.shutdown).start()
+
+class DaemonClient:
+
+    def __init__(self, socket_path=None, timeout=30):
+        self.socket_path = socket_path or default_socket_path()
+        self.timeout = timeout
+
+    def request(self, command, **arguments):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            sock.sendall(json.dumps(dict(arguments, command=command)).encode('utf-8') + b"\n")
+            with sock.makefile('rb') as reader:
+                return json.loads(reader.readline())
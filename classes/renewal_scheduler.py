@@ -0,0 +1,202 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+import traceback
+from classes.metrics import Metrics
+
+# Faults no retry can fix: another host holds the port, or the router won't take the request
+# as it is (Invalid Args, Action not authorized, SamePortValuesRequired, OnlyPermanentLeasesSupported)
+FINAL_FAULTS = {'402', '606', '718', '724', '725'}
+
+class RenewalScheduler:
+
+    def __init__(self, renew, on_result=None, batch_window=5, jitter=0.1, min_interval=5, metrics=None,
+                 retry_interval=5, max_retry_interval=300):
+        # renew(leases) gets every lease due in the same batch and returns one result dict per
+        # lease, in order (UPnPinterface.add_port_mappings fits). Leases are dicts with ip,
+        # external_port, internal_port, protocol, description and lease keys.
+        # on_result(key, lease, result) is called from the scheduler thread after each renewal,
+        # a failed lease is still in the scheduler when it will be retried.
+        self.renew = renew
+        self.on_result = on_result
+        self.batch_window = batch_window
+        self.jitter = jitter
+        self.min_interval = min_interval
+        # A failed renewal is retried after retry_interval, doubling up to max_retry_interval.
+        # Once the lease it was renewing has run out it is retried every max_retry_interval, so
+        # a gateway that comes back gets the mapping back. Only FINAL_FAULTS drop a lease.
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.metrics = metrics or Metrics()
+
+        # Min-heap of (due, sequence, key). Cancelled or replaced leases stay in the heap and are
+        # skipped when they reach the top, so add and cancel are both O(log n) or better.
+        self.heap = []
+        # key -> (lease, sequence, due, expires, failures) for the live entry of every key, expires
+        # is when the router drops the mapping unless a renewal gets through
+        self.leases = {}
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+
+    def __contains__(self, key):
+        return key in self.leases
+
+    def __len__(self):
+        return len(self.leases)
+
+    def lease_key(self, lease):
+        return (lease['protocol'], int(lease['external_port']))
+
+    def next_due(self, lease, granted=None):
+        # Renew at half the lease, pulled forward by up to jitter of that so leases added
+        # together don't all hit the router in the same second. NAT-PMP and PCP gateways may
+        # grant less than was asked for, the shorter one wins.
+        interval = min(int(lease['lease']), granted or int(lease['lease'])) / 2
+        interval -= interval * random.uniform(0, self.jitter)
+        return time.monotonic() + max(interval, self.min_interval)
+
+    def retry_due(self, expires, failures):
+        # When to try again after failures failed renewals in a row, at the latest just before
+        # the lease runs out
+        now = time.monotonic()
+        if now >= expires - 1:
+            return now + self.max_retry_interval
+        delay = min(self.retry_interval * 2 ** (failures - 1), self.max_retry_interval)
+        return min(now + delay, expires - 1)
+
+    def schedule(self, lease, due=None):
+        # Adds or replaces the lease for its (protocol, external port). Returns the monotonic due
+        # time, or None for permanent (lease 0) mappings which never need renewing.
+        if int(lease['lease']) <= 0:
+            self.cancel(self.lease_key(lease))
+            return None
+        key = self.lease_key(lease)
+        with self.condition:
+            if due is None:
+                due = self.next_due(lease)
+            sequence = next(self.sequence)
+            # Counted from now even for leases restored after a restart, so a router that isn't
+            # reachable yet gets a whole lease worth of quick retries
+            self.leases[key] = (lease, sequence, due, time.monotonic() + int(lease['lease']), 0)
+            heapq.heappush(self.heap, (due, sequence, key))
+            self.condition.notify()
+        return due
+
+    def cancel(self, key):
+        with self.condition:
+            return self.leases.pop(key, None) is not None
+
+    def pending(self):
+        # [(seconds until due, lease)] sorted by due time
+        now = time.monotonic()
+        with self.condition:
+            entries = sorted(self.leases.values(), key=lambda entry: entry[2])
+        return [(due - now, lease) for lease, sequence, due, expires, failures in entries]
+
+    def start(self):
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+        self.thread = threading.Thread(target=self.run, name="renewal-scheduler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def take_due(self):
+        # Pops every live entry due within batch_window of now, called with the lock held
+        now = time.monotonic()
+        batch = []
+        while self.heap and self.heap[0][0] <= now + self.batch_window:
+            due, sequence, key = heapq.heappop(self.heap)
+            entry = self.leases.get(key)
+            if entry is None or entry[1] != sequence:
+                continue
+            batch.append((key, entry[0], sequence, due))
+        return batch
+
+    def run(self):
+        self.condition.acquire()
+        try:
+            while self.running:
+                # Drop stale heads so the wait below is for a live lease
+                while self.heap and self.leases.get(self.heap[0][2], (None, None))[1] != self.heap[0][1]:
+                    heapq.heappop(self.heap)
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+                delay = self.heap[0][0] - time.monotonic()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+
+                batch = self.take_due()
+                if not batch:
+                    continue
+                self.condition.release()
+                try:
+                    # How long after its due time each lease went out, leases pulled forward
+                    # into the batch window count as on time
+                    fired = time.monotonic()
+                    for key, lease, sequence, due in batch:
+                        self.metrics.observe('upnp_renewal_lateness_seconds', max(0.0, fired - due))
+                    with self.metrics.timer('upnp_renewal_batch_seconds'):
+                        results = self.renew_batch(batch)
+                    for result in results:
+                        self.metrics.increment('upnp_renewals_total', result='ok' if result['code'] == 0 else 'failed')
+                finally:
+                    self.condition.acquire()
+
+                finished = []
+                for (key, lease, sequence, due), result in zip(batch, results):
+                    current = self.leases.get(key)
+                    # Cancelled or replaced while the renewal was in flight
+                    if current is None or current[1] != sequence:
+                        continue
+                    if result['code'] == 0:
+                        due = self.next_due(lease, result.get('granted_lease'))
+                        granted = min(int(lease['lease']), result.get('granted_lease') or int(lease['lease']))
+                        expires, failures = time.monotonic() + granted, 0
+                    else:
+                        # A reboot, a timeout or a passing 501 shouldn't lose the lease, however
+                        # long it lasts, only a final fault does
+                        expires, failures = current[3], current[4] + 1
+                        due = None
+                        if result.get('fault_code') not in FINAL_FAULTS:
+                            due = self.retry_due(expires, failures)
+                    if due is None:
+                        del self.leases[key]
+                    else:
+                        sequence = next(self.sequence)
+                        self.leases[key] = (lease, sequence, due, expires, failures)
+                        heapq.heappush(self.heap, (due, sequence, key))
+                    finished.append((key, lease, result))
+
+                if self.on_result is not None:
+                    self.condition.release()
+                    try:
+                        for key, lease, result in finished:
+                            self.on_result(key, lease, result)
+                    finally:
+                        self.condition.acquire()
+        finally:
+            self.condition.release()
+
+    def renew_batch(self, batch):
+        leases = [lease for key, lease, sequence, due in batch]
+        print(f"Renewing {len(leases)} port mapping(s).")
+        try:
+            return self.renew(leases)
+        except Exception as e:
+            traceback.print_exc()
+            return [{'code':3, 'error':f"Renewal failed: {e}"} for lease in leases]
@@ -0,0 +1,173 @@
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+# SOAP encoding and decoding for the control hot path. Envelopes are built once per (service
+# type, action) so a request is one string format of the escaped values, and responses keep
+# only the action's output arguments or the UPnP fault.
+
+ENVELOPE_HEAD = (
+    '<?xml version="1.0"?>'
+    '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" '
+    's:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">'
+    '<s:Body>'
+)
+ENVELOPE_TAIL = '</s:Body></s:Envelope>'
+
+class SOAPError(Exception):
+    pass
+
+class SOAPFault(SOAPError):
+
+    # UPnP errorCode this class stands for, None for the generic fault
+    code = None
+
+    def __init__(self, code, description):
+        super().__init__(f"{code} {description}")
+        self.code = code
+        self.description = description
+
+class InvalidArgs(SOAPFault):
+    code = '402'
+
+class ActionFailed(SOAPFault):
+    code = '501'
+
+class NotAuthorized(SOAPFault):
+    code = '606'
+
+class SpecifiedArrayIndexInvalid(SOAPFault):
+    code = '713'
+
+class NoSuchEntryInArray(SOAPFault):
+    code = '714'
+
+class ConflictInMappingEntry(SOAPFault):
+    code = '718'
+
+class SamePortValuesRequired(SOAPFault):
+    code = '724'
+
+class OnlyPermanentLeasesSupported(SOAPFault):
+    code = '725'
+
+class PortMappingNotFound(SOAPFault):
+    code = '730'
+
+FAULT_CLASSES = {fault.code: fault for fault in (
+    InvalidArgs, ActionFailed, NotAuthorized, SpecifiedArrayIndexInvalid, NoSuchEntryInArray,
+    ConflictInMappingEntry, SamePortValuesRequired, OnlyPermanentLeasesSupported, PortMappingNotFound
+)}
+
+def fault_from_code(code, description):
+    return FAULT_CLASSES.get(code, SOAPFault)(code, description)
+
+# Input arguments of the actions the clients send, in the order of the service description.
+# Requests pass the values of these in order, leaving out FIXED_ARGUMENTS.
+ACTION_ARGUMENTS = {
+    'AddPortMapping':('NewRemoteHost', 'NewExternalPort', 'NewProtocol', 'NewInternalPort', 'NewInternalClient',
+                      'NewEnabled', 'NewPortMappingDescription', 'NewLeaseDuration'),
+    'DeletePortMapping':('NewRemoteHost', 'NewExternalPort', 'NewProtocol'),
+    'GetGenericPortMappingEntry':('NewPortMappingIndex',),
+    'GetListOfPortMappings':('NewStartPort', 'NewEndPort', 'NewProtocol', 'NewManage', 'NewNumberOfPorts'),
+    'QueryStateVariable':('varName',)
+}
+
+# Any remote host, enabled and every mapping in listings is all this app ever asks for, so
+# these are written into the envelope once like the hand written envelopes had them
+FIXED_ARGUMENTS = {
+    'NewRemoteHost':'',
+    'NewEnabled':1,
+    'NewManage':1
+}
+
+class RequestTemplate:
+
+    # The envelope of one action for one service type, built once as a % template with a slot
+    # per argument value. Only values are ever put into it, each escaped on the way in.
+
+    def __init__(self, service_type, action):
+        self.action = action
+        self.names = [name for name in ACTION_ARGUMENTS[action] if name not in FIXED_ARGUMENTS]
+        self.soap_action = f'"{service_type}#{action}"'
+        namespace = escape(service_type, {'"': '&quot;'})
+        # The envelope split around its argument values, a % in the text (the service type comes
+        # from the router) must stay text
+        pieces = [f'{ENVELOPE_HEAD}<u:{action} xmlns:u="{namespace}">']
+        for name in ACTION_ARGUMENTS[action]:
+            if name in FIXED_ARGUMENTS:
+                pieces[-1] += f'<{name}>{escape(str(FIXED_ARGUMENTS[name]))}</{name}>'
+            else:
+                pieces[-1] += f'<{name}>'
+                pieces.append(f'</{name}>')
+        pieces[-1] += f'</u:{action}>{ENVELOPE_TAIL}'
+        self.envelope = '%s'.join(piece.replace('%', '%%') for piece in pieces)
+
+    def encode(self, values):
+        # Escapes &, < and > in every value that isn't a plain int, > so that a ]]> in a
+        # description can't end up in the document
+        if len(values) != len(self.names):
+            raise ValueError(f"{self.action} takes {len(self.names)} arguments, got {len(values)}")
+        # Replaces inline rather than through escape(), which costs a call and a dict walk per value
+        values = tuple([value if value.__class__ is int else
+                        str(value).replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;') for value in values])
+        return self.soap_action, (self.envelope % values).encode('utf-8')
+
+# (service type, action) -> RequestTemplate
+templates = {}
+
+def encode_request(service_type, action, values):
+    # values follow ACTION_ARGUMENTS[action] without FIXED_ARGUMENTS, returns (SOAPAction
+    # header, body bytes)
+    template = templates.get((service_type, action))
+    if template is None:
+        template = templates.setdefault((service_type, action), RequestTemplate(service_type, action))
+    return template.encode(values)
+
+SOAP_ENVELOPE = '{http://schemas.xmlsoap.org/soap/envelope/}'
+
+def local_name(tag):
+    return tag.rpartition('}')[2]
+
+def decode_response(data):
+    # Output arguments of a SOAP response as {name: text}, raises the matching SOAPFault
+    # subclass for a UPnP fault and SOAPError for anything that isn't SOAP
+    try:
+        root = ElementTree.fromstring(data)
+    except ElementTree.ParseError as e:
+        raise SOAPError(f"Malformed SOAP response: {e}")
+    body = root.find(SOAP_ENVELOPE + 'Body')
+    if body is None or not len(body):
+        return {}
+    response = body[0]
+    if response.tag == SOAP_ENVELOPE + 'Fault':
+        fields = {}
+        for element in response.iter():
+            name = local_name(element.tag)
+            if name in ('errorCode', 'errorDescription'):
+                fields[name] = (element.text or '').strip()
+        raise fault_from_code(fields.get('errorCode'), fields.get('errorDescription'))
+    return {local_name(child.tag): child.text or '' for child in response}
+
+# GetListOfPortMappings names two fields differently from GetGenericPortMappingEntry
+LISTING_KEYS = {
+    'NewDescription':'NewPortMappingDescription',
+    'NewLeaseTime':'NewLeaseDuration'
+}
+
+def decode_port_listing(data):
+    # NewPortListing of GetListOfPortMappings as GetGenericPortMappingEntry style dicts
+    if not data or not data.strip():
+        return []
+    try:
+        root = ElementTree.fromstring(data)
+    except ElementTree.ParseError as e:
+        raise SOAPError(f"Malformed port listing: {e}")
+    entries = []
+    for element in root.iter():
+        if local_name(element.tag) == 'PortMappingEntry':
+            entry = {}
+            for child in element:
+                name = local_name(child.tag)
+                entry[LISTING_KEYS.get(name, name)] = child.text or ''
+            entries.append(entry)
+    return entries
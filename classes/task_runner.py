@@ -0,0 +1,83 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+import traceback
+from classes.metrics import Metrics
+
+class TaskRunner:
+
+    def __init__(self, dispatch, max_workers=4, on_busy=None, metrics=None):
+        # dispatch(fn) must run fn on the UI thread, GLib.idle_add for the GTK window.
+        # on_busy(count) is called on the UI thread whenever the number of jobs changes.
+        self.dispatch = dispatch
+        self.on_busy = on_busy
+        # Queue wait and run time per task, and how long callbacks hold the UI thread
+        self.metrics = metrics or Metrics()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="upnp")
+        self.lock = threading.Lock()
+        self.busy = 0
+        # key -> "queued", "running" or "rerun" for coalesced jobs
+        self.keyed = {}
+
+    def submit(self, func, args=(), callback=None, key=None):
+        # Runs func(*args) on a worker and hands the result to callback on the UI thread.
+        # Jobs sharing a key are coalesced: a duplicate of a queued job is dropped, and a
+        # duplicate of a running job reruns it once it finishes instead of stacking up.
+        with self.lock:
+            if key is not None:
+                state = self.keyed.get(key)
+                if state == "queued" or state == "rerun":
+                    return
+                if state == "running":
+                    self.keyed[key] = "rerun"
+                    return
+                self.keyed[key] = "queued"
+            self.busy += 1
+        self.notify_busy()
+        self.executor.submit(self.run, func, args, callback, key, time.perf_counter())
+
+    def run(self, func, args, callback, key, submitted):
+        if key is not None:
+            with self.lock:
+                self.keyed[key] = "running"
+        task = getattr(func, '__name__', 'task')
+        self.metrics.observe('upnp_task_wait_seconds', time.perf_counter() - submitted, task=task)
+        with self.metrics.timer('upnp_task_seconds', task=task, outcome='error') as labels:
+            try:
+                result = func(*args)
+                failed = False
+                labels['outcome'] = 'ok'
+            except Exception:
+                traceback.print_exc()
+                failed = True
+
+        rerun = False
+        with self.lock:
+            self.busy -= 1
+            if key is not None:
+                rerun = self.keyed.pop(key) == "rerun"
+        self.notify_busy()
+
+        if rerun:
+            # The result is already stale, only deliver the one from the rerun
+            self.submit(func, args, callback, key)
+        elif callback is not None and not failed:
+            self.call_soon(self.timed_callback, callback, result)
+
+    def timed_callback(self, callback, result):
+        with self.metrics.timer('upnp_ui_callback_seconds', callback=getattr(callback, '__name__', 'callback')):
+            callback(result)
+
+    def call_soon(self, func, *args):
+        def deliver():
+            func(*args)
+            return False
+        self.dispatch(deliver)
+
+    def notify_busy(self):
+        # Read the count when the UI thread gets to it, so out of order deliveries can't go stale
+        if self.on_busy is not None:
+            self.call_soon(lambda: self.on_busy(self.busy))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -1,218 +1,827 @@
 import requests
+import requests.adapters
 from xml.etree import ElementTree 
+from urllib.parse import urljoin, urlsplit
+from concurrent.futures import ThreadPoolExecutor
+import ipaddress
+import queue
+import selectors
 import socket
 import sys
-import netifaces
+import threading
+import time
+from classes.soap_codec import SOAPError, SOAPFault, encode_request, decode_response, decode_port_listing
+from classes.metrics import Metrics
+from classes.port_index import PortIndex
+from classes.port_mapping import PortMapping
+from classes.port_control import (PORT_CONTROL_CLIENTS, PORT_CONTROL_PORT, PROTOCOL_NUMBERS, CONFLICT_FAULT, default_gateway,
+                                  default_probe_cache_path, load_probe, probe_port_control, save_probe)
+
+SSDP_ADDRESS = ('239.255.255.250', 1900)
+
+GATEWAY_SEARCH_TARGETS = (
+    'urn:schemas-upnp-org:device:InternetGatewayDevice:1',
+    'urn:schemas-upnp-org:device:InternetGatewayDevice:2',
+    'urn:schemas-upnp-org:service:WANIPConnection:1',
+    'urn:schemas-upnp-org:service:WANIPConnection:2',
+    'urn:schemas-upnp-org:service:WANPPPConnection:1',
+)
+
+def build_msearch(search_target, mx=1, address=SSDP_ADDRESS):
+    # M-Search message body
+    return (
+        'M-SEARCH * HTTP/1.1\r\n'
+        f'HOST:{address[0]}:{address[1]}\r\n'
+        f'ST:{search_target}\r\n'
+        f'MX:{mx}\r\n'
+        'MAN:"ssdp:discover"\r\n'
+        '\r\n'
+    ).encode('utf-8')
+
+def parse_ssdp_response(data):
+    lines = data.decode("utf-8", errors="replace").strip().splitlines()
+    if not lines or " 200" not in lines[0]:
+        return None
+
+    gateway_info = {}
+    for line in lines[1:]:
+        if ":" in line:
+            # Split each line at the first occurrence of ":", header names are case-insensitive
+            key, value = line.split(":", 1)
+            gateway_info[key.strip().upper()] = value.strip()
+    return gateway_info
+
+def local_ipv4_addresses():
+    # [(interface, address)] for every IPv4 address outside the loopback network
+    try:
+        import netifaces
+    except ImportError:
+        return []
+    addresses = []
+    for interface in netifaces.interfaces():
+        for entry in netifaces.ifaddresses(interface).get(netifaces.AF_INET, []):
+            address = entry.get('addr')
+            if address and not ipaddress.ip_address(address).is_loopback:
+                addresses.append((interface, address))
+    return addresses
+
+def route_source_address(host):
+    # Local address the kernel picks to reach host, connecting a UDP socket sends nothing
+    SOC = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        SOC.connect((host, SSDP_ADDRESS[1]))
+        return SOC.getsockname()[0]
+    except OSError:
+        return None
+    finally:
+        SOC.close()
+
+def is_gateway_response(gateway_info):
+    if not gateway_info.get('LOCATION'):
+        return False
+    search_target = gateway_info.get('ST', '')
+    return any(search_target.startswith(target[:-1]) for target in GATEWAY_SEARCH_TARGETS)
+
+# Implicit action of every UPnP 1.0 service, used to read PortMappingNumberOfEntries
+QUERY_STATE_SERVICE = 'urn:schemas-upnp-org:control-1-0'
+
+# Fault that GetGenericPortMappingEntry returns past the end of the table
+END_OF_TABLE_FAULT = '713'
+
+# GetListOfPortMappings answers with 730 when nothing is mapped in the requested range
+NO_MAPPINGS_FAULT = '730'
+
+PORT_LISTING_PAGE = 1000
+
+def parse_soap_fault(xml_string):
+    # Returns (errorCode, errorDescription) from a UPnPError fault, or (None, None)
+    try:
+        decode_response(xml_string)
+    except SOAPFault as fault:
+        return fault.code, fault.description
+    except SOAPError:
+        pass
+    return None, None
+
+def parse_soap_response(xml_string):
+    return decode_response(xml_string)
+
+def parse_port_mapping_entry(xml_string):
+    return decode_response(xml_string)
+
+def parse_port_listing(xml_string):
+    return decode_port_listing(xml_string)
+
+def parse_service_actions(xml_data):
+    root = ElementTree.fromstring(xml_data)
+    actions = root.findall('.//{urn:schemas-upnp-org:service-1-0}actionList/{urn:schemas-upnp-org:service-1-0}action')
+    return {action.findtext('{urn:schemas-upnp-org:service-1-0}name') for action in actions}
+
+def parse_gateway_service(xml_data):
+    root = ElementTree.fromstring(xml_data)
+    services = root.findall('.//{urn:schemas-upnp-org:device-1-0}serviceList/{urn:schemas-upnp-org:device-1-0}service')
+    if not services:
+        print("No service elements found in the XML data.")
+        return None
+
+    for service in services:
+        service_type = service.find('{urn:schemas-upnp-org:device-1-0}serviceType').text
+        if "WANIPConnection" in service_type or "WANPPPConnection" in service_type:
+            return {
+                'service_type':service_type,
+                'control_url':service.find('{urn:schemas-upnp-org:device-1-0}controlURL').text,
+                'scpd_url':service.findtext('{urn:schemas-upnp-org:device-1-0}SCPDURL'),
+                'event_sub_url':service.findtext('{urn:schemas-upnp-org:device-1-0}eventSubURL')
+            }
+
+    return None
+
+class GatewayError(Exception):
+
+    # Raised by UPnPinterface.iter_port_mappings() with the error dict the list API returns
+    def __init__(self, result):
+        super().__init__(result['error'])
+        self.result = result
 
 class UPnPinterface:
 
     def __init__(self, data):
 
-        #self.control_url = data['control_url']
-        #self.location = data['location']
         self.renewals = data['renewals']
-    
+
+        # Where M-SEARCH goes, a unicast address reaches a local test gateway such as FakeIGD
+        self.ssdp_address = tuple(data.get('ssdp_address', SSDP_ADDRESS))
+        # A description URL pins this interface to one gateway and skips SSDP, bind_address
+        # sends M-SEARCH from that local address only instead of from every interface
+        self.pinned_location = data.get('location') or None
+        self.bind_address = data.get('bind_address') or None
+
+        # Gateway cache, filled by resolve_gateway() and dropped after cache_ttl seconds
+        # (None keeps it until invalidate_gateway() or a failed request)
+        self.cache_ttl = data.get('cache_ttl', 300)
+        self.location = None
+        self.control_url = None
+        self.control_endpoint = None
+        self.event_endpoint = None
+        self.service_type = None
+        self.actions = set()
+        self.query_state_supported = True
+        self.gateway_time = 0
+        self.gateway_lock = threading.RLock()
+
+        # One keep-alive connection pool shared by every description and SOAP request
+        self.timeout = (data.get('connect_timeout', 3), data.get('read_timeout', 10))
+        self.pool_size = data.get('pool_size', 8)
+        self.session = self.create_session()
+
+        # Latency histograms and counters for discovery, description fetches and SOAP actions,
+        # pass one Metrics in data to share it with a RenewalScheduler or TaskRunner
+        self.metrics = data.get('metrics') or Metrics()
+
+        # The router table by (protocol, external port), loaded by get_port_mappings() and
+        # updated by our own adds and removes, for conflict checks without a round trip
+        self.port_index = PortIndex()
+
+        # Leases for this host go over NAT-PMP or PCP when the gateway speaks one of them.
+        # 'auto' probes for PCP then NAT-PMP, 'pcp' or 'natpmp' only try that one and 'soap'
+        # never probes. The answer is kept in port_control_cache (None keeps it in memory only)
+        # for port_control_ttl, so a short-lived process like a CLI add from cron doesn't wait
+        # for a gateway that drops UDP 5351 every time. Once that runs out a gateway that didn't
+        # answer is probed again in the background, requests meanwhile go over SOAP.
+        self.port_control_mode = data.get('port_control', 'auto')
+        self.port_control_ttl = data.get('port_control_ttl', 3600)
+        # UDP port the gateway answers on, only a test gateway such as FakeIGD uses another one
+        self.port_control_port = data.get('port_control_port', PORT_CONTROL_PORT)
+        self.port_control_cache = data.get('port_control_cache', default_probe_cache_path())
+        self.port_control = None
+        self.port_control_time = None
+        self.port_control_probing = False
+        self.port_control_lock = threading.Lock()
+
+    def create_session(self):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=self.pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def close(self):
+        self.session.close()
+
+    def http_request(self, method, url, **kwargs):
+        # Routers often drop idle keep-alive sockets without closing them cleanly,
+        # the pool then hands out a dead connection. Retry once on a fresh one.
+        for attempt in range(2):
+            try:
+                return self.session.request(method, url, timeout=self.timeout, **kwargs)
+            except requests.exceptions.ConnectTimeout:
+                raise
+            except requests.exceptions.ConnectionError:
+                if attempt > 0:
+                    raise
+
     def get_local_ip(self):
+        # The address this host has on the gateway's network, so mappings point back at us
+        # on whichever VLAN the gateway sits on. None if no address could be found.
+        if self.bind_address:
+            return self.bind_address
+        location = self.location or self.pinned_location
+        if location:
+            address = route_source_address(urlsplit(location).hostname)
+            if address:
+                return address
         try:
-            return netifaces.ifaddresses(netifaces.gateways()['default'][netifaces.AF_INET][1])[2][0]['addr']
-        except:
-            return "192.168.1.100"
+            import netifaces
+            return netifaces.ifaddresses(netifaces.gateways()['default'][netifaces.AF_INET][1])[netifaces.AF_INET][0]['addr']
+        except (ImportError, KeyError, IndexError, ValueError) as e:
+            print(f"No default route, can't tell the local address.\n {e}")
+            return None
 
-    def parse_port_mappings(self, xml_string):
-        root = ElementTree.fromstring(xml_string)
-        namespace = {'s': 'http://schemas.xmlsoap.org/soap/envelope/'}
-        body = root.find('s:Body', namespace)
-        response = body.find('*')
-        result = {}
-        for child in response:
-            result[child.tag.replace('{http://schemas.xmlsoap.org/soap/envelope/}', '')] = child.text
+    def port_control_gateway(self):
+        # The IGD's host when we know it, it is the router that holds the mappings
+        location = self.location or self.pinned_location
+        if location:
+            return urlsplit(location).hostname
+        return default_gateway()
+
+    def port_control_protocols(self):
+        return tuple(PORT_CONTROL_CLIENTS) if self.port_control_mode == 'auto' else (self.port_control_mode,)
+
+    def get_port_control(self):
+        # The NAT-PMP or PCP client for the gateway, or None to use SOAP
+        if self.port_control_mode not in PORT_CONTROL_CLIENTS and self.port_control_mode != 'auto':
+            return None
+        with self.port_control_lock:
+            if self.port_control is not None:
+                return self.port_control
+            if self.port_control_time is not None:
+                if time.monotonic() - self.port_control_time >= self.port_control_ttl and not self.port_control_probing:
+                    self.port_control_probing = True
+                    threading.Thread(target=self.reprobe_port_control, name="port-control-probe", daemon=True).start()
+                return None
+            self.port_control_time = time.monotonic()
+            gateway = self.port_control_gateway()
+            local_address = self.get_local_ip() if gateway else None
+            if not local_address:
+                return None
+            cached = None
+            if self.port_control_cache:
+                cached = load_probe(self.port_control_cache, gateway, self.port_control_port, local_address,
+                                    self.port_control_protocols(), self.port_control_ttl)
+            if cached is not None:
+                protocol, age = cached
+                self.port_control_time -= age
+                self.port_control = PORT_CONTROL_CLIENTS[protocol](gateway, local_address, self.port_control_port) if protocol else None
+                self.metrics.increment('upnp_port_control_probe_cache_hits_total')
+            else:
+                self.port_control = self.probe_port_control(gateway, local_address)
+            return self.port_control
+
+    def probe_port_control(self, gateway, local_address):
+        protocols = self.port_control_protocols()
+        with self.metrics.timer('upnp_port_control_probe_seconds', result='none') as labels:
+            client = probe_port_control(gateway, local_address, protocols, self.port_control_port)
+            if client is not None:
+                labels['result'] = client.name
+        if self.port_control_cache:
+            save_probe(self.port_control_cache, gateway, self.port_control_port, local_address, protocols,
+                       client and client.mode, self.port_control_ttl)
+        if client is not None:
+            print(f"Gateway {gateway} speaks {client.name}, using it for this host's leases.")
+        return client
+
+    def reprobe_port_control(self):
+        # Runs on its own thread, a renewal batch or a request never waits for it
+        try:
+            gateway = self.port_control_gateway()
+            local_address = self.get_local_ip() if gateway else None
+            client = self.probe_port_control(gateway, local_address) if local_address else None
+        finally:
+            with self.port_control_lock:
+                self.port_control_probing = False
+                self.port_control_time = time.monotonic()
+        if client is not None:
+            with self.port_control_lock:
+                if self.port_control is None:
+                    self.port_control = client
+
+    def port_control_client(self, internal_client, protocol, lease):
+        # The client when this mapping can go over it: only to this host, and with a lease as
+        # lifetime 0 means delete to both protocols
+        if int(lease) <= 0 or str(protocol).upper() not in PROTOCOL_NUMBERS:
+            return None
+        client = self.get_port_control()
+        if client is None or internal_client != client.local_address:
+            return None
+        return client
+
+    def port_control_call(self, client, action, func, *args):
+        # The result, or None when the request should go over SOAP instead
+        with self.metrics.timer('upnp_port_control_seconds', protocol=client.name, action=action, outcome='timeout') as labels:
+            result = func(*args)
+            if result is not None:
+                labels['outcome'] = 'ok' if result['code'] == 0 else 'failed'
+        if result is None:
+            print(f"{client.name} gateway stopped answering, using SOAP.")
+            with self.port_control_lock:
+                if self.port_control is client:
+                    self.port_control = None
+                    self.port_control_time = time.monotonic()
+            if self.port_control_cache:
+                save_probe(self.port_control_cache, client.gateway, client.port, client.local_address,
+                           self.port_control_protocols(), None, self.port_control_ttl)
+            return None
+        # A taken port would be refused over SOAP too, any other refusal may not be
+        if result['code'] != 0 and result['fault_code'] != CONFLICT_FAULT:
+            print(f"{client.name} refused, trying SOAP.\n {result['error']}")
+            return None
         return result
 
+    def parse_port_mappings(self, xml_string):
+        return parse_port_mapping_entry(xml_string)
+
+    def discover_upnp_devices(self, timeout=2):
+        # Returns the headers of the first IGD that answers, or {} if none did
+        gateways = self.ssdp_search(timeout)
+        if not gateways:
+            return {}
+        return gateways[0]
 
-    def discover_upnp_devices(self):
-        # M-Search message body
-        MS = \
-            'M-SEARCH * HTTP/1.1\r\n' \
-            'HOST:239.255.255.250:1900\r\n' \
-            'ST:upnp:rootdevice\r\n' \
-            'MX:2\r\n' \
-            'MAN:"ssdp:discover"\r\n' \
-            '\r\n'
+    def discover_gateways(self, collect_ms=500, timeout=2):
+        # Returns every distinct IGD that answers within collect_ms
+        return self.ssdp_search(timeout, collect_ms)
 
-        # Set up a UDP socket for multicast
+    def ssdp_search(self, timeout, collect_ms=None):
+        with self.metrics.timer('upnp_discovery_seconds', mode='first' if collect_ms is None else 'collect') as labels:
+            gateways = self.ssdp_exchange(timeout, collect_ms)
+            labels['result'] = 'found' if gateways else 'none'
+        return gateways
+
+    def search_addresses(self):
+        # Local addresses to send M-SEARCH from, None for one unbound socket. Multicast only
+        # leaves through one interface per socket, so every VLAN gets its own.
+        if self.bind_address:
+            return [self.bind_address]
+        if not ipaddress.ip_address(self.ssdp_address[0]).is_multicast:
+            return [None]
+        return [address for interface, address in local_ipv4_addresses()] or [None]
+
+    def open_search_socket(self, address):
+        # Set up a UDP socket for multicast, sending from address when given
         SOC = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-        SOC.settimeout(2)
+        try:
+            if address is not None:
+                SOC.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(address))
+                SOC.bind((address, 0))
+            # Send one M-Search per gateway search target
+            for search_target in GATEWAY_SEARCH_TARGETS:
+                SOC.sendto(build_msearch(search_target, address=self.ssdp_address), self.ssdp_address)
+        except OSError as e:
+            print(f"Can't search for gateways from {address}.\n {e}")
+            SOC.close()
+            return None
+        return SOC
 
-        # Send M-Search message to multicast address for UPNP
-        SOC.sendto(MS.encode('utf-8'), ('239.255.255.250', 1900) )
+    def ssdp_exchange(self, timeout, collect_ms):
+        # All interfaces are searched at once, so this takes as long as the slowest answer
+        # (or timeout) no matter how many networks the host is on
+        deadline = time.monotonic() + timeout
+        if collect_ms is not None:
+            deadline = min(deadline, time.monotonic() + collect_ms / 1000)
 
-        #listen and capture returned responses
-        gateway_info = {}
+        gateways = []
+        seen = set()
+        selector = selectors.DefaultSelector()
         try:
-            while True:
-                data, addr = SOC.recvfrom(8192)
-                #print (addr," ", data.decode('utf-8'))
-                lines = data.decode("utf-8").strip().split('\n')
-
-                # Loop through each line and parse key-value pairs
-                for line in lines:
-                    if ":" in line:
-                        # Split each line at the first occurrence of ":"
-                        key, value = line.split(":", 1)
-                        # Remove leading and trailing whitespaces from key and value
-                        key = key.strip()
-                        value = value.strip()
-                        # Add key-value pair to the dictionary
-                        gateway_info[key] = value
-        except socket.timeout:
-                pass
-        return gateway_info
+            for address in self.search_addresses():
+                SOC = self.open_search_socket(address)
+                if SOC is not None:
+                    selector.register(SOC, selectors.EVENT_READ, address)
 
-    def get_control_url(self, location):
+            # Parse each datagram on its own and stop at the first usable gateway
+            while selector.get_map():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                events = selector.select(remaining)
+                if not events:
+                    break
+                for key, mask in events:
+                    try:
+                        data, addr = key.fileobj.recvfrom(8192)
+                    except OSError:
+                        continue
+                    gateway_info = parse_ssdp_response(data)
+                    if gateway_info is None or not is_gateway_response(gateway_info):
+                        continue
+                    # An IGD answers once per matching search target, and on every interface that reaches it
+                    if gateway_info['LOCATION'] in seen:
+                        continue
+                    seen.add(gateway_info['LOCATION'])
+                    gateway_info['LOCAL_ADDRESS'] = key.data or route_source_address(addr[0])
+                    gateways.append(gateway_info)
+                if gateways and collect_ms is None:
+                    break
+        finally:
+            for key in list(selector.get_map().values()):
+                key.fileobj.close()
+            selector.close()
+        return gateways[:1] if collect_ms is None else gateways
+
+    def get_gateway_service(self, location):
         headers = {"Content-Type": "application/xml"}
-        response = requests.get(location, headers=headers)
-        xml_data = response.text
-        control_url = None
-
-        root = ElementTree.fromstring(xml_data)
-        services = root.findall('.//{urn:schemas-upnp-org:device-1-0}serviceList/{urn:schemas-upnp-org:device-1-0}service')
-        if not services:
-            print("No service elements found in the XML data.")
+        with self.metrics.timer('upnp_description_fetch_seconds', document='device', outcome='error') as labels:
+            response = self.http_request('GET', location, headers=headers)
+            labels['outcome'] = 'ok'
+        return parse_gateway_service(response.text)
+
+    def get_service_actions(self, scpd_url):
+        # Actions the service advertises in its SCPD, empty if it can't be read
+        try:
+            with self.metrics.timer('upnp_description_fetch_seconds', document='scpd', outcome='error') as labels:
+                response = self.http_request('GET', scpd_url)
+                labels['outcome'] = 'ok'
+            return parse_service_actions(response.text)
+        except (requests.exceptions.RequestException, ElementTree.ParseError) as e:
+            print(f"Failed to read service description.\n {e}")
+            return set()
+
+    def get_control_url(self, location):
+        service = self.get_gateway_service(location)
+        if service is None:
             return None
+        return service['control_url']
 
-        for service in services:
-            service_type = service.find('{urn:schemas-upnp-org:device-1-0}serviceType').text
-            if "WANIPConnection" in service_type or "WANPPPConnection" in service_type:
-                control_url = service.find('{urn:schemas-upnp-org:device-1-0}controlURL').text
-                break
+    def get_event_url(self, location):
+        # GENA subscription URL of the WANIPConnection service, None if it isn't evented
+        service = self.get_gateway_service(location)
+        if service is None or not service['event_sub_url']:
+            return None
+        return urljoin(location, service['event_sub_url'])
 
-        return control_url
-    
+    def invalidate_gateway(self, control_endpoint=None):
+        # With control_endpoint set, only drop the cache if it still points there,
+        # so concurrent failures against the same gateway rediscover it once
+        with self.gateway_lock:
+            if control_endpoint is not None and control_endpoint != self.control_endpoint:
+                return
+            self.location = None
+            self.control_url = None
+            self.control_endpoint = None
+            self.event_endpoint = None
+            self.service_type = None
+            self.actions = set()
+            self.query_state_supported = True
+            self.gateway_time = 0
 
-    def get_port_mappings(self):
-        upnp_gateway = self.discover_upnp_devices()
-        try:
-            self.location = upnp_gateway['LOCATION']  # Change this to your router's description URL
-            self.control_url = self.get_control_url(self.location)
-        except Exception as e:
-            print(f"Failed to find IGD device.\n {e}")
-            return {
-                'code':1,
-                'error':f"Failed to find IGD device: {e}"
-            }
+    def gateway_cached(self):
+        if self.control_endpoint is None:
+            return False
+        return self.cache_ttl is None or time.monotonic() - self.gateway_time < self.cache_ttl
 
-        headers = {'Content-Type': 'text/xml; charset="utf-8"',
-                   'SOAPAction': '"urn:schemas-upnp-org:service:WANIPConnection:1#GetGenericPortMappingEntry"'}
-        mappings = []
-        count = 0
-        while True:
-            body = f"""<?xml version="1.0"?>
-                <s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"
-                s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">
-                <s:Body>
-                <u:GetGenericPortMappingEntry xmlns:u="urn:schemas-upnp-org:service:WANIPConnection:1">
-                <NewPortMappingIndex>{count}</NewPortMappingIndex>
-                </u:GetGenericPortMappingEntry>
-                </s:Body>
-                </s:Envelope>"""
-            count+=1
-            response = requests.post(f"{self.location.split('/')[0]}//{self.location.split('/')[2]}{self.control_url}", headers=headers, data=body)
-            if response.status_code != 200:
-                break
-            mappings.append(self.parse_port_mappings(response.text))
-
-        return mappings
+    def resolve_gateway(self, force=False):
+        with self.gateway_lock:
+            if not force and self.gateway_cached():
+                return None
+            self.metrics.increment('upnp_gateway_resolves_total', reason='forced' if force else 'cache_miss')
+            self.invalidate_gateway()
+            upnp_gateway = {'LOCATION':self.pinned_location} if self.pinned_location else self.discover_upnp_devices()
+            try:
+                location = upnp_gateway['LOCATION']
+                service = self.get_gateway_service(location)
+                if service is None:
+                    raise LookupError("no WANIPConnection or WANPPPConnection service")
+            except Exception as e:
+                print(f"Failed to find IGD device.\n {e}")
+                return {
+                    'code':1,
+                    'error':f"Failed to find IGD device: {e}"
+                }
 
-    def remove_port_mapping(self, external_port, protocol):
-        upnp_gateway = self.discover_upnp_devices()
-        try:
-            self.location = upnp_gateway['LOCATION']  # Change this to your router's description URL
-            self.control_url = self.get_control_url(self.location)
-        except Exception as e:
-            print(f"Failed to find IGD device.\n {e}")
-            return {
-                'code':1,
-                'error':f"Failed to find IGD device: {e}"
-            }
+            self.location = location
+            self.control_url = service['control_url']
+            self.control_endpoint = urljoin(location, self.control_url)
+            self.event_endpoint = urljoin(location, service['event_sub_url']) if service['event_sub_url'] else None
+            self.service_type = service['service_type']
+            if service['scpd_url']:
+                self.actions = self.get_service_actions(urljoin(location, service['scpd_url']))
+            self.gateway_time = time.monotonic()
+            return None
 
-        headers = {
-            "Content-Type": "text/xml",
-            "SOAPAction": '"urn:schemas-upnp-org:service:WANIPConnection:1#DeletePortMapping"'
-        }
+    def soap_request(self, action, values, namespace=None):
+        # Returns (response, error). A cached gateway that refuses the connection or
+        # answers 404 has most likely moved, so rediscover it once and retry.
+        with self.metrics.timer('upnp_soap_request_seconds', action=action, outcome='error') as labels:
+            response, error = self.send_soap_request(action, values, namespace)
+            if error is None:
+                labels['outcome'] = 'ok' if response.status_code == 200 else 'fault'
+            elif error['error'].startswith("IGD did not answer in time"):
+                labels['outcome'] = 'timeout'
+        if error is None and response.status_code != 200:
+            fault_code, fault_description = parse_soap_fault(response.content)
+            self.metrics.increment('upnp_soap_faults_total', action=action, code=fault_code or str(response.status_code))
+        return response, error
+
+    def send_soap_request(self, action, values, namespace):
+        for attempt in range(2):
+            with self.gateway_lock:
+                error = self.resolve_gateway()
+                control_endpoint, service_type = self.control_endpoint, namespace or self.service_type
+            if error is not None:
+                return None, error
 
-        body = f"""<?xml version="1.0"?>
-        <s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"
-        s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">
-            <s:Body>
-                <u:DeletePortMapping xmlns:u="urn:schemas-upnp-org:service:WANIPConnection:1">
-                    <NewRemoteHost></NewRemoteHost>
-                    <NewExternalPort>{external_port}</NewExternalPort>
-                    <NewProtocol>{protocol}</NewProtocol>
-                </u:DeletePortMapping>
-            </s:Body>
-        </s:Envelope>"""
+            soap_action, body = encode_request(service_type, action, values)
+            headers = {
+                "Content-Type": 'text/xml; charset="utf-8"',
+                "SOAPAction": soap_action
+            }
+            try:
+                response = self.http_request('POST', control_endpoint, headers=headers, data=body)
+            except requests.exceptions.ConnectionError as e:
+                print(f"Connection to IGD failed, rediscovering.\n {e}")
+                self.metrics.increment('upnp_gateway_invalidations_total', reason='connection')
+                self.invalidate_gateway(control_endpoint)
+                error = {
+                    'code':2,
+                    'error':f"Connection to IGD failed: {e}"
+                }
+                continue
+            except requests.exceptions.Timeout as e:
+                print(f"IGD did not answer in time.\n {e}")
+                return None, {
+                    'code':2,
+                    'error':f"IGD did not answer in time: {e}"
+                }
+            if response.status_code == 404:
+                print("IGD control URL not found, rediscovering.")
+                self.metrics.increment('upnp_gateway_invalidations_total', reason='not_found')
+                self.invalidate_gateway(control_endpoint)
+                error = {
+                    'code':2,
+                    'error':response.text
+                }
+                continue
+            return response, None
 
-        response = requests.post(f"{self.location.split('/')[0]}//{self.location.split('/')[2]}{self.control_url}", headers=headers, data=body)
+        return None, error
 
+    def soap_result(self, response, error):
+        if error is not None:
+            return dict(error, fault_code=None)
         if response.status_code == 200:
-            print("Port mapping removed successfully.\n",response.text)
             return {
                 'code':0,
-                'error':response.text
+                'error':response.text,
+                'fault_code':None
             }
+        fault_code, fault_description = parse_soap_fault(response.content)
+        return {
+            'code':2,
+            'error':f"{fault_code} {fault_description}" if fault_code else response.text,
+            'fault_code':fault_code
+        }
+
+    def run_batch(self, func, items, max_workers):
+        # Bounded by the connection pool so every worker keeps its own keep-alive socket
+        items = list(items)
+        if not items:
+            return []
+        workers = max(1, min(max_workers, self.pool_size, len(items)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(func, items))
+
+    def get_port_mappings(self):
+        # The whole table as GetGenericPortMappingEntry style dicts, or an error dict
+        try:
+            return [mapping.to_entry() for mapping in self.iter_port_mappings()]
+        except GatewayError as e:
+            return e.result
+
+    def iter_port_mappings(self):
+        # Yields a PortMapping for each entry as soon as it is parsed, so the first rows can be
+        # shown while the rest of the table is still coming in. Raises GatewayError with the
+        # usual error dict when no gateway answers.
+        error = self.resolve_gateway()
+        if error is not None:
+            raise GatewayError(error)
+
+        mappings = []
+        if 'GetListOfPortMappings' in self.actions:
+            try:
+                for entry in self.iter_port_mapping_list():
+                    mapping = self.read_port_mapping(entry)
+                    if mapping is not None:
+                        mappings.append(mapping)
+                        yield mapping
+                self.port_index.load(mappings)
+                return
+            except SOAPError as e:
+                print(f"GetListOfPortMappings failed, falling back to GetGenericPortMappingEntry.\n {e}")
+
+        # Entries the listing already yielded before it failed are skipped
+        listed = {mapping.key for mapping in mappings}
+        for entry in self.iter_generic_port_mappings():
+            mapping = self.read_port_mapping(entry)
+            if mapping is not None and mapping.key not in listed:
+                mappings.append(mapping)
+                yield mapping
+        self.port_index.load(mappings)
+
+    def read_port_mapping(self, entry):
+        try:
+            return PortMapping.from_entry(entry)
+        except (KeyError, ValueError, TypeError) as e:
+            print(f"Skipping unreadable port mapping entry.\n {e}")
+            return None
+
+    def iter_port_mapping_list(self):
+        # IGDv2 bulk listing, one request per protocol and page of PORT_LISTING_PAGE entries.
+        # TCP and UDP are fetched in parallel and pages are yielded in the order they arrive.
+        # Raises SOAPError when the router fails the listing.
+        pages = queue.Queue()
+
+        def fetch(protocol):
+            start_port = 0
+            try:
+                while start_port <= 65535:
+                    response, error = self.soap_request('GetListOfPortMappings', (
+                        start_port, 65535, protocol, PORT_LISTING_PAGE
+                    ))
+                    if error is not None:
+                        raise SOAPError(error['error'])
+                    if response.status_code != 200:
+                        fault_code, fault_description = parse_soap_fault(response.content)
+                        if fault_code == NO_MAPPINGS_FAULT:
+                            break
+                        raise SOAPError(f"{fault_code} {fault_description}" if fault_code else response.text)
+                    page = parse_port_listing(parse_soap_response(response.content).get('NewPortListing'))
+                    pages.put(page)
+                    if len(page) < PORT_LISTING_PAGE:
+                        break
+                    start_port = max(int(mapping['NewExternalPort']) for mapping in page) + 1
+            except (SOAPError, ValueError) as e:
+                pages.put(SOAPError(f"{protocol} listing: {e}"))
+                return
+            pages.put(None)
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            for protocol in ('TCP', 'UDP'):
+                executor.submit(fetch, protocol)
+            running = 2
+            while running:
+                page = pages.get()
+                if page is None:
+                    running -= 1
+                elif isinstance(page, SOAPError):
+                    raise page
+                else:
+                    yield from page
+
+    def get_port_mapping_count(self):
+        # PortMappingNumberOfEntries through QueryStateVariable, None if the router won't say
+        if not self.query_state_supported:
+            return None
+        response, error = self.soap_request('QueryStateVariable', ('PortMappingNumberOfEntries',),
+                                            namespace=QUERY_STATE_SERVICE)
+        if error is None and response.status_code == 200:
+            try:
+                return int(parse_soap_response(response.content).get('return'))
+            except (TypeError, ValueError, SOAPError):
+                pass
+        self.query_state_supported = False
+        return None
+
+    def request_port_mapping_entry(self, index):
+        response, error = self.soap_request('GetGenericPortMappingEntry', (index,))
+        result = self.soap_result(response, error)
+        if result['code'] == 0:
+            try:
+                result['mapping'] = self.parse_port_mappings(response.content)
+            except SOAPError as e:
+                result = dict(result, code=2, error=str(e))
+        return result
+
+    def iter_generic_port_mappings(self):
+        # IGDv1 walk in parallel windows of indexes, yielding entries in index order as they
+        # arrive. The table ends at fault 713, any other failure is retried once and then
+        # skipped so one bad answer doesn't truncate the list.
+        count = self.get_port_mapping_count()
+        window = self.pool_size
+        if count is not None:
+            # Fetch the whole table plus one index to confirm the end in a single window
+            window = max(window, count + 1)
+
+        index = 0
+        with ThreadPoolExecutor(max_workers=self.pool_size) as executor:
+            while True:
+                results = executor.map(self.request_port_mapping_entry, range(index, index + window))
+                fetched = 0
+                end = False
+                for offset, result in enumerate(results):
+                    if result['code'] != 0 and result['fault_code'] != END_OF_TABLE_FAULT:
+                        result = self.request_port_mapping_entry(index + offset)
+                    if result['code'] == 0:
+                        fetched += 1
+                        yield result['mapping']
+                    elif result['fault_code'] == END_OF_TABLE_FAULT:
+                        end = True
+                        break
+                    else:
+                        print(f"Skipping port mapping entry {index + offset}.\n {result['error']}")
+                # Routers that never send 713 stop once a whole window fails
+                if end or fetched == 0:
+                    break
+                index += window
+                window = self.pool_size
+
+    def request_remove_port_mapping(self, external_port, protocol):
+        started = time.perf_counter()
+        result = None
+        # Only mappings made over NAT-PMP or PCP can be deleted there
+        client = self.port_control
+        if client is not None and client.owns(str(protocol).upper(), external_port):
+            result = self.port_control_call(client, 'delete', client.remove, external_port, str(protocol).upper())
+        if result is None:
+            response, error = self.soap_request('DeletePortMapping', (external_port, protocol))
+            result = self.soap_result(response, error)
+        result['latency'] = time.perf_counter() - started
+        # 714 means it was already gone
+        if result['code'] == 0 or result['fault_code'] == '714':
+            self.port_index.remove(protocol, external_port)
+        return result
+
+    def request_add_port_mapping(self, internal_client, external_port, internal_port, protocol, description, leaseDuration):
+        started = time.perf_counter()
+        result = None
+        client = self.port_control_client(internal_client, protocol, leaseDuration)
+        if client is not None:
+            result = self.port_control_call(client, 'add', client.add, int(external_port), int(internal_port),
+                                            str(protocol).upper(), int(leaseDuration))
+        if result is None:
+            response, error = self.soap_request('AddPortMapping', (external_port, protocol, internal_port,
+                                                internal_client, description, leaseDuration))
+            result = self.soap_result(response, error)
+        result['latency'] = time.perf_counter() - started
+        if result['code'] == 0:
+            self.port_index.put(PortMapping(protocol.upper(), int(external_port), internal_client, int(internal_port),
+                                            True, description, int(leaseDuration)))
+        return result
+
+    def remove_port_mapping(self, external_port, protocol):
+        result = self.request_remove_port_mapping(external_port, protocol)
+        if result['code'] == 0:
+            print("Port mapping removed successfully.")
         else:
-            print("Failed to remove port mapping.\n",response.text)
-            return {
-                'code':2,
-                'error':response.text
-            }
+            print("Failed to remove port mapping.\n", result['error'])
+        return result
 
     def add_port_mapping(self, internal_client, external_port, internal_port, protocol, description, leaseDuration):
-        upnp_gateway = self.discover_upnp_devices()
-        try:
-            self.location = upnp_gateway['LOCATION']  # Change this to your router's description URL
-            self.control_url = self.get_control_url(self.location)
-        except Exception as e:
-            print(f"Failed to find IGD device.\n {e}")
-            return {
-                'code':1,
-                'error':f"Failed to find IGD device: {e}"
-            }
+        result = self.request_add_port_mapping(internal_client, external_port, internal_port, protocol, description, leaseDuration)
+        if result['code'] == 0:
+            print("Port mapping added successfully.")
+        else:
+            print("Failed to add port mapping.\n", result['error'])
+        return result
 
-        headers = {
-            "Content-Type": "text/xml",
-            "SOAPAction": '"urn:schemas-upnp-org:service:WANIPConnection:1#AddPortMapping"'
-        }
+    def remove_port_mappings(self, keys, max_workers=4):
+        # keys are (external_port, protocol) pairs, results come back in the same order
+        keys = list(keys)
+        # Discovery is only needed when some key goes over SOAP
+        client = self.port_control
+        if client is not None and all(client.owns(str(protocol).upper(), port) for port, protocol in keys):
+            error = None
+        else:
+            error = self.resolve_gateway()
+        if error is not None:
+            return [dict(error, external_port=port, protocol=protocol, fault_code=None, latency=0) for port, protocol in keys]
 
-        body = f"""<?xml version="1.0"?>
-        <s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"
-        s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">
-            <s:Body>
-                <u:AddPortMapping xmlns:u="urn:schemas-upnp-org:service:WANIPConnection:1">
-                    <NewRemoteHost></NewRemoteHost>
-                    <NewExternalPort>{external_port}</NewExternalPort>
-                    <NewProtocol>{protocol}</NewProtocol>
-                    <NewInternalPort>{internal_port}</NewInternalPort>
-                    <NewInternalClient>{internal_client}</NewInternalClient>
-                    <NewEnabled>1</NewEnabled>
-                    <NewPortMappingDescription>{description}</NewPortMappingDescription>
-                    <NewLeaseDuration>{leaseDuration}</NewLeaseDuration>
-                </u:AddPortMapping>
-            </s:Body>
-        </s:Envelope>"""
-
-        response = requests.post(f"{self.location.split('/')[0]}//{self.location.split('/')[2]}{self.control_url}", headers=headers, data=body)
+        def remove(key):
+            result = self.request_remove_port_mapping(*key)
+            result['external_port'], result['protocol'] = key
+            return result
 
-        if response.status_code == 200:
-            print("Port mapping added successfully.\n", response.text)
-            return {
-                'code':0,
-                'error':response.text
-            }
+        results = self.run_batch(remove, keys, max_workers)
+        failed = sum(1 for result in results if result['code'] != 0)
+        print(f"Removed {len(results) - failed} of {len(results)} port mappings.")
+        return results
 
+    def add_port_mappings(self, specs, max_workers=4):
+        # specs are dicts with ip, external_port, internal_port, protocol, description and lease keys
+        specs = list(specs)
+        # Discovery is only needed when some spec goes over SOAP
+        if specs and all(self.port_control_client(spec['ip'], spec['protocol'], spec['lease']) for spec in specs):
+            error = None
         else:
-            print("Failed to add port mapping.\n",response.text)
-            return {
-                'code':2,
-                'error':response.text
-            }
\ No newline at end of file
+            error = self.resolve_gateway()
+        if error is not None:
+            return [dict(spec, **error, fault_code=None, latency=0) for spec in specs]
+
+        def add(spec):
+            result = self.request_add_port_mapping(spec['ip'], spec['external_port'], spec['internal_port'],
+                                                   spec['protocol'], spec['description'], spec['lease'])
+            return dict(spec, **result)
+
+        results = self.run_batch(add, specs, max_workers)
+        failed = sum(1 for result in results if result['code'] != 0)
+        print(f"Added {len(results) - failed} of {len(results)} port mappings.")
+        return results
@@ -0,0 +1,314 @@
+import argparse
+import contextlib
+import json
+import sys
+
+# Only argparse and json at startup, the UPnP client (requests, netifaces, XML parsing) is
+# imported by the subcommands that talk to a router
+
+# UPnPinterface reports progress with print(), which goes to stderr while a command runs,
+# results are written here
+output = sys.stdout
+
+def parse_ports(values):
+    # "80", "27000-27010" -> list of ints
+    ports = []
+    for value in values:
+        if "-" in value:
+            first, last = value.split("-", 1)
+            ports.extend(range(int(first), int(last) + 1))
+        else:
+            ports.append(int(value))
+    return ports
+
+def parse_key(value):
+    # "UDP:27015" -> ('UDP', 27015), a bare port is TCP
+    if ":" in value:
+        protocol, port = value.split(":", 1)
+        return (protocol.upper(), int(port))
+    return ('TCP', int(value))
+
+def cell(value):
+    if value is None:
+        return ''
+    lines = str(value).splitlines()
+    return lines[0] if lines else ''
+
+def multi_gateway(args):
+    return args.all_gateways or len(args.gateway) > 1
+
+def create_interface(args):
+    data = {'renewals':'', 'cache_ttl':None, 'port_control':args.port_control}
+    if multi_gateway(args):
+        from classes.multi_gateway import MultiGatewayInterface
+        return MultiGatewayInterface(data, args.gateway)
+    from classes.upnp_interface import UPnPinterface
+    if args.gateway:
+        data['location'] = args.gateway[0]
+    return UPnPinterface(data)
+
+def create_client(args):
+    from classes.renewal_daemon import DaemonClient
+    return DaemonClient(args.socket)
+
+def print_rows(args, rows, columns):
+    if args.format == 'json':
+        json.dump(rows, output, indent=2)
+        print(file=output)
+        return
+    for row in rows:
+        print("\t".join(cell(row.get(column)) for column in columns), file=output)
+
+def print_results(args, results):
+    # A successful SOAP response body carries nothing worth printing
+    results = [dict(result, error='') if result['code'] == 0 else result for result in results]
+    columns = ('protocol', 'external_port', 'code', 'error')
+    print_rows(args, results, columns + ('gateway',) if multi_gateway(args) else columns)
+    return 0 if all(result['code'] == 0 for result in results) else 1
+
+def command_discover(args):
+    upnp = create_interface(args)
+    if multi_gateway(args):
+        # Searches every interface and adds each gateway that answers to the given ones
+        gateways = upnp.discover(args.collect_ms, args.timeout)
+    elif args.all:
+        gateways = upnp.discover_gateways(args.collect_ms, args.timeout)
+    else:
+        gateway = upnp.discover_upnp_devices(args.timeout)
+        gateways = [gateway] if gateway else []
+    print_rows(args, gateways, ('LOCATION', 'ST', 'SERVER', 'LOCAL_ADDRESS'))
+    return 0 if gateways else 1
+
+def command_list(args):
+    columns = ('NewProtocol', 'NewExternalPort', 'NewInternalClient', 'NewInternalPort',
+               'NewLeaseDuration', 'NewEnabled', 'NewPortMappingDescription')
+    if not args.daemon and not multi_gateway(args) and args.format != 'json':
+        # Rows are printed as the router returns them, the table is never held in memory
+        from classes.upnp_interface import GatewayError
+        try:
+            for mapping in create_interface(args).iter_port_mappings():
+                print_rows(args, (mapping.to_entry(),), columns)
+        except GatewayError as e:
+            print(e.result['error'], file=sys.stderr)
+            return 1
+        return 0
+
+    if args.daemon:
+        response = create_client(args).request('list', refresh=args.refresh)
+        if response['code'] != 0:
+            print(response['error'], file=sys.stderr)
+            return 1
+        mappings = response['mappings']
+    else:
+        mappings = create_interface(args).get_port_mappings()
+        if type(mappings) == dict:
+            print(mappings['error'], file=sys.stderr)
+            return 1
+    print_rows(args, mappings, columns + ('gateway',) if multi_gateway(args) else columns)
+    return 0
+
+def command_add(args):
+    specs = [{
+        'ip':args.ip,
+        'external_port':port,
+        'internal_port':port if args.internal_port is None else args.internal_port + offset,
+        'protocol':args.protocol,
+        'description':args.description,
+        'lease':args.lease
+    } for offset, port in enumerate(parse_ports(args.ports))]
+
+    if args.daemon:
+        client = create_client(args)
+        return print_results(args, [client.request('add', renew=args.renew, **spec) for spec in specs])
+
+    upnp = create_interface(args)
+    if not multi_gateway(args):
+        # Several gateways each fill in this host's address on their own network
+        for spec in specs:
+            spec['ip'] = spec['ip'] or upnp.get_local_ip()
+            if not spec['ip']:
+                print("No local address found, pass --ip", file=sys.stderr)
+                return 1
+    return print_results(args, upnp.add_port_mappings(specs))
+
+def command_remove(args):
+    keys = [parse_key(value) for value in args.mappings]
+    if args.daemon:
+        client = create_client(args)
+        return print_results(args, [client.request('remove', protocol=protocol, external_port=port) for protocol, port in keys])
+    return print_results(args, create_interface(args).remove_port_mappings([(port, protocol) for protocol, port in keys]))
+
+def command_renew(args):
+    # Re-adds existing mappings with a fresh lease, one enumeration plus one batch
+    keys = set(parse_key(value) for value in args.mappings)
+    upnp = create_interface(args)
+    mappings = upnp.get_port_mappings()
+    if type(mappings) == dict:
+        print(mappings['error'], file=sys.stderr)
+        return 1
+
+    specs = []
+    found = set()
+    for mapping in mappings:
+        key = (mapping['NewProtocol'].upper(), int(mapping['NewExternalPort']))
+        if key not in keys:
+            continue
+        found.add(key)
+        specs.append({
+            'gateway':mapping.get('gateway'),
+            'ip':mapping['NewInternalClient'],
+            'external_port':key[1],
+            'internal_port':int(mapping['NewInternalPort']),
+            'protocol':key[0],
+            'description':mapping['NewPortMappingDescription'] or '',
+            'lease':args.lease
+        })
+
+    results = upnp.add_port_mappings(specs)
+    results += [{'protocol':protocol, 'external_port':port, 'code':2, 'error':"No such port mapping"}
+                for protocol, port in sorted(keys - found)]
+    return print_results(args, results)
+
+def command_reconcile(args):
+    # The declared mappings are a JSON list of {ip, external_port, internal_port, protocol,
+    # description, lease} objects, ip and internal_port default to this host and the external port
+    from classes.reconciler import Reconciler
+    if multi_gateway(args):
+        print("reconcile works on one gateway, pick it with --gateway", file=sys.stderr)
+        return 1
+    with open(args.file, 'r', encoding='utf-8') if args.file != '-' else contextlib.nullcontext(sys.stdin) as declared:
+        desired = json.load(declared)
+
+    upnp = create_interface(args)
+    for lease in desired:
+        lease['ip'] = lease.get('ip') or upnp.get_local_ip()
+        if not lease['ip']:
+            print("No local address found, give every mapping an ip", file=sys.stderr)
+            return 1
+        lease['protocol'] = str(lease.get('protocol', 'TCP')).upper()
+        lease['internal_port'] = lease.get('internal_port', lease['external_port'])
+        lease['description'] = lease.get('description', 'simple_upnp')
+        lease['lease'] = lease.get('lease', 0)
+
+    owned = None
+    if args.prune_description is not None:
+        owned = lambda mapping: mapping['NewPortMappingDescription'] == args.prune_description
+    report = Reconciler(upnp).reconcile(desired, owned, args.force, args.dry_run)
+    if report['code'] != 0 and 'writes' not in report:
+        print(report['error'], file=sys.stderr)
+        return 1
+
+    if args.format == 'json':
+        json.dump(report, output, indent=2)
+        print(file=output)
+    elif args.dry_run:
+        for action in ('add', 'update', 'renew'):
+            for lease in report[action]:
+                print(f"{action}\t{lease['protocol']}\t{lease['external_port']}", file=output)
+        for protocol, port in report['delete']:
+            print(f"delete\t{protocol}\t{port}", file=output)
+    else:
+        for drift in report['drift']:
+            mapping = drift['mapping']
+            print(f"drift\t{mapping['NewProtocol']}\t{mapping['NewExternalPort']}\t{mapping['NewInternalClient']}", file=output)
+        for result in report['failed']:
+            print(f"failed\t{result['protocol']}\t{result['external_port']}\t{cell(result['error'])}", file=output)
+    return 0 if report['code'] == 0 else 1
+
+def command_allocate(args):
+    # Finds and maps a block of contiguous free ports in one batch
+    if multi_gateway(args):
+        print("allocate works on one gateway, pick it with --gateway", file=sys.stderr)
+        return 1
+    from classes.port_index import PortAllocator
+    first, last = parse_ports([args.range])[0], parse_ports([args.range])[-1]
+    report = PortAllocator(create_interface(args)).allocate(args.count, args.protocol, first, last, args.ip,
+                                                            args.description, args.lease, args.internal_port)
+    if report['code'] != 0:
+        print(report['error'], file=sys.stderr)
+        return 1
+    if args.format == 'json':
+        json.dump(report, output, indent=2)
+        print(file=output)
+    else:
+        print(f"{report['protocol']}\t{report['first_port']}\t{report['last_port']}", file=output)
+    return 0
+
+def command_metrics(args):
+    # Latency histograms and counters of the running daemon
+    response = create_client(args).request('metrics', format='json' if args.format == 'json' else 'prometheus')
+    if response['code'] != 0:
+        print(response['error'], file=sys.stderr)
+        return 1
+    if args.format == 'json':
+        json.dump({key:value for key, value in response.items() if key not in ('code', 'error')}, output, indent=2)
+        print(file=output)
+    else:
+        output.write(response['text'])
+    return 0
+
+def create_parser():
+    parser = argparse.ArgumentParser(prog="simple_upnp", description="Manage UPnP port mappings from the command line.")
+    parser.add_argument('--format', choices=('tsv', 'json'), default='tsv', help="Output format")
+    parser.add_argument('--daemon', action='store_true', help="Go through the renewal daemon instead of the router")
+    parser.add_argument('--socket', default=None, help="Renewal daemon socket path")
+    parser.add_argument('--gateway', action='append', default=[], help="Description URL of a gateway to use instead of searching, can be repeated")
+    parser.add_argument('--all-gateways', action='store_true', help="Work on every gateway found on any interface")
+    parser.add_argument('--port-control', choices=('auto', 'pcp', 'natpmp', 'soap'), default='auto', help="Protocol for this host's leases, auto uses PCP or NAT-PMP when the gateway answers and SOAP otherwise")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    discover = subparsers.add_parser('discover', help="Find the internet gateway")
+    discover.add_argument('--all', action='store_true', help="List every gateway that answers")
+    discover.add_argument('--timeout', type=float, default=2, help="Seconds to wait for an answer")
+    discover.add_argument('--collect-ms', type=int, default=500, help="How long --all listens")
+    discover.set_defaults(func=command_discover)
+
+    list_parser = subparsers.add_parser('list', help="List the router's port mappings")
+    list_parser.add_argument('--refresh', action='store_true', help="With --daemon, re-read the router first")
+    list_parser.set_defaults(func=command_list)
+
+    add = subparsers.add_parser('add', help="Add port mappings")
+    add.add_argument('ports', nargs='+', help="External ports or ranges such as 27000-27010")
+    add.add_argument('--protocol', type=str.upper, choices=('TCP', 'UDP'), default='TCP')
+    add.add_argument('--ip', default=None, help="Internal client, defaults to this host")
+    add.add_argument('--internal-port', type=int, default=None, help="First internal port, defaults to the external port")
+    add.add_argument('--description', default="simple_upnp")
+    add.add_argument('--lease', type=int, default=0, help="Lease duration in seconds, 0 for permanent")
+    add.add_argument('--no-renew', dest='renew', action='store_false', help="With --daemon, don't keep the lease renewed")
+    add.set_defaults(func=command_add)
+
+    remove = subparsers.add_parser('remove', help="Remove port mappings")
+    remove.add_argument('mappings', nargs='+', help="PROTOCOL:PORT, a bare port is TCP")
+    remove.set_defaults(func=command_remove)
+
+    renew = subparsers.add_parser('renew', help="Re-add existing port mappings with a new lease")
+    renew.add_argument('mappings', nargs='+', help="PROTOCOL:PORT, a bare port is TCP")
+    renew.add_argument('--lease', type=int, required=True, help="New lease duration in seconds")
+    renew.set_defaults(func=command_renew)
+
+    reconcile = subparsers.add_parser('reconcile', help="Make the router match a declared set of mappings")
+    reconcile.add_argument('file', help="JSON list of mappings, - for stdin")
+    reconcile.add_argument('--prune-description', default=None, help="Delete undeclared mappings with this description")
+    reconcile.add_argument('--force', action='store_true', help="Take back ports another host has mapped")
+    reconcile.add_argument('--dry-run', action='store_true', help="Only print the planned changes")
+    reconcile.set_defaults(func=command_reconcile)
+
+    allocate = subparsers.add_parser('allocate', help="Map a block of contiguous free external ports")
+    allocate.add_argument('count', type=int, help="Number of ports")
+    allocate.add_argument('--range', default="1024-65535", help="Ports to pick the block from, such as 27000-28000")
+    allocate.add_argument('--protocol', type=str.upper, choices=('TCP', 'UDP'), default='UDP')
+    allocate.add_argument('--ip', default=None, help="Internal client, defaults to this host")
+    allocate.add_argument('--internal-port', type=int, default=None, help="First internal port, defaults to the external ports")
+    allocate.add_argument('--description', default="simple_upnp")
+    allocate.add_argument('--lease', type=int, default=0, help="Lease duration in seconds, 0 for permanent")
+    allocate.set_defaults(func=command_allocate)
+
+    metrics = subparsers.add_parser('metrics', help="Print the daemon's metrics, Prometheus text unless --format json")
+    metrics.set_defaults(func=command_metrics)
+    return parser
+
+if __name__ == '__main__':
+    args = create_parser().parse_args()
+    with contextlib.redirect_stdout(sys.stderr):
+        status = args.func(args)
+    sys.exit(status)
@@ -0,0 +1,23 @@
+import argparse
+import signal
+import sys
+from classes.renewal_daemon import RenewalDaemon, default_socket_path
+from classes.mapping_store import StoreLockedError, default_store_path
+
+parser = argparse.ArgumentParser(description="Keep UPnP port mappings renewed in the background.")
+parser.add_argument('--socket', default=default_socket_path(), help="Unix socket for the JSON control API")
+parser.add_argument('--refresh-interval', type=int, default=300, help="Seconds between router table refreshes when the gateway sends no events")
+parser.add_argument('--store', default=default_store_path(), help="Journal of the mappings to keep renewed")
+parser.add_argument('--cache-ttl', type=int, default=300, help="Seconds to keep the discovered gateway")
+parser.add_argument('--port-control', choices=('auto', 'pcp', 'natpmp', 'soap'), default='auto', help="Protocol for this host's leases, auto uses PCP or NAT-PMP when the gateway answers and SOAP otherwise")
+args = parser.parse_args()
+
+try:
+    daemon = RenewalDaemon(args.socket, args.refresh_interval, {'renewals':'', 'cache_ttl':args.cache_ttl, 'port_control':args.port_control}, args.store)
+except StoreLockedError as e:
+    # Another daemon, or the GUI, already renews the leases in this store
+    print(f"{e}, not starting.", file=sys.stderr)
+    sys.exit(1)
+signal.signal(signal.SIGTERM, lambda signum, frame: daemon.shutdown())
+signal.signal(signal.SIGINT, lambda signum, frame: daemon.shutdown())
+daemon.serve_forever()
@@ -1,8 +1,14 @@
 import gi
+import os
+import time
 gi.require_version("Gtk", "3.0")
 from gi.repository import Gtk, GLib
-from classes.upnp_interface import UPnPinterface
-import datetime
+from classes.upnp_interface import UPnPinterface, GatewayError
+from classes.task_runner import TaskRunner
+from classes.renewal_scheduler import RenewalScheduler
+from classes.mapping_store import MappingStore, StoreLockedError
+from classes.renewal_daemon import DaemonClient
+from classes.gena import EventListener
 
 class MainWindow(Gtk.Window):
     def __init__(self, *args, **kwargs):
@@ -25,11 +31,37 @@ class MainWindow(Gtk.Window):
         self.box1.pack_start(self.labelRow, True, True, 0)
         self.box1.pack_start(self.inputRow, True, True, 0)
 
+        # All router calls run on worker threads, results come back through GLib.idle_add
+        self.runner = TaskRunner(GLib.idle_add, on_busy=self.onBusyChanged, metrics=upnp.metrics)
+        # Every auto-renewed lease, keyed by (protocol, external port), renewed in batches on one timer thread
+        self.scheduler = RenewalScheduler(upnp.add_port_mappings, on_result=self.onRenewed, metrics=upnp.metrics)
+        # Keys of the leases the renewal daemon keeps renewed, read with every refresh
+        self.daemon = None
+        self.daemonLeases = set()
+        try:
+            self.store = MappingStore()
+        except StoreLockedError as e:
+            # The renewal daemon has the journal, leases are handed to it instead of renewed here
+            print(f"{e}, renewals go through the renewal daemon.")
+            self.store = None
+            self.daemon = DaemonClient()
+        else:
+            # Restore the leases to renew from the last session before the router has even answered
+            for key, record in self.store.items():
+                self.scheduler.schedule(record['lease'], due=time.monotonic() + self.store.renewal_delay(key))
+        self.scheduler.start()
+
         self.createPortMapperMenu()
         self.createUPnPMappingList()
+
+        # Refresh when the router reports a change instead of waiting for the Refresh button
+        self.events = EventListener(upnp, self.onRouterEvent)
+        self.runner.submit(self.events.start, callback=self.onEventsStarted)
     
     def createUPnPMappingList(self):
         self.liststore = Gtk.ListStore(str, str, int, int, str, bool, bool)
+        # (protocol, external port) -> row iter, ListStore iters stay valid until the row is removed
+        self.rows = {}
         # Testing with IGD failures
         #self.liststore.append(["TCP",f"192.168.1.100:{12345}", 12345, 30, "Server",False, False])
         self.refreshMappingsList()
@@ -74,9 +106,51 @@ class MainWindow(Gtk.Window):
         self.refreshButton.connect('clicked', self.onRefreshClicked)
         self.removeButton.connect('clicked', self.removePort)
 
+        self.spinner = Gtk.Spinner()
+        self.statusLabel = Gtk.Label()
+        self.statusBox = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=5)
+        self.statusBox.pack_start(self.spinner, False, False, 0)
+        self.statusBox.pack_start(self.statusLabel, False, False, 0)
+
         self.gridBox.pack_start(treeview, False, False, 0)
         self.gridBox.pack_start(self.refreshButton, False, False, 0)
         self.gridBox.pack_start(self.removeButton, False, False, 0)
+        self.gridBox.pack_start(self.statusBox, False, False, 0)
+
+    def onEventsStarted(self, error):
+        if error is not None:
+            print(f"Router doesn't send events, use Refresh to update the list.\n {error['error']}")
+
+    def onRouterEvent(self, variables, missed):
+        # Called from the event listener thread
+        GLib.idle_add(self.onRouterChanged, variables, missed)
+
+    def onRouterChanged(self, variables, missed):
+        count = variables.get('PortMappingNumberOfEntries')
+        if missed or (count is not None and count != str(len(self.rows))):
+            print("Router reported a change, refreshing list...")
+            self.refreshMappingsList()
+        return False
+
+    def onDestroy(self, window):
+        self.events.stop()
+        self.scheduler.stop()
+        self.runner.shutdown()
+        if self.store is not None:
+            self.store.close()
+        # SIMPLE_UPNP_METRICS=path.json (or .prom for the Prometheus text format) keeps the session's timings
+        metricsPath = os.environ.get('SIMPLE_UPNP_METRICS')
+        if metricsPath:
+            upnp.metrics.write(metricsPath, 'prometheus' if metricsPath.endswith('.prom') else 'json')
+        Gtk.main_quit()
+
+    def onBusyChanged(self, busy):
+        if busy:
+            self.spinner.start()
+            self.statusLabel.set_text(f"Talking to router ({busy} pending)...")
+        else:
+            self.spinner.stop()
+            self.statusLabel.set_text("")
 
     def on_remove_toggled(self, widget, path):
         self.liststore[path][6] = not self.liststore[path][6]
@@ -85,7 +159,7 @@ class MainWindow(Gtk.Window):
         self.internalPortBox = Gtk.Entry(text="12345")
         self.externalPortBox = Gtk.Entry(text="12345")
         ip = upnp.get_local_ip()
-        self.internalIPBox = Gtk.Entry(text=ip)
+        self.internalIPBox = Gtk.Entry(text=ip or "")
         self.leaseDurationBox = Gtk.Entry(text="0")
         self.descriptionBox = Gtk.Entry(text="Server")
         
@@ -136,6 +210,19 @@ class MainWindow(Gtk.Window):
 
     def addPort(self, button):
         protocol = "TCP" if self.button1.get_active() else "UDP"
+        # Checked against the last refresh, no need to wait for the router to answer 718
+        holder = upnp.port_index.conflict(protocol, int(self.externalPortBox.get_text()), self.internalIPBox.get_text())
+        if holder is not None:
+            dialog = Gtk.MessageDialog(
+                transient_for=None,
+                flags=0,
+                message_type=Gtk.MessageType.ERROR,
+                buttons=Gtk.ButtonsType.OK,
+                text=f"{protocol} port {self.externalPortBox.get_text()} is already mapped to {holder.internal_client or 'another host'}."
+            )
+            dialog.run()
+            dialog.destroy()
+            return
         if self.renewButton.get_active():
             data = {
                 'ip':self.internalIPBox.get_text(), 
@@ -145,8 +232,7 @@ class MainWindow(Gtk.Window):
                 'description':self.descriptionBox.get_text(), 
                 'lease':int(self.leaseDurationBox.get_text())
             }
-            renewalList.append(data)
-            self.schedule_renewal(data, len(renewalList)-1)
+            self.schedule_renewal(data)
         if self.renewButton.get_active() and int(self.leaseDurationBox.get_text()) < 10:
                 dialog = Gtk.MessageDialog(
                     transient_for=None,
@@ -157,12 +243,17 @@ class MainWindow(Gtk.Window):
                 )
                 dialog.run()
                 dialog.destroy()
-        response = upnp.add_port_mapping(self.internalIPBox.get_text(), 
+        if self.renewButton.get_active() and self.daemon is not None:
+            # The daemon makes the mapping itself, onDaemonAnswered reports how it went
+            return
+        self.runner.submit(upnp.add_port_mapping, (self.internalIPBox.get_text(), 
                          int(self.externalPortBox.get_text()), 
                          int(self.internalPortBox.get_text()), 
                          protocol, 
                          self.descriptionBox.get_text(), 
-                         int(self.leaseDurationBox.get_text()))
+                         int(self.leaseDurationBox.get_text())), self.onPortAdded)
+
+    def onPortAdded(self, response):
         if response['code'] == 0:
             dialog = Gtk.MessageDialog(
                 transient_for=None,
@@ -187,101 +278,149 @@ class MainWindow(Gtk.Window):
         self.refreshMappingsList()
     
     def removePort(self, button):
+        keys = []
         iter = self.liststore.get_iter_first()
         while iter is not None:
-            port, protocol, remove = self.liststore.get(iter, 2, 0, 5)
-            iter = self.liststore.iter_next(iter)
-            if not(remove):
-                continue
-            response = upnp.remove_port_mapping(port, protocol)
-            if response['code'] == 0:
-                dialog = Gtk.MessageDialog(
-                    transient_for=None,
-                    flags=0,
-                    message_type=Gtk.MessageType.INFO,
-                    buttons=Gtk.ButtonsType.OK,
-                    text=f"Port mapping removed successfully."
-                )
-                dialog.run()
-                dialog.destroy()
-            else:
-                dialog = Gtk.MessageDialog(
-                    transient_for=None,
-                    flags=0,
-                    message_type=Gtk.MessageType.ERROR,
-                    buttons=Gtk.ButtonsType.OK,
-                    text=f"Failed to remove port mapping.\nReturned {response['code']} {response['error']}"
-                )
-                dialog.run()
-                dialog.destroy()
-                break
-            
-    def renewal(self, data, renewalIndex):
-        lease = data['lease']
-        protocol = data['protocol']
-        IP = data['ip']
-        internal_port = data['internal_port']
-        external_port = data['external_port']
-        desc = data['description']
-        iter = self.liststore.get_iter_first()
-        listItem = None
-        while iter is not None:
-            itemProtocol, itemIp_port, itemExternal_port = self.liststore.get(iter, 0, 1, 2)
-            if str(protocol) == str(protocol) and str(itemIp_port) == f"{IP}:{internal_port}" and str(itemExternal_port) == str(external_port):
-                listItem = iter
+            port, protocol, remove = self.liststore.get(iter, 2, 0, 6)
             iter = self.liststore.iter_next(iter)
-        if self.liststore[listItem][5]:
-            response = upnp.add_port_mapping(IP, internal_port, external_port, protocol, desc, lease)
-            if response['code'] == 0:
-                print(f"Port mapping renewed successfully.")
-                self.schedule_renewal(data, renewalIndex)
-            else:
-                dialog = Gtk.MessageDialog(
-                    transient_for=None,
-                    flags=0,
-                    message_type=Gtk.MessageType.ERROR,
-                    buttons=Gtk.ButtonsType.OK,
-                    text=f"Failed to renew port mapping.\nReturned {response['code']} {response['error']}"
-                )
-                dialog.run()
-                dialog.destroy()
-                renewalList.pop(renewalIndex)
-                self.liststore[listItem][5] = not self.liststore[listItem][5]
+            if remove:
+                keys.append((port, protocol))
+        if not keys:
+            return
+        self.runner.submit(upnp.remove_port_mappings, (keys,), self.onPortsRemoved)
+
+    def onPortsRemoved(self, results):
+        failures = [result for result in results if result['code'] != 0]
+        if not failures:
+            dialog = Gtk.MessageDialog(
+                transient_for=None,
+                flags=0,
+                message_type=Gtk.MessageType.INFO,
+                buttons=Gtk.ButtonsType.OK,
+                text=f"Removed {len(results)} port mapping(s) successfully."
+            )
         else:
-            renewalList.pop(renewalIndex)
-            print("Renewal cancelled:",protocol,IP,internal_port,external_port,lease,desc)
+            details = "\n".join(f"{result['protocol']} {result['external_port']}: {result['code']} {result['error']}" for result in failures)
+            dialog = Gtk.MessageDialog(
+                transient_for=None,
+                flags=0,
+                message_type=Gtk.MessageType.ERROR,
+                buttons=Gtk.ButtonsType.OK,
+                text=f"Failed to remove {len(failures)} of {len(results)} port mapping(s).\n{details}"
+            )
+        dialog.run()
+        dialog.destroy()
+        self.refreshMappingsList()
+            
+    def onRenewed(self, key, data, response):
+        # Called from the scheduler thread, a failed lease still in the scheduler will be retried
+        if response['code'] == 0:
+            print(f"Port mapping renewed successfully.")
+            self.store.record_renewal(key)
+            return
+        if key in self.scheduler:
+            print(f"Port mapping renewal failed, retrying.\n {response['error']}")
+            return
+        self.store.delete(key)
+        GLib.idle_add(self.onRenewalFailed, key, response)
+
+    def onRenewalFailed(self, key, response):
+        dialog = Gtk.MessageDialog(
+            transient_for=None,
+            flags=0,
+            message_type=Gtk.MessageType.ERROR,
+            buttons=Gtk.ButtonsType.OK,
+            text=f"Failed to renew port mapping.\nReturned {response['code']} {response['error']}"
+        )
+        dialog.run()
+        dialog.destroy()
+        iter = self.rows.get(key)
+        if iter is not None:
+            self.liststore.set_value(iter, 5, False)
+        return False
     
     def toggle_renewal(self, toggle, data):
         self.liststore[data][5] = not self.liststore[data][5]
+        key = (self.liststore[data][0], self.liststore[data][2])
         
         if self.liststore[data][5]:
             leaseData = {
                 'ip':self.liststore[data][1].split(":", 1)[0], 
                 'external_port':self.liststore[data][2], 
-                'internal_port':self.liststore[data][1].split(":", 1)[1], 
+                'internal_port':int(self.liststore[data][1].split(":", 1)[1]), 
                 'protocol':self.liststore[data][0], 
                 'description':self.liststore[data][4], 
                 'lease':self.liststore[data][3]
             }
-            renewalList.append(leaseData)
-            self.schedule_renewal(leaseData, len(renewalList)-1) 
+            self.schedule_renewal(leaseData) 
+        elif self.daemon is not None:
+            self.runner.submit(self.requestDaemon, ('cancel', {'protocol':key[0], 'external_port':key[1]}), self.onDaemonAnswered)
         else: 
+            self.scheduler.cancel(key)
+            self.store.delete(key)
             print("Cancelled")
 
 
-    def schedule_renewal(self, data, renewalIndex):
-        now = datetime.datetime.now()
-        scheduled_time = now + datetime.timedelta(seconds=data['lease']/2)
-        time_difference = (scheduled_time - now).total_seconds()
-        print("Renewal scheduled for:", scheduled_time)
-        GLib.timeout_add_seconds(int(time_difference), lambda: self.renewal(data, renewalIndex))
+    def schedule_renewal(self, data):
+        if self.daemon is not None:
+            self.runner.submit(self.requestDaemon, ('add', dict(data, renew=True)), self.onDaemonAnswered)
+            return
+        if data['lease'] > 0:
+            self.store.put(data)
+        due = self.scheduler.schedule(data)
+        if due is not None:
+            print(f"Renewal scheduled in {due - time.monotonic():.0f} s.")
+
+    def requestDaemon(self, command, arguments):
+        # Runs on a worker
+        try:
+            return self.daemon.request(command, **arguments)
+        except (OSError, ValueError) as e:
+            return {'code':3, 'error':f"Renewal daemon not reachable: {e}"}
+
+    def onDaemonAnswered(self, response):
+        if response['code'] != 0:
+            dialog = Gtk.MessageDialog(
+                transient_for=None,
+                flags=0,
+                message_type=Gtk.MessageType.ERROR,
+                buttons=Gtk.ButtonsType.OK,
+                text=f"Renewal daemon request failed.\nReturned {response['code']} {response['error']}"
+            )
+            dialog.run()
+            dialog.destroy()
+        # The renew column follows what the daemon actually keeps renewed
+        self.refreshMappingsList()
 
     def onRefreshClicked(self, button):
         self.refreshMappingsList()
 
     def refreshMappingsList(self):
-        mappings = upnp.get_port_mappings()
-        self.liststore.clear()
+        # Refreshes requested while one is in flight collapse into a single follow-up
+        self.runner.submit(self.loadMappings, callback=self.onMappingsLoaded, key='refresh')
+
+    def loadMappings(self):
+        # Runs on a worker, rows are shown in chunks as the router answers instead of all at the end
+        if self.daemon is not None:
+            status = self.requestDaemon('status', {})
+            if status['code'] == 0:
+                self.daemonLeases = {(lease['protocol'], int(lease['external_port'])) for lease in status['renewals']}
+        mappings = []
+        chunk = []
+        try:
+            for mapping in upnp.iter_port_mappings():
+                mappings.append(mapping)
+                chunk.append(mapping)
+                if len(chunk) == 64:
+                    self.runner.call_soon(self.updateMappings, chunk)
+                    chunk = []
+        except GatewayError as e:
+            return e.result
+        if chunk:
+            self.runner.call_soon(self.updateMappings, chunk)
+        return mappings
+
+    def onMappingsLoaded(self, mappings):
         if type(mappings) == dict:
             dialog = Gtk.MessageDialog(
                 transient_for=None,
@@ -293,22 +432,34 @@ class MainWindow(Gtk.Window):
             dialog.run()
             dialog.destroy()
         else:
-            for mapping in mappings:
-                if len(renewalList) > 0:
-                    for i in range(len(renewalList)):
-                        renewal = renewalList[i]
-                        if str(renewal['ip']) == str(mapping['NewInternalClient']) and str(renewal['internal_port']) == str(mapping['NewInternalPort']) and str(renewal['external_port']) == str(mapping['NewExternalPort']):
-                           self.liststore.append([mapping['NewProtocol'],f"{mapping['NewInternalClient']}:{mapping['NewInternalPort']}", int(mapping['NewExternalPort']), int(mapping['NewLeaseDuration']), mapping['NewPortMappingDescription'] , True, False])
-                        else:
-                            self.liststore.append([mapping['NewProtocol'],f"{mapping['NewInternalClient']}:{mapping['NewInternalPort']}", int(mapping['NewExternalPort']), int(mapping['NewLeaseDuration']), mapping['NewPortMappingDescription'] , False, False])
-                else:
-                    self.liststore.append([mapping['NewProtocol'],f"{mapping['NewInternalClient']}:{mapping['NewInternalPort']}", int(mapping['NewExternalPort']), int(mapping['NewLeaseDuration']), mapping['NewPortMappingDescription'] , False, False])
+            self.applyMappings(mappings)
         print("Mapping list refreshed.")
 
+    def applyMappings(self, mappings):
+        # Diff the router table against the rows by (protocol, external port), so a refresh only
+        # touches rows that changed and keeps the selection, scroll position and Remove marks
+        seen = {mapping.key for mapping in mappings}
+        self.updateMappings(mappings)
+        for key in [key for key in self.rows if key not in seen]:
+            self.liststore.remove(self.rows.pop(key))
+
+    def updateMappings(self, mappings):
+        # Adds and updates rows only, rows gone from the router are dropped once the whole table is in
+        for mapping in mappings:
+            key = mapping.key
+            values = [mapping.protocol, f"{mapping.internal_client}:{mapping.internal_port}", mapping.external_port, mapping.lease, mapping.description, key in self.scheduler or key in self.daemonLeases]
+            iter = self.rows.get(key)
+            if iter is None:
+                self.rows[key] = self.liststore.append(values + [False])
+                continue
+            current = self.liststore.get(iter, *range(len(values)))
+            columns = [column for column in range(len(values)) if current[column] != values[column]]
+            if columns:
+                self.liststore.set(iter, columns, [values[column] for column in columns])
+
 upnp = UPnPinterface({'location':'','control_url':'','renewals':''})
-renewalList = []
 
 win = MainWindow()
-win.connect("destroy", Gtk.main_quit)
+win.connect("destroy", win.onDestroy)
 win.show_all()
 Gtk.main()
\ No newline at end of file